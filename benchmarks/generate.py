@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Deterministic synthetic JSONL corpora for benchmarks
+"""
+
+import sys
+import json
+import random
+import string
+
+WORDS = ("the of and to in is you that it he was for on are as with his they at be this have from or one had "
+         "by word but not what all were we when your can said there use an each which she do how their if will "
+         "up other about out many then them these so some her would make like him into time has look two more "
+         "write go see number no way could people my than first water been call who oil its now find long down "
+         "day did get come made may part").split()
+
+def _text(rng, n_words):
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+def flat(rng, i):
+    """
+    A wide record of 40 scalar fields of mixed types.
+    """
+    ret = {"id": i}
+    for j in range(10):
+        ret["f%d" % j] = rng.random()
+        ret["i%d" % j] = rng.randrange(1000)
+        ret["s%d" % j] = rng.choice(WORDS)
+        ret["b%d" % j] = rng.random() < 0.5
+    return ret
+
+def _nested(rng, depth):
+    if depth == 0:
+        return rng.choice([rng.random(), rng.randrange(100), rng.choice(WORDS), None])
+    if rng.random() < 0.3:
+        return [_nested(rng, depth - 1) for _ in range(rng.randrange(1, 4))]
+    return {"k%d" % j: _nested(rng, depth - 1) for j in range(rng.randrange(1, 4))}
+
+def nested(rng, i):
+    """
+    A record with deeply nested dicts and lists.
+    """
+    return {
+        "id": i,
+        "user": {"name": rng.choice(WORDS), "address": {"city": rng.choice(WORDS), "zip": rng.randrange(10000)}},
+        "items": [{"sku": rng.randrange(100), "price": round(rng.random() * 100, 2),
+                   "tags": [rng.choice(WORDS) for _ in range(rng.randrange(3))]} for _ in range(rng.randrange(1, 6))],
+        "tree": _nested(rng, 5),
+    }
+
+def text(rng, i):
+    """
+    A chat transcript with a few long text fields.
+    """
+    return {
+        "id": i,
+        "user": "u%d" % rng.randrange(100),
+        "lang": rng.choice(["en", "fr", "de"]),
+        "messages": [{"role": role, "text": _text(rng, rng.randrange(20, 200))} for role in ["user", "assistant"]],
+        "score": rng.random(),
+    }
+
+def mixed(rng, i):
+    """
+    Records with varying keys, some of which change type.
+    """
+    ret = {"id": i}
+    for key in rng.sample(string.ascii_lowercase[:12], rng.randrange(2, 10)):
+        ret[key] = rng.choice([rng.random(), rng.randrange(100), rng.choice(WORDS), [rng.random()], {"x": rng.random()}])
+    return ret
+
+CORPORA = {
+    "flat": flat,
+    "nested": nested,
+    "text": text,
+    "mixed": mixed,
+}
+
+def generate(kind, n, seed=0):
+    """
+    Yields @n records of corpus @kind; the same arguments always give the
+    same records.
+    """
+    rng = random.Random(seed)
+    make = CORPORA[kind]
+    for i in range(n):
+        yield make(rng, i)
+
+def write_jsonl(fname, kind, n, seed=0):
+    with open(fname, "w") as f:
+        for obj in generate(kind, n, seed):
+            f.write(json.dumps(obj) + "\n")
+
+def write_tsv(fname, n, seed=0):
+    """
+    Writes the string fields of the flat corpus as a TSV for `import`.
+    """
+    with open(fname, "w") as f:
+        for i, obj in enumerate(generate("flat", n, seed)):
+            row = {key: str(value) for key, value in obj.items()}
+            if i == 0:
+                f.write("\t".join(row) + "\n")
+            f.write("\t".join(row.values()) + "\n")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Generates synthetic JSONL corpora')
+    parser.add_argument('kind', choices=CORPORA, help="Kind of records")
+    parser.add_argument('-n', '--records', type=int, default=100000, help="Number of records")
+    parser.add_argument('-s', '--seed', type=int, default=0, help="Random seed")
+    parser.add_argument('-o', '--output', type=str, help="Output file (default: stdout)")
+    args = parser.parse_args()
+
+    if args.output:
+        write_jsonl(args.output, args.kind, args.records, args.seed)
+    else:
+        for obj in generate(args.kind, args.records, args.seed):
+            sys.stdout.write(json.dumps(obj) + "\n")
+
+if __name__ == "__main__":
+    main()
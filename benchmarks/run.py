@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the jsontool commands and of its core functions
+
+Runs each command on synthetic corpora (see generate.py) in a separate
+process and reports records/s, MB/s and peak RSS as JSON, e.g.:
+
+    python benchmarks/run.py -n 50000 -o after.json --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import tempfile
+import subprocess
+
+import generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, corpus, arguments); the corpus "tsv" is the flat corpus as a TSV.
+SCENARIOS = [
+    ("filter", "flat", ["filter", "-e", "$.f0 > 0.5"]),
+    ("filter-all", "flat", ["filter", "-a", "-e", "$.i0 < 500", "$.s0 == \"the\""]),
+    ("filter-deep", "nested", ["filter", "-e", "$.user.address.zip < 5000"]),
+    ("filter-regex", "text", ["filter", "-e", "find(\"water\", $.messages[0].text)"]),
+    ("filter-mixed", "mixed", ["filter", "-e", "$.a > 50"]),
+    ("extract", "nested", ["extract", "-s", "{\"id\": \"$.id\", \"city\": \"$.user.address.city\", \"skus\": \"$.items[*].sku\"}"]),
+    ("extract", "text", ["extract", "-s", "{\"user\": \"$.user\", \"n\": \"len($.messages)\"}"]),
+    ("csv", "flat", ["csv"]),
+    ("csv", "mixed", ["csv"]),
+    ("pp", "nested", ["pp"]),
+    ("pp", "text", ["pp"]),
+    ("agg", "flat", ["agg", "-g", "$.s0", "-a", "count", "mean:$.f0", "p90:$.i0"]),
+    ("import", "tsv", ["import"]),
+]
+
+def _corpus(data_dir, corpus, n):
+    fname = os.path.join(data_dir, "{}-{}.{}".format(corpus, n, "tsv" if corpus == "tsv" else "jsonl"))
+    if not os.path.exists(fname):
+        if corpus == "tsv":
+            generate.write_tsv(fname, n)
+        else:
+            generate.write_jsonl(fname, corpus, n)
+    return fname
+
+def run_command(args, fname, n):
+    """
+    Runs `jsontool @args` on @fname and returns its wall time, peak RSS
+    and throughput.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    cmd = [sys.executable, "-m", "jsontool.main"] + args + ["-i", fname, "-o", os.devnull]
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    proc.returncode = status
+    if status != 0:
+        raise RuntimeError("{} exited with status {}".format(" ".join(cmd), status))
+    size = os.path.getsize(fname)
+    return {
+        "seconds": seconds,
+        "records_per_s": n / seconds,
+        "mb_per_s": size / seconds / 1e6,
+        # ru_maxrss is in KB on Linux and in bytes on macOS.
+        "peak_rss_kb": usage.ru_maxrss // (1024 if sys.platform == "darwin" else 1),
+    }
+
+def micro_benchmarks(n):
+    """
+    Yields (name, calls per second) of the core functions.
+    """
+    sys.path.insert(0, ROOT)
+    from jsontool.expr import parse_expr, JsonPath, parse_jsonpath
+    from jsontool.schema import parse_schema, apply_schema
+
+    objs = list(generate.generate("nested", min(n, 1000)))
+    exprs = ["$.a > 0", "mean($.xs) + 1 < 2 && $.b == \"x\"", "find(\"ab+\", $.s) ? $.x : $.y",
+             "sum(len{$.items[*].tags})"]
+
+    def rate(fn, calls):
+        seconds = min(timeit.repeat(fn, number=1, repeat=3))
+        return calls / seconds
+
+    yield "parse_expr", rate(lambda: [parse_expr(expr) for expr in exprs], len(exprs))
+    for path in ["$.user.address.city", "$.items[*].sku", "$..sku", "$.items[0:2].sku"]:
+        path_ = JsonPath(parse_jsonpath(path))
+        yield "JsonPath({})".format(path), rate(lambda: [path_(obj) for obj in objs], len(objs))
+    schema = parse_schema({"id": "$.id", "city": "$.user.address.city", "skus": "$.items[*].sku",
+                           "n": "len($.items)", "user": {"name": "$.user.name", "zip": "$.user.address.zip"}})
+    yield "apply_schema", rate(lambda: [apply_schema(schema, obj) for obj in objs], len(objs))
+
+def _key(result):
+    return (result["name"], result.get("corpus"))
+
+def compare(results, baseline, threshold):
+    """
+    Prints the speed of @results relative to @baseline and returns the
+    names of those that are slower by more than @threshold.
+    """
+    old = {_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        if _key(result) not in old:
+            continue
+        ratio = result["records_per_s"] / old[_key(result)]["records_per_s"]
+        print("{:40} {:8.2f}x".format(" ".join(filter(None, _key(result))), ratio), file=sys.stderr)
+        if ratio < 1 - threshold:
+            regressions.append(" ".join(filter(None, _key(result))))
+    return regressions
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks jsontool')
+    parser.add_argument('-n', '--records', type=int, default=50000, help="Number of records per corpus")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Runs of each command; the fastest is reported")
+    parser.add_argument('-k', '--only', type=str, nargs="+", help="Only run these scenarios (names as in the output)")
+    parser.add_argument('-d', '--data-dir', type=str, help="Where to keep generated corpora between runs (default: a temporary directory)")
+    parser.add_argument('-o', '--output', type=str, help="Write results as JSON to this file (default: stdout)")
+    parser.add_argument('-c', '--compare', type=str, help="Results of an earlier run to compare against")
+    parser.add_argument('-t', '--threshold', type=float, default=0.1, help="With --compare, fail if anything is this much slower")
+    parser.add_argument('--no-micro', action='store_true', help="Skip micro-benchmarks")
+    args = parser.parse_args()
+
+    tmp = None
+    if args.data_dir is None:
+        tmp = tempfile.TemporaryDirectory()
+        args.data_dir = tmp.name
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    results = []
+    for name, corpus, cmd in SCENARIOS:
+        if args.only and name not in args.only:
+            continue
+        fname = _corpus(args.data_dir, corpus, args.records)
+        runs = [run_command(cmd, fname, args.records) for _ in range(args.repeat)]
+        result = dict(min(runs, key=lambda run: run["seconds"]), name=name, corpus=corpus, records=args.records)
+        print("{:14} {:8} {:10.0f} records/s {:8.1f} MB/s {:8d} KB".format(
+            name, corpus, result["records_per_s"], result["mb_per_s"], result["peak_rss_kb"]), file=sys.stderr)
+        results.append(result)
+
+    if not args.no_micro:
+        for name, calls_per_s in micro_benchmarks(args.records):
+            if args.only and name not in args.only:
+                continue
+            print("{:40} {:10.0f} calls/s".format(name, calls_per_s), file=sys.stderr)
+            results.append({"name": name, "records_per_s": calls_per_s})
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "records": args.records,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+    if tmp is not None:
+        tmp.cleanup()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("Slower than {}: {}".format(args.compare, ", ".join(regressions)), file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
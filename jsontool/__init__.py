@@ -1,3 +1,12 @@
-from .expr import parse_expr
-from .schema import parse_schema, apply_schema
 from .util import *
+
+def __getattr__(name):
+    # The expression modules import jsonpath_ng, which commands that don't
+    # evaluate expressions shouldn't wait for.
+    if name == "parse_expr":
+        from .expr import parse_expr
+        return parse_expr
+    if name in ("parse_schema", "apply_schema"):
+        from . import schema
+        return getattr(schema, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,339 @@
+"""
+Streaming, mergeable aggregation across records
+"""
+
+import re
+import math
+import pickle
+import logging
+
+from .expr import parse_expr
+from .sketch import HyperLogLog, KLL
+from .stats import count
+from .util import default_codec
+
+logger = logging.getLogger(__name__)
+
+class Count():
+    def __init__(self):
+        self.n = 0
+
+    def add(self, value):
+        self.n += 1
+
+    def merge(self, other):
+        self.n += other.n
+
+    def result(self):
+        return self.n
+
+class Sum():
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value):
+        self.total += value
+
+    def merge(self, other):
+        self.total += other.total
+
+    def result(self):
+        return self.total
+
+class Moments():
+    """
+    Count, mean and variance with Welford's update and Chan et al.'s
+    merge, which stay accurate where sums of squares don't.
+    """
+    def __init__(self, statistic="mean"):
+        self.statistic = statistic
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self, value):
+        # Nothing changes if @value isn't a number.
+        n = self.n + 1
+        delta = value - self.mean
+        mean = self.mean + delta / n
+        self.m2 += delta * (value - mean)
+        self.n, self.mean = n, mean
+
+    def merge(self, other):
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+
+    def result(self):
+        if self.statistic == "mean":
+            return self.mean if self.n else None
+        # Sample variance, like pandas.
+        var = self.m2 / (self.n - 1) if self.n > 1 else None
+        if self.statistic == "std" and var is not None:
+            return math.sqrt(var)
+        return var
+
+class Extremum():
+    def __init__(self, fn=max):
+        self.fn = fn
+        self.value = None
+
+    def add(self, value):
+        self.value = value if self.value is None else self.fn(self.value, value)
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+class Quantile():
+    def __init__(self, q=0.5):
+        self.q = q
+        self.sketch = KLL()
+
+    def add(self, value):
+        # The sketch sorts its values, which only works for numbers.
+        if not isinstance(value, (int, float)):
+            raise TypeError("quantiles need numbers, not {}".format(type(value).__name__))
+        self.sketch.add(value)
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+
+    def result(self):
+        return self.sketch.quantile(self.q)
+
+class Distinct():
+    def __init__(self):
+        self.sketch = HyperLogLog()
+
+    def add(self, value):
+        self.sketch.add(value)
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+
+    def result(self):
+        return len(self.sketch)
+
+# Lookup table of aggregates: each entry builds a fresh accumulator.
+_AGGREGATES = {
+    "count": Count,
+    "sum": Sum,
+    "mean": lambda: Moments("mean"),
+    "var": lambda: Moments("var"),
+    "std": lambda: Moments("std"),
+    "min": lambda: Extremum(min),
+    "max": lambda: Extremum(max),
+    "median": lambda: Quantile(0.5),
+    "distinct": Distinct,
+}
+
+def _aggregate(name):
+    if name in _AGGREGATES:
+        return _AGGREGATES[name]
+    m = re.fullmatch(r"p(\d+(\.\d+)?)", name)
+    if m and float(m.group(1)) <= 100:
+        q = float(m.group(1)) / 100
+        return lambda: Quantile(q)
+    raise ValueError("Unknown aggregate {}; expected one of {} or pNN".format(name, ", ".join(_AGGREGATES)))
+
+def parse_aggregate(spec):
+    """
+    Parses "[name=]aggregate[:expr]", e.g. "count", "mean:$.score" or
+    "latency=p99:$.latency", into (name, accumulator factory, expression).
+    """
+    name, _, spec_ = spec.partition("=") if re.match(r"^\w+=[^=]", spec) else ("", "", spec)
+    agg, _, expr = spec_.partition(":")
+    return (name or spec_, _aggregate(agg.strip()), parse_expr(expr) if expr.strip() else None)
+
+def _hashable(value):
+    # Tagged by type, so that e.g. {"a": 1} and [["a", 1]], or true and 1,
+    # are different groups (1 and 1.0 are the same).
+    if isinstance(value, list):
+        return ("l", tuple(map(_hashable, value)))
+    if isinstance(value, dict):
+        return ("d", tuple(sorted((key, _hashable(value_)) for key, value_ in value.items())))
+    if isinstance(value, bool):
+        return ("b", value)
+    return value
+
+class Aggregator():
+    """
+    Aggregates records by group. `state` maps a group key to the group
+    values and one accumulator per aggregate; states from different
+    workers or files can be combined with `merge`. Lines that aren't
+    valid JSON, records whose groups raise, and values that raise or that
+    an aggregate can't take (e.g. strings to sum) are skipped and
+    counted; see `report`.
+    """
+    def __init__(self, groups, aggregates):
+        self.group_names = list(groups)
+        self.specs = list(aggregates)
+        self.groups = [parse_expr(group) for group in groups]
+        self.aggregates = [parse_aggregate(spec) for spec in aggregates]
+        self.loads = default_codec().loads
+        self._reset_errors()
+        self.reset()
+
+    def reset(self):
+        self.state = {}
+
+    def _reset_errors(self):
+        self.decode_errors = 0
+        self.group_errors = 0
+        self.group_error = None
+        self.errors = [0] * len(self.aggregates)
+        self.error = [None] * len(self.aggregates)
+
+    def _error(self, i, e):
+        self.errors[i] += 1
+        if self.error[i] is None:
+            self.error[i] = e
+
+    def add(self, obj):
+        try:
+            values = [group(obj) for group in self.groups]
+        except Exception as e:
+            self.group_errors += 1
+            if self.group_error is None:
+                self.group_error = e
+            return
+        key = _hashable(values)
+        if key not in self.state:
+            self.state[key] = (values, [factory() for _, factory, _ in self.aggregates])
+        _, accs = self.state[key]
+        for i, (acc, (_, _, expr)) in enumerate(zip(accs, self.aggregates)):
+            try:
+                value = expr(obj) if expr is not None else True
+            except Exception as e:
+                self._error(i, e)
+                continue
+            if value is not None:
+                try:
+                    acc.add(value)
+                except TypeError as e:
+                    self._error(i, e)
+
+    def add_line(self, line):
+        try:
+            obj = self.loads(line)
+        except ValueError:
+            self.decode_errors += 1
+            return
+        self.add(obj)
+
+    def merge(self, state):
+        for key, (values, accs) in state.items():
+            if key not in self.state:
+                self.state[key] = (values, accs)
+            else:
+                for i, (acc, acc_) in enumerate(zip(self.state[key][1], accs)):
+                    try:
+                        acc.merge(acc_)
+                    except TypeError as e:
+                        # e.g. the min of strings and of numbers.
+                        self._error(i, e)
+
+    def report(self):
+        """
+        Logs and resets the error counts.
+        """
+        count("decode_errors", self.decode_errors)
+        count("group_errors", self.group_errors)
+        count("aggregate_errors", sum(self.errors))
+        if self.decode_errors:
+            logger.warning("Skipped %d lines that are not valid JSON", self.decode_errors)
+        if self.group_errors:
+            logger.warning("Skipped %d records whose groups raised (e.g. %s: %s)", self.group_errors,
+                           type(self.group_error).__name__, self.group_error)
+        for (name, _, _), errors, error in zip(self.aggregates, self.errors, self.error):
+            if errors:
+                logger.warning("Skipped %d values of %s that raised or can't be aggregated (e.g. %s: %s)", errors,
+                               name, type(error).__name__, error)
+        self._reset_errors()
+
+    def save_state(self, fstream):
+        pickle.dump((self.group_names, self.specs, self.state), fstream)
+
+    def load_state(self, fstream):
+        """
+        Merges a state saved with `save_state` by an Aggregator with the
+        same groups and aggregates.
+        """
+        group_names, specs, state = pickle.load(fstream)
+        if (group_names, specs) != (self.group_names, self.specs):
+            raise ValueError("Saved state has groups {} and aggregates {}, expected {} and {}".format(
+                group_names, specs, self.group_names, self.specs))
+        self.merge(state)
+
+    def results(self):
+        for values, accs in self.state.values():
+            ret = dict(zip(self.group_names, values))
+            ret.update((name, acc.result()) for (name, _, _), acc in zip(self.aggregates, accs))
+            yield ret
+
+def test_aggregator():
+    import statistics
+
+    objs = [{"g": i % 3, "x": i, "u": i % 7} for i in range(1000)] + [{"g": 0}]
+
+    agg = Aggregator(["$.g"], ["count", "n=count:$.x", "sum:$.x", "mean:$.x", "std:$.x", "min:$.x",
+                               "max:$.x", "median:$.x", "p90:$.x", "distinct:$.u"])
+    aggs = [Aggregator(agg.group_names, agg.specs) for _ in range(2)]
+    for i, obj in enumerate(objs):
+        aggs[i % 2].add(obj)
+    for agg_ in aggs:
+        agg.merge(agg_.state)
+
+    results = {ret["$.g"]: ret for ret in agg.results()}
+    assert sorted(results) == [0, 1, 2]
+    xs = [obj["x"] for obj in objs if obj["g"] == 0 and "x" in obj]
+    ret = results[0]
+    assert ret["count"] == len(xs) + 1 and ret["n"] == len(xs)
+    assert ret["sum:$.x"] == sum(xs) and ret["min:$.x"] == 0 and ret["max:$.x"] == 999
+    assert abs(ret["mean:$.x"] - statistics.mean(xs)) < 1e-9
+    assert abs(ret["std:$.x"] - statistics.stdev(xs)) < 1e-9
+    assert abs(ret["median:$.x"] - statistics.median(xs)) <= 6
+    assert abs(ret["p90:$.x"] - 900) <= 3
+    assert ret["distinct:$.u"] == 7
+
+def test_aggregator_errors():
+    lines = [b'{"x": 1}\n', b'{"x": "a"}\n', b'not json\n', b'{"x": 3}\n', b'{"x": [2]}\n']
+    agg = Aggregator([], ["count", "sum:$.x", "mean:$.x", "min:$.x", "p50:$.x", "distinct:$.x"])
+    for line in lines:
+        agg.add_line(line)
+    ret, = agg.results()
+    assert ret == {"count": 4, "sum:$.x": 4, "mean:$.x": 2.0, "min:$.x": 1, "p50:$.x": 1, "distinct:$.x": 4}
+    assert agg.decode_errors == 1 and agg.errors == [0, 2, 2, 2, 2, 0]
+    agg.report()
+    assert agg.decode_errors == 0 and agg.errors == [0] * 6
+
+    # States whose values can't be compared are counted when merged.
+    other = Aggregator([], agg.specs)
+    other.add({"x": "b"})
+    agg.merge(other.state)
+    assert next(agg.results())["min:$.x"] == 1 and agg.errors[3] == 1
+
+def test_aggregator_groups():
+    objs = [{"g": {"a": 1}}, {"g": [["a", 1]]}, {"g": [["a", 1]]}, {"g": True}, {"g": 1}, {"g": 1.0}, {"g": "s"}]
+    agg = Aggregator(["$.g"], ["count"])
+    for obj in objs:
+        agg.add(obj)
+    assert sorted(([ret["$.g"], ret["count"]] for ret in agg.results()), key=repr) == sorted(
+        [[{"a": 1}, 1], [[["a", 1]], 2], [True, 1], [1, 2], ["s", 1]], key=repr)
+
+    # Groups and values that raise are skipped and counted.
+    agg = Aggregator(["$.g + 1"], ["count", "sum:$.x + 1"])
+    for obj in [{"g": 1, "x": 1}, {"g": 1, "x": "s"}, {"g": "s", "x": 2}]:
+        agg.add(obj)
+    assert list(agg.results()) == [{"$.g + 1": 2, "count": 2, "sum:$.x + 1": 2}]
+    assert agg.group_errors == 1 and agg.errors == [0, 1]
+    agg.report()
+    assert agg.group_errors == 0 and agg.errors == [0, 0]
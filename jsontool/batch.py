@@ -0,0 +1,313 @@
+"""
+Vectorized evaluation of expressions over blocks of records
+"""
+import operator
+from itertools import chain
+
+import numpy as np
+
+from .expr import compile_expr, _OPS
+
+# Integers beyond this can't be stored exactly as floats.
+_MAX_EXACT = 2 ** 53
+
+_UFUNCS = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide,
+    "<=": np.less_equal,
+    "<": np.less,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+class Column():
+    """
+    The values of an expression over a block of records.
+
+    `values` is a float64 array if every value is a number (or a bool)
+    and an object array otherwise; `missing` marks values that are None
+    and `error` marks records for which evaluation raised.
+    """
+    def __init__(self, values, missing, error):
+        self.values = values
+        self.missing = missing
+        self.error = error
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def numeric(self):
+        return self.values.dtype != object
+
+    def objects(self):
+        if not self.numeric:
+            return self.values
+        ret = np.empty(len(self), dtype=object)
+        ret[:] = self.values.tolist()
+        ret[self.missing] = None
+        return ret
+
+    def tolist(self):
+        return self.objects().tolist()
+
+def _is_number(v):
+    t = type(v)
+    return t is float or t is bool or (t is int and -_MAX_EXACT <= v <= _MAX_EXACT)
+
+_NUMBER_TYPES = {float, int, bool, type(None)}
+
+def _as_floats(values, types):
+    """
+    Converts @values, whose types are @types, to a float array if they are
+    all numbers (or None, which becomes NaN); returns None otherwise.
+    """
+    if not types <= _NUMBER_TYPES:
+        return None
+    ret = np.array(values, dtype=float)
+    if int in types and not (np.abs(ret[~np.isnan(ret)]) <= _MAX_EXACT).all():
+        return None
+    return ret
+
+def column(values, error=None):
+    """
+    Builds a Column from a list of Python values.
+    """
+    n = len(values)
+    if error is None:
+        error = np.zeros(n, dtype=bool)
+    # Checking types with C-level map/set is much faster than per-value tests.
+    types = set(map(type, values))
+    if type(None) in types:
+        missing = np.fromiter([v is None for v in values], dtype=bool, count=n)
+    else:
+        missing = np.zeros(n, dtype=bool)
+    floats = _as_floats(values, types)
+    if floats is not None:
+        floats[missing] = 0.
+        return Column(floats, missing, error)
+    return Column(np.fromiter(values, dtype=object, count=n), missing, error)
+
+def _constant(value, n):
+    if value is None or _is_number(value):
+        return Column(np.full(n, 0. if value is None else float(value)),
+                      np.full(n, value is None), np.zeros(n, dtype=bool))
+    values = np.empty(n, dtype=object)
+    values.fill(value)
+    return Column(values, np.zeros(n, dtype=bool), np.zeros(n, dtype=bool))
+
+def _elementwise(fn, cols):
+    """
+    Applies @fn to each row of @cols in Python, recording exceptions.
+    """
+    n = len(cols[0])
+    error = np.logical_or.reduce([col.error for col in cols])
+    args = [col.tolist() for col in cols]
+    ret = [None] * n
+    for i in range(n):
+        if error[i]:
+            continue
+        try:
+            ret[i] = fn(*[arg[i] for arg in args])
+        except Exception:
+            error[i] = True
+    return column(ret, error)
+
+def truthy(col):
+    """
+    Returns the Python truth value of every row of @col.
+    """
+    if col.numeric:
+        return (col.values != 0) & ~col.missing
+    return np.fromiter(map(bool, col.values), dtype=bool, count=len(col))
+
+def _where(cond, l, r):
+    if l.numeric and r.numeric:
+        values = np.where(cond, l.values, r.values)
+    else:
+        values = np.where(cond, l.objects(), r.objects())
+    return Column(values, np.where(cond, l.missing, r.missing), np.where(cond, l.error, r.error))
+
+def _binary(op, l, r):
+    if op == "&&" or op == "||":
+        cond = truthy(l)
+        ret = _where(cond, r, l) if op == "&&" else _where(cond, l, r)
+        # The right-hand side is only evaluated where the left doesn't decide.
+        ret.error |= l.error
+        return ret
+
+    if not (l.numeric and r.numeric):
+        if op in ("==", "!="):
+            # Comparisons of objects can still run in NumPy's loop.
+            try:
+                values = getattr(operator, "eq" if op == "==" else "ne")(l.objects(), r.objects())
+                values = np.asarray(values, dtype=bool)
+                return Column(values.astype(float), np.zeros(len(l), dtype=bool), l.error | r.error)
+            except Exception:
+                pass
+        return _elementwise(_OPS[op], [l, r])
+
+    error = l.error | r.error
+    both = l.missing & r.missing
+    either = l.missing | r.missing
+    if op in ("==", "!="):
+        values = ((l.values == r.values) & ~either) | both
+        if op == "!=":
+            values = ~values
+    else:
+        # None doesn't support arithmetic or ordering.
+        error = error | either
+        with np.errstate(all="ignore"):
+            values = _UFUNCS[op](l.values, r.values)
+        if op == "/":
+            error |= r.values == 0
+    return Column(values.astype(float), np.zeros(len(l), dtype=bool), error)
+
+def _reduce(name, arg):
+    """
+    Evaluates sum/mean/max/min of lists of numbers with NumPy; returns
+    None if @arg doesn't have that form.
+    """
+    n = len(arg)
+    if arg.numeric:
+        # A scalar aggregates like a list of one, and 0 like an empty list.
+        return Column(arg.values.copy(), arg.missing | (arg.values == 0), arg.error.copy())
+
+    values = arg.values
+    if not set(map(type, values)) <= {list, type(None)}:
+        return None
+    values = [v or [] for v in values]
+    flat = list(chain.from_iterable(values))
+    types = set(map(type, flat))
+    # Python raises on None inside a list, which the row-by-row path records.
+    flat = None if type(None) in types else _as_floats(flat, types)
+    if flat is None:
+        return None
+    lengths = np.fromiter(map(len, values), dtype=np.int64, count=n)
+    empty = lengths == 0
+    rows = np.repeat(np.arange(n), lengths)
+
+    if name in ("sum", "mean"):
+        ret = np.bincount(rows, weights=flat, minlength=n)
+        if name == "mean":
+            with np.errstate(all="ignore"):
+                ret = ret / lengths
+    else:
+        ret = np.zeros(n)
+        ufunc = np.maximum if name == "max" else np.minimum
+        if len(flat):
+            starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            ret[~empty] = ufunc.reduceat(flat, starts[~empty])
+    return Column(ret, empty, arg.error.copy())
+
+_VECTORIZED_REDUCE = {"sum", "mean", "max", "min"}
+
+def _eval(node, objs, memo, compiled):
+    if node.kind == "const":
+        return _constant(node.value, len(objs))
+    if node.kind == "path":
+        key = str(node.value)
+        if key not in memo:
+            getter = node.value.getter
+            try:
+                memo[key] = column([getter(obj) for obj in objs])
+            except Exception:
+                memo[key] = _elementwise(getter, [column(objs)])
+        return memo[key]
+    if node.kind == "op":
+        l, r = node.children
+        return _binary(node.value, _eval(l, objs, memo, compiled), _eval(r, objs, memo, compiled))
+    if node.kind == "cond":
+        cond, l, r = [_eval(child, objs, memo, compiled) for child in node.children]
+        ret = _where(truthy(cond), l, r)
+        ret.error |= cond.error
+        return ret
+    if node.kind == "reduce" and node.value in _VECTORIZED_REDUCE and len(node.children) == 1:
+        ret = _reduce(node.value, _eval(node.children[0], objs, memo, compiled))
+        if ret is not None:
+            return ret
+    # Everything else (maps, applies, other functions) runs row by row,
+    # compiled the first time it is needed.
+    fn = compiled.get(node)
+    if fn is None:
+        fn = compiled[node] = compile_expr(node)
+    return _elementwise(fn, [column(objs)])
+
+def compile_batch(expr):
+    """
+    Returns a function that evaluates @expr (from `parse_expr`) over a
+    list of records and returns a Column.
+    """
+    node = expr.node
+    # Row-by-row functions of the nodes that aren't vectorized, by node.
+    compiled = {}
+    return lambda objs: _eval(node, objs, {}, compiled)
+
+def batch_filter(exprs, objs, all_=False, errors=None):
+    """
+    Returns a mask of the records in @objs that match @exprs (functions
+    from `compile_batch`), with the semantics of `plan.FilterPlan`: an
+    expression that raises on a record doesn't match it. Adds the number
+    of records each expression raised on to @errors, counting only those
+    records that weren't already decided.
+    """
+    n = len(objs)
+    pending = np.ones(n, dtype=bool)
+    for i, expr in enumerate(exprs):
+        col = expr(objs)
+        if errors is not None:
+            errors[i] += int((col.error & pending).sum())
+        value = truthy(col) & ~col.error
+        pending &= value if all_ else ~value
+    return pending if all_ else ~pending
+
+def test_compile_batch(monkeypatch):
+    from .expr import parse_expr
+
+    objs = [
+        {"a": 1, "b": 2.5, "c": [1, 2, 3], "s": "x", "t": True},
+        {"a": 0, "b": None, "c": [], "s": "y", "t": False},
+        {"a": -3, "c": [4], "s": None},
+        {"a": 2**60, "b": "2", "c": "abc", "t": None},
+        {"a": 5, "b": 0, "c": None, "s": "x", "n": [1, None]},
+        ]
+
+    exprs = ["$.a", "$.a + 1", "$.a / $.b", "$.a > 0", "$.b == None", "$.b == $.d",
+             "$.s == \"x\"", "$.s != \"x\"", "$.a > 0 && $.b", "$.a || $.b", "$.t ? $.a : $.b",
+             "$.t => $.s", "sum($.c)", "mean($.c)", "max($.c)", "min($.c) < 2", "len($.c)",
+             "sum($.a)", "mean(tern{$.c})", "sum($.n)", "$.a + $.s", "$.a < $.s"]
+    for expr in exprs:
+        row = parse_expr(expr.replace("None", "$.missing"))
+        col = compile_batch(row)(objs)
+        for i, obj in enumerate(objs):
+            try:
+                expected = row(obj)
+            except Exception:
+                assert col.error[i], (expr, i)
+                continue
+            assert not col.error[i], (expr, i)
+            assert col.tolist()[i] == expected, (expr, i, col.tolist()[i], expected)
+
+    for all_ in [True, False]:
+        exprs_ = [parse_expr(e) for e in ["$.a > 0", "$.a + $.s", "$.s == \"x\""]]
+        expected = []
+        for obj in objs:
+            values = []
+            for expr in exprs_:
+                try:
+                    values.append(bool(expr(obj)))
+                except Exception:
+                    values.append(False)
+            expected.append((all if all_ else any)(values))
+        errors = [0] * len(exprs_)
+        assert batch_filter([compile_batch(e) for e in exprs_], objs, all_, errors).tolist() == expected
+        assert errors == ([0, 3, 0] if all_ else [0, 2, 0])
+
+    # Nodes that run row by row are compiled once, not per block.
+    calls, compile_ = [], compile_expr
+    monkeypatch.setattr(__name__ + ".compile_expr", lambda node: calls.append(node) or compile_(node))
+    batch = compile_batch(parse_expr("len($.c) > 1"))
+    assert batch(objs).tolist() == batch(objs[:2]).tolist() + batch(objs[2:]).tolist()
+    assert len(calls) == 1
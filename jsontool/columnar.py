@@ -0,0 +1,198 @@
+"""
+Columnar (Parquet and Arrow IPC) input and output
+"""
+
+FORMATS = ["parquet", "arrow"]
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Arrow files need pyarrow; install it with `pip install jsontool[arrow]`")
+    return pyarrow
+
+def arrow_type(spec):
+    """
+    Converts a type spec shaped like a schema for `parse_schema` into an
+    Arrow type: a dict is a struct, a list of one spec is a list and a
+    string is a type name like "int64" or "string".
+    """
+    pa = _pyarrow()
+    if isinstance(spec, dict):
+        return pa.struct([(key, arrow_type(value)) for key, value in spec.items()])
+    elif isinstance(spec, list):
+        if len(spec) != 1:
+            raise ValueError("List types have exactly one element type, not {}".format(spec))
+        return pa.list_(arrow_type(spec[0]))
+    else:
+        return pa.type_for_alias(spec)
+
+def arrow_schema(spec):
+    """
+    Converts a dict of type specs (see `arrow_type`) into an Arrow schema.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("Arrow schemas map field names to types, not {}".format(spec))
+    return _pyarrow().schema([(key, arrow_type(value)) for key, value in spec.items()])
+
+class ArrowWriter():
+    """
+    Writes objects to a Parquet or Arrow IPC file, @row_group_size at a
+    time so that memory use doesn't grow with the input. Nested dicts and
+    lists become structs and lists. Without a @schema, it is inferred from
+    the first row group. Objects that aren't dicts are written as a
+    "value" column. Call `close` to finish the file.
+    """
+    def __init__(self, stream, format="parquet", schema=None, row_group_size=65536):
+        if format not in FORMATS:
+            raise ValueError("Unknown columnar format {}; expected one of {}".format(format, ", ".join(FORMATS)))
+        self.pa = _pyarrow()
+        self.stream = stream
+        self.format = format
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.writer = None
+
+    def write(self, obj):
+        self.rows.append(obj if isinstance(obj, dict) else {"value": obj})
+        if len(self.rows) >= self.row_group_size:
+            self._write_rows()
+
+    def _open(self, schema):
+        if self.format == "parquet":
+            return self.pa.parquet.ParquetWriter(self.stream, schema)
+        return self.pa.ipc.new_file(self.stream, schema)
+
+    def _write_rows(self):
+        try:
+            table = self.pa.Table.from_pylist(self.rows, schema=self.schema)
+        except (self.pa.ArrowInvalid, self.pa.ArrowTypeError) as e:
+            raise ValueError("Records don't match the Arrow schema {}; pass a schema for these fields ({})".format(
+                self.schema, e))
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = self._open(self.schema)
+        if self.format == "parquet":
+            self.writer.write_table(table, row_group_size=len(self.rows))
+        else:
+            self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        # An empty input still gets a (possibly empty) schema and file.
+        if self.rows or self.writer is None:
+            self._write_rows()
+        self.writer.close()
+        if not self.stream.closed:
+            self.stream.flush()
+
+def _json_value(value):
+    # Arrow values that JSON has no type for.
+    import base64
+    import datetime
+    import decimal
+    if isinstance(value, dict):
+        return {key: _json_value(value_) for key, value_ in value.items()}
+    elif isinstance(value, list):
+        return [_json_value(value_) for value_ in value]
+    elif isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    elif isinstance(value, decimal.Decimal):
+        return float(value)
+    elif isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    return value
+
+def _is_json_type(pa, type_):
+    if pa.types.is_struct(type_):
+        return all(_is_json_type(pa, type_.field(i).type) for i in range(type_.num_fields))
+    if pa.types.is_list(type_) or pa.types.is_large_list(type_):
+        return _is_json_type(pa, type_.value_type)
+    return (pa.types.is_null(type_) or pa.types.is_boolean(type_) or pa.types.is_integer(type_) or
+            pa.types.is_floating(type_) or pa.types.is_string(type_) or pa.types.is_large_string(type_))
+
+def read_columnar(stream, format="parquet", batch_size=65536):
+    """
+    Yields the rows of a Parquet or Arrow IPC (file or stream) @stream as
+    dicts, reading @batch_size rows at a time. Dates and times become ISO
+    strings, durations seconds, decimals floats and binary base64 strings.
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown columnar format {}; expected one of {}".format(format, ", ".join(FORMATS)))
+    pa = _pyarrow()
+    seekable = stream.seekable()
+    if format == "parquet":
+        if not seekable:
+            # Parquet's metadata is at the end of the file.
+            import io
+            stream = io.BytesIO(stream.read())
+        parquet = pa.parquet.ParquetFile(stream)
+        schema, batches = parquet.schema_arrow, parquet.iter_batches(batch_size=batch_size)
+    elif seekable:
+        reader = pa.ipc.open_file(stream)
+        schema, batches = reader.schema, (reader.get_batch(i) for i in range(reader.num_record_batches))
+    else:
+        reader = pa.ipc.open_stream(stream)
+        schema, batches = reader.schema, reader
+    is_json = all(_is_json_type(pa, field.type) for field in schema)
+    for batch in batches:
+        rows = batch.to_pylist()
+        yield from rows if is_json else map(_json_value, rows)
+
+def test_arrow_writer():
+    import io
+    import pytest
+    pa = pytest.importorskip("pyarrow")
+
+    objs = [{"a": i, "b": {"c": str(i), "d": [i, i + 1]}} for i in range(10)]
+    for format in FORMATS:
+        output = io.BytesIO()
+        writer = ArrowWriter(output, format, row_group_size=4)
+        for obj in objs:
+            writer.write(obj)
+        writer.close()
+        output.seek(0)
+        if format == "parquet":
+            table = pa.parquet.read_table(output)
+            assert pa.parquet.ParquetFile(io.BytesIO(output.getvalue())).num_row_groups == 3
+        else:
+            table = pa.ipc.open_file(output).read_all()
+        assert table.to_pylist() == objs
+        assert table.schema.field("b").type == pa.struct([("c", pa.string()), ("d", pa.list_(pa.int64()))])
+
+    schema = arrow_schema({"a": "float64", "b": {"d": ["int32"]}})
+    output = io.BytesIO()
+    writer = ArrowWriter(output, "parquet", schema)
+    for obj in objs:
+        writer.write({"a": obj["a"], "b": {"d": obj["b"]["d"]}})
+    writer.close()
+    output.seek(0)
+    assert pa.parquet.read_table(output).schema == schema
+
+def test_read_columnar():
+    import io
+    import datetime
+    import pytest
+    pa = pytest.importorskip("pyarrow")
+
+    objs = [{"a": i, "b": {"c": str(i), "d": [i, i + 1]}} for i in range(10)]
+    for format in FORMATS:
+        output = io.BytesIO()
+        writer = ArrowWriter(output, format, row_group_size=4)
+        for obj in objs:
+            writer.write(obj)
+        writer.close()
+        assert list(read_columnar(io.BytesIO(output.getvalue()), format, batch_size=3)) == objs
+
+    output = io.BytesIO()
+    table = pa.table({"t": [datetime.date(2020, 1, 2)], "x": [b"ab"]})
+    with pa.ipc.new_stream(output, table.schema) as writer:
+        writer.write_table(table)
+    output.seek(0)
+    output.seekable = lambda: False
+    assert list(read_columnar(output, "arrow")) == [{"t": "2020-01-02", "x": "YWI="}]
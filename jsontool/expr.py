@@ -2,16 +2,22 @@
 Simple JSON expressions
 """
 import re
-import pdb
 import os
+import sys
+import logging
+from functools import lru_cache
 
-import numpy as np
-
-from lark import Lark, UnexpectedInput
-from lark import Transformer as _Transformer
 from jsonpath_ng import parse as parse_jsonpath
+from jsonpath_ng import jsonpath as _jp
+try:
+    from re import _parser as _sre_parse
+except ImportError:
+    import sre_parse as _sre_parse
+
+logger = logging.getLogger(__name__)
 
 def _dbg(x):
+    import pdb
     pdb.set_trace()
     return x
 
@@ -19,31 +25,74 @@ def _print(x):
     print(x)
     return x
 
+def _mean(vs):
+    return sum(vs) / len(vs)
+
+def _median(vs):
+    vs = sorted(vs)
+    mid = len(vs) // 2
+    return vs[mid] if len(vs) % 2 else (vs[mid - 1] + vs[mid]) / 2
+
+def _aggregate(fn):
+    # Aggregates of a handful of values per record are much cheaper in
+    # plain Python than through NumPy; like NumPy, a scalar is treated as
+    # a list of one.
+    return lambda vs: (fn(vs) if isinstance(vs, list) else fn([vs])) if vs else None
+
+def _regex(pattern, flags=0):
+    # Constant patterns are compiled at parse time (see `Transformer`).
+    return pattern if isinstance(pattern, re.Pattern) else re.compile(pattern, flags)
+
 # Lookup table of possible functions.
 _FUNCTIONS = {
-    "mean": lambda vs: np.mean(vs) if vs else None,
-    "sum": lambda vs: np.sum(vs) if vs else None,
-    "max": lambda vs: np.max(vs) if vs else None,
-    "min": lambda vs: np.min(vs) if vs else None,
-    "median": lambda vs: np.median(vs) if vs else None,
+    "mean": _aggregate(_mean),
+    "sum": _aggregate(sum),
+    "max": _aggregate(max),
+    "min": _aggregate(min),
+    "median": _aggregate(_median),
     "len": len,
     "not": lambda v: not v,
     "tern": lambda v: 1 if (v or 0) > 0 else (0 if (v or 0) < 0 else None),
     "scale": lambda vs, r: [v / r for v in vs],
-    "agreement": lambda xs, ys: np.mean([1 if x == y else 0 for x, y in zip(xs,ys)]),
+    "agreement": lambda xs, ys: _mean([1 if x == y else 0 for x, y in zip(xs,ys)]) if xs and ys else float("nan"),
     "cnst": lambda v, l: [v for _ in range(l)],
-    "match": lambda v, v_: re.match(v, v_) != None,
-    "find": lambda v, v_: len(re.findall(v, v_)) > 0,
-    "imatch": lambda v, v_: re.match(v, v_, flags=re.IGNORECASE) != None,
-    "ifind": lambda v, v_: len(re.findall(v, v_, flags=re.IGNORECASE)) > 0,
+    "match": lambda v, v_: _regex(v).match(v_) is not None,
+    "find": lambda v, v_: _regex(v).search(v_) is not None,
+    "imatch": lambda v, v_: _regex(v, re.IGNORECASE).match(v_) is not None,
+    "ifind": lambda v, v_: _regex(v, re.IGNORECASE).search(v_) is not None,
     "all": all,
     "any": any,
     "apply": (lambda x, y: x(y)),
     "zip": lambda *vs: list(zip(*vs)),
 }
 
-def _fn(v):
-    return lambda _: v
+# Flags of the functions whose first argument is a regular expression.
+_REGEX_FUNCTIONS = {"match": 0, "find": 0, "imatch": re.IGNORECASE, "ifind": re.IGNORECASE}
+
+# Characters that JSON encoders write as is, so that text made of them
+# appears verbatim in the encoded record.
+_UNESCAPED = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 -_.,:;!?@#$%*+=()[]{}|~^`")
+
+def _regex_literal(pattern):
+    """
+    Returns the longest run of literal characters that every match of
+    the compiled @pattern contains, or None.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = _sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    ret, run = "", ""
+    for op, value in parsed:
+        if op == _sre_parse.LITERAL and chr(value) in _UNESCAPED:
+            run += chr(value)
+            ret = max(ret, run, key=len)
+        else:
+            run = ""
+    return ret or None
+
 def _condense(items):
     if items:
         return items[0] if len(items) == 1 else items
@@ -53,9 +102,186 @@ def _skip_nones(vs):
     ret = [v for v in vs if v is not None]
     return ret if ret else None
 
+def _map(fn, *vs):
+    # Each of these is either a list or a singleton
+    cnts = [len(v) if isinstance(v, list) else 1 for v in vs]
+    max_cnt = max(cnts)
+    assert all(c == 1 or c == max_cnt for c in cnts), "Map arguments have unequal argument sizes: {}".format(vs)
+
+    vs = [[v] * max_cnt if c == 1 else v for v, c in zip(vs, cnts)]
+    return _skip_nones([fn(*vs_) for vs_ in zip(*vs)])
+
+def _fields_step(fields):
+    if "*" in fields:
+        def _step(values):
+            return [v for value in values if isinstance(value, dict) for v in value.values()]
+    elif len(fields) == 1:
+        field, = fields
+        def _step(values):
+            return [value[field] for value in values if isinstance(value, dict) and field in value]
+    else:
+        def _step(values):
+            return [value[field] for value in values if isinstance(value, dict)
+                    for field in fields if field in value]
+    return _step
+
+def _index_step(indices):
+    def _step(values):
+        ret = []
+        for value in values:
+            if isinstance(value, (list, str)) and value:
+                ret.extend(value[i] for i in indices if -len(value) <= i < len(value))
+        return ret
+    return _step
+
+def _slice_step(values):
+    ret = []
+    for value in values:
+        if isinstance(value, list):
+            ret.extend(value)
+        elif value is not None:
+            ret.append(value)
+    return ret
+
+def _descendants_step(right):
+    def _recurse(value, ret):
+        ret.extend(right([value]))
+        if isinstance(value, list):
+            for v in value:
+                _recurse(v, ret)
+        elif isinstance(value, dict):
+            for v in value.values():
+                _recurse(v, ret)
+    def _step(values):
+        ret = []
+        for value in values:
+            _recurse(value, ret)
+        return ret
+    return _step
+
+def _compile_steps(path, root=True):
+    """
+    Translates the common subset of JSONPath (child fields, integer
+    indexes, `*`, `[*]` and `..`) into a function from a list of matched
+    values to the next list of matched values; returns None for anything
+    else.
+    """
+    if isinstance(path, _jp.Root):
+        return (lambda values: values) if root else None
+    if isinstance(path, _jp.This):
+        return lambda values: values
+    if isinstance(path, _jp.Fields):
+        return _fields_step(path.fields)
+    if isinstance(path, _jp.Index):
+        return _index_step(path.indices)
+    if isinstance(path, _jp.Slice):
+        if path.start is None and path.end is None and path.step is None:
+            return _slice_step
+        return None
+    if isinstance(path, _jp.Child):
+        left, right = _compile_steps(path.left, root), _compile_steps(path.right, False)
+        if left is None or right is None:
+            return None
+        return lambda values: right(left(values))
+    if isinstance(path, _jp.Descendants):
+        left, right = _compile_steps(path.left, root), _compile_steps(path.right, False)
+        if left is None or right is None:
+            return None
+        step = _descendants_step(right)
+        return lambda values: step(left(values))
+    return None
+
+def _singular_keys(path):
+    """
+    Returns the keys of a path of the form `$.a[0].b`, which has at most
+    one match, or None.
+    """
+    if isinstance(path, _jp.Root):
+        return []
+    if isinstance(path, _jp.Child):
+        keys = _singular_keys(path.left)
+        if keys is None:
+            return None
+        if isinstance(path.right, _jp.Fields) and len(path.right.fields) == 1 and path.right.fields[0] != "*":
+            return keys + [path.right.fields[0]]
+        if isinstance(path.right, _jp.Index) and len(path.right.indices) == 1:
+            return keys + [path.right.indices[0]]
+    return None
+
+def _keys_getter(keys):
+    """
+    Returns a function that looks up @keys in turn in an object, or
+    returns None if one is missing.
+    """
+    # Field lookups on lists and index lookups on dicts raise
+    # TypeError/KeyError, which is exactly when the path has no match.
+    source = "def _get(obj):\n    try:\n        return obj{}\n    except (KeyError, IndexError, TypeError):\n        return None\n".format(
+        "".join("[{!r}]".format(key) for key in keys))
+    namespace = {}
+    exec(source, namespace)
+    return namespace["_get"]
+
+def compile_jsonpath(path):
+    """
+    Returns a function that evaluates @path against an object using plain
+    dict/list access, or None if @path is outside the supported subset.
+    """
+    keys = _singular_keys(path)
+    if keys is not None:
+        return _keys_getter(keys)
+
+    steps = _compile_steps(path)
+    if steps is not None:
+        return lambda obj: _condense(steps([obj]))
+    return None
+
+def _projection_keys(path):
+    """
+    Returns the field names that @path starts with, or None if it doesn't
+    start at the root.
+    """
+    if isinstance(path, _jp.Root):
+        return []
+    if isinstance(path, _jp.Child):
+        keys = _projection_keys(path.left)
+        if keys is None or len(keys) < _depth(path.left):
+            return keys
+        if isinstance(path.right, _jp.Fields) and len(path.right.fields) == 1 and path.right.fields[0] != "*":
+            return keys + [path.right.fields[0]]
+        return keys
+    if isinstance(path, _jp.Descendants):
+        return _projection_keys(path.left)
+    return None
+
+def _depth(path):
+    if isinstance(path, _jp.Child):
+        return _depth(path.left) + 1
+    return 0
+
+def projection(paths):
+    """
+    Returns the parts of a record that @paths can reach as a nested dict
+    of field names, where None stands for "everything below here". A
+    return value of None means the whole record is needed.
+    """
+    ret = {}
+    for path in paths:
+        keys = _projection_keys(path.path)
+        if not keys:
+            return None
+        node = ret
+        for key in keys[:-1]:
+            if key in node and node[key] is None:
+                break
+            node = node.setdefault(key, {})
+        else:
+            node[keys[-1]] = None
+    return ret
+
 class JsonPath():
     def __init__(self, path):
         self.path = path
+        self.getter = compile_jsonpath(path) or self._find
 
     def __repr__(self):
         return f"<jsonpath: {self.path}>"
@@ -63,112 +289,431 @@ class JsonPath():
     def __str__(self):
         return f"{self.path}"
 
-    def __call__(self, obj):
+    def __getstate__(self):
+        # The getter is compiled code; it is rebuilt when unpickled.
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def _find(self, obj):
         return _condense([match.value for match in self.path.find(obj)])
 
-class Transformer(_Transformer):
+    def __call__(self, obj):
+        return self.getter(obj)
+
+class Node():
+    """
+    A node in the expression tree produced by `Transformer`.
+
+    `kind` is one of "const", "path", "op", "cond", "map", "reduce" or
+    "apply"; `value` holds the constant, the `JsonPath`, the operator or
+    the function name.
+    """
+    def __init__(self, kind, value=None, children=()):
+        self.kind = kind
+        self.value = value
+        self.children = list(children)
+
+    def __repr__(self):
+        if self.kind in ("const", "path"):
+            return f"<{self.kind}: {self.value!r}>"
+        return f"<{self.kind} {self.value}: {self.children}>"
+
+    def __str__(self):
+        """
+        Formats the node like an expression, for messages; parentheses
+        show the grouping.
+        """
+        if self.kind == "const":
+            value = self.value.pattern if isinstance(self.value, re.Pattern) else self.value
+            return '"{}"'.format(value) if isinstance(value, str) else str(value)
+        if self.kind == "path":
+            return str(self.value)
+        args = [str(child) for child in self.children]
+        if self.kind == "op":
+            return "({} {} {})".format(args[0], self.value, args[1])
+        if self.kind == "cond":
+            return "({} ? {} : {})".format(*args)
+        if self.kind == "apply":
+            return "({} |> {})".format(*args)
+        return "{}{}{}{}".format(self.value, "{" if self.kind == "map" else "(", ", ".join(args),
+                                 "}" if self.kind == "map" else ")")
+
+    def key(self):
+        """
+        Returns a hashable key that is equal for identical subtrees.
+        """
+        if self.kind == "const":
+            if isinstance(self.value, re.Pattern):
+                return ("const", "pattern", self.value.pattern, self.value.flags)
+            return ("const", type(self.value).__name__, repr(self.value))
+        if self.kind == "path":
+            return ("path", str(self.value))
+        return (self.kind, self.value, tuple(child.key() for child in self.children))
+
+    @property
+    def is_const(self):
+        return self.kind == "const"
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def scope(self):
+        """
+        Yields the nodes evaluated against the same object as this one,
+        i.e. excluding the right-hand side of an apply.
+        """
+        yield self
+        children = self.children[:1] if self.kind == "apply" else self.children
+        for child in children:
+            yield from child.scope()
+
+    def paths(self):
+        """
+        Returns the JSONPaths evaluated against the record.
+        """
+        ret = {}
+        for node in self.scope():
+            if node.kind == "path":
+                ret.setdefault(str(node.value), node.value)
+        return list(ret.values())
+
+_OPS = {
+    "+": lambda l, r: l + r,
+    "-": lambda l, r: l - r,
+    "*": lambda l, r: l * r,
+    "/": lambda l, r: l / r,
+    "==": lambda l, r: l == r,
+    "!=": lambda l, r: l != r,
+    "<=": lambda l, r: l <= r,
+    "<": lambda l, r: l < r,
+    ">": lambda l, r: l > r,
+    ">=": lambda l, r: l >= r,
+    "&&": lambda l, r: l and r,
+    "||": lambda l, r: l or r,
+}
+# Functions that depend on more than their arguments can't be folded.
+_UNFOLDABLE = {"apply"}
+
+def _fold(kind, value, children, fn):
+    """
+    Evaluates @fn at parse time if all @children are constants; if that
+    raises, the error is left for evaluation time.
+    """
+    if all(child.is_const for child in children):
+        try:
+            return Node("const", fn(*[child.value for child in children]))
+        except Exception:
+            pass
+    return Node(kind, value, children)
+
+def _compile_pattern(fn, args):
+    """
+    Compiles the pattern of a regex function once if it is a constant.
+    """
+    if fn in _REGEX_FUNCTIONS and args and args[0].is_const and isinstance(args[0].value, str):
+        try:
+            args = [Node("const", re.compile(args[0].value, _REGEX_FUNCTIONS[fn]))] + args[1:]
+        except re.error as e:
+            raise ValueError("Invalid regular expression {!r}: {}".format(args[0].value, e))
+    return args
+
+class Transformer():
+    """
+    Turns a parse tree into a `Node` tree, folding constants on the way.
+    """
+    def transform(self, tree):
+        # Like lark.Transformer, calls the method named after each rule
+        # with its transformed children; tokens are left as they are.
+        if not hasattr(tree, "data"):
+            return tree
+        return getattr(self, tree.data)([self.transform(child) for child in tree.children])
+
     def jsonpath(self, items):
         path = parse_jsonpath(items[0])
-        #return lambda obj: _condense([match.value for match in path.find(obj)])
-        return JsonPath(path)
+        return Node("path", JsonPath(path))
 
-    boolean = lambda self, items: _fn(items[0] == "True")
-    number = lambda self, items: _fn(float(items[0]))
-    string = lambda self, items: _fn(items[0][1:-1]) # Remove surrounding quotes
-    literal = lambda self, items: _FUNCTIONS[items[0]]
+    boolean = lambda self, items: Node("const", items[0] == "True")
+    number = lambda self, items: Node("const", float(items[0]))
+    string = lambda self, items: Node("const", items[0][1:-1]) # Remove surrounding quotes
+    literal = lambda self, items: str(items[0])
 
-    comparison_op = lambda self, items: items[0]
-    boolean_op = lambda self, items: items[0]
-    arith_op = lambda self, items: items[0]
-    eq_op = lambda self, items: items[0]
-    literal = lambda self, items: items[0]
+    comparison_op = lambda self, items: str(items[0])
+    boolean_op = lambda self, items: str(items[0])
+    arith_op = lambda self, items: str(items[0])
+    eq_op = lambda self, items: str(items[0])
 
     def map_expr(self, items):
         fn, *args = items
-        fn = _FUNCTIONS[fn]
-
-        def _ret(obj):
-            vs = [arg(obj) for arg in args]
-            # Each of these is either a list or a singleton
-            cnts = [len(v) if isinstance(v, list) else 1 for v in vs]
-            max_cnt = max(cnts)
-            assert all(c == 1 or c == max_cnt for c in cnts), "Map arguments have unequal argument sizes: {}".format(vs)
-
-            vs = [[v] * max_cnt if c == 1 else v for v, c in zip(vs, cnts)]
-            ret = [fn(*vs_) for vs_ in zip(*vs)]
-            ret = _skip_nones(ret)
-
-            return ret
-        return _ret
+        args = [arg for arg in args if arg is not None]
+        args = _compile_pattern(fn, args)
+        f = _FUNCTIONS[fn]
+        if fn in _UNFOLDABLE:
+            return Node("map", fn, args)
+        return _fold("map", fn, args, lambda *vs: _map(f, *vs))
 
     def reduce_expr(self, items):
         fn, *args = items
-        fn = _FUNCTIONS[fn]
-        return lambda obj: fn(*[arg(obj) for arg in args])
-
-    def arith_expr(self, items):
-        assert len(items) == 3
-        l, op, r = items
-        if op == "+":
-            return lambda obj: l(obj) + r(obj)
-        if op == "-":
-            return lambda obj: l(obj) - r(obj)
-        if op == "*":
-            return lambda obj: l(obj) * r(obj)
-        if op == "/":
-            return lambda obj: l(obj) / r(obj)
-
-    def boolean_atom(self, items):
-        assert len(items) == 3
-        l, op, r = items
-
-        if op == "==":
-            return lambda obj: l(obj) == r(obj)
-        if op == "!=":
-            return lambda obj: l(obj) != r(obj)
-        if op == "<=":
-            return lambda obj: l(obj) <= r(obj)
-        if op == "<":
-            return lambda obj: l(obj) < r(obj)
-        if op == ">":
-            return lambda obj: l(obj) > r(obj)
-        if op == ">=":
-            return lambda obj: l(obj) >= r(obj)
-
-    def boolean_expr(self, items):
+        args = [arg for arg in args if arg is not None]
+        args = _compile_pattern(fn, args)
+        f = _FUNCTIONS[fn]
+        if fn in _UNFOLDABLE:
+            return Node("reduce", fn, args)
+        return _fold("reduce", fn, args, f)
+
+    def _binary(self, items):
         assert len(items) == 3
         l, op, r = items
-        if op == "&&":
-            return lambda obj: l(obj) and r(obj)
-        if op == "||":
-            return lambda obj: l(obj) or r(obj)
+        # Short-circuiting operators only need their left side to be known.
+        if op in ("&&", "||") and l.is_const:
+            if op == "&&":
+                return r if l.value else l
+            else:
+                return l if l.value else r
+        return _fold("op", op, [l, r], _OPS[op])
+
+    arith_expr = _binary
+    boolean_atom = _binary
+    boolean_expr = _binary
 
     def conditional_expr(self, items):
         assert len(items) == 2 or len(items) == 3
         if len(items) == 2:
-            cond, l = items
-            return lambda obj: l(obj) if cond(obj) else None
-        if len(items) == 3:
-            cond, l, r = items
-            return lambda obj: l(obj) if cond(obj) else r(obj)
+            items = items + [Node("const", None)]
+        cond, l, r = items
+        if cond.is_const:
+            return l if cond.value else r
+        return Node("cond", None, [cond, l, r])
 
     def apply_expr(self, items):
         assert len(items) == 2
         arg, fn = items
-        return lambda obj: fn(arg(obj))
+        if fn.is_const:
+            return fn
+        return Node("apply", None, [arg, fn])
+
+def _is_literal(value):
+    if value is None or isinstance(value, (bool, int, str)):
+        return True
+    return isinstance(value, float) and value == value and abs(value) != float("inf")
+
+def required_literals(node):
+    """
+    Returns strings that the encoded record must contain for @node to
+    be true, found from the constant patterns of `match`/`find` applied
+    to paths (computed subjects need not occur in the record) and
+    combined through `&&` and `||`.
+    """
+    if node.kind == "reduce" and node.value in _REGEX_FUNCTIONS and node.children[0].is_const and \
+            len(node.children) == 2 and node.children[1].kind == "path":
+        literal = _regex_literal(node.children[0].value)
+        return {literal} if literal else set()
+    if node.kind == "op" and node.value == "&&":
+        return required_literals(node.children[0]) | required_literals(node.children[1])
+    if node.kind == "op" and node.value == "||":
+        return required_literals(node.children[0]) & required_literals(node.children[1])
+    return set()
+
+class _Compiler():
+    """
+    Generates the source of a single Python function for an expression
+    tree.  JSONPath lookups that occur more than once are hoisted into
+    locals so that each is evaluated once per call.
+    """
+    def __init__(self):
+        self.namespace = {"_map": _map}
+        self.lines = []
+        self._names = {}
+        self._hoisted = {}
+        # Locals holding subexpressions computed ahead, by `Node.key`.
+        self._memo = {}
+        self._applies = 0
+
+    def bind(self, prefix, value, key=None):
+        key = (prefix, key if key is not None else id(value))
+        if key not in self._names:
+            name = "_{}{}".format(prefix, len(self._names))
+            self._names[key] = name
+            self.namespace[name] = value
+        return self._names[key]
+
+    def function(self, node, name="_expr"):
+        paths = {}
+        for node_ in node.scope():
+            if node_.kind == "path":
+                key = str(node_.value)
+                paths[key] = paths.get(key, 0) + 1
+        hoisted = {key: "_v{}".format(i) for i, key in enumerate(k for k, c in paths.items() if c > 1)}
+
+        lines = ["def {}(obj):".format(name)]
+        for node_ in node.scope():
+            if node_.kind == "path" and str(node_.value) in hoisted:
+                local = hoisted.pop(str(node_.value))
+                lines.append("    {} = {}(obj)".format(local, self.path(node_)))
+                self._hoisted[str(node_.value)] = local
+        lines.append("    return {}".format(self.expr(node)))
+        self.lines.extend(lines)
+        self.lines.append("")
+        return name
+
+    def path(self, node):
+        return self.bind("p", node.value.getter, key=str(node.value))
+
+    def expr(self, node):
+        if self._memo and node.key() in self._memo:
+            return self._memo[node.key()]
+        if node.kind == "const":
+            if _is_literal(node.value):
+                return repr(node.value)
+            return self.bind("c", node.value)
+        if node.kind == "path":
+            return self._hoisted.get(str(node.value)) or "{}(obj)".format(self.path(node))
+        if node.kind == "op":
+            l, r = node.children
+            op = {"&&": "and", "||": "or"}.get(node.value, node.value)
+            return "({} {} {})".format(self.expr(l), op, self.expr(r))
+        if node.kind == "cond":
+            cond, l, r = node.children
+            return "({} if {} else {})".format(self.expr(l), self.expr(cond), self.expr(r))
+        if node.kind == "reduce":
+            fn = self.bind("f", _FUNCTIONS[node.value], key=node.value)
+            return "{}({})".format(fn, ", ".join(self.expr(child) for child in node.children))
+        if node.kind == "map":
+            fn = self.bind("f", _FUNCTIONS[node.value], key=node.value)
+            return "_map({})".format(", ".join([fn] + [self.expr(child) for child in node.children]))
+        if node.kind == "apply":
+            arg, fn = node.children
+            outer, self._hoisted, memo, self._memo = self._hoisted, {}, self._memo, {}
+            self._applies += 1
+            name = self.function(fn, name="_a{}".format(self._applies))
+            self._hoisted, self._memo = outer, memo
+            return "{}({})".format(name, self.expr(arg))
+        raise ValueError("Unknown expression node {}".format(node))
+
+    def compile(self, node):
+        self.function(node)
+        source = "\n".join(self.lines)
+        exec(compile(source, "<jsontool-expr>", "exec"), self.namespace)
+        fn = self.namespace["_expr"]
+        fn.source = source
+        fn.node = node
+        fn.paths = node.paths()
+        return fn
+
+def compile_expr(node):
+    """
+    Compiles an expression tree into a Python function of one record.
+    """
+    return _Compiler().compile(node)
 
 GRAMMAR_PATH = os.path.join(os.path.dirname(__file__), "grammar.lark")
-with open(GRAMMAR_PATH) as f:
-    _GRAMMAR = f.read()
-    _PARSER = Lark(_GRAMMAR, start="expr")
+# Bump when `Transformer` changes what it builds, to invalidate cached trees.
+CACHE_VERSION = 1
+# Sources of the classes in cached trees (ours and jsonpath_ng's), which
+# must be the same files for a cached tree to be used.
+_CACHED_SOURCES = [__file__, _jp.__file__, sys.modules[parse_jsonpath.__module__].__file__]
 _TRANSFORMER = Transformer()
 
-def parse_expr(expr):
+@lru_cache(maxsize=None)
+def _parser():
+    # Lark takes a while to import and to build the (Earley) parser, so
+    # both only happen when an expression isn't in the cache. The grammar
+    # isn't LALR (a path is both an arithmetic and a boolean atom, and
+    # precedence comes from resolving ambiguities), so Lark's own parser
+    # cache, which only supports LALR, doesn't apply.
+    from lark import Lark
+    with open(GRAMMAR_PATH) as f:
+        return Lark(f.read(), start="expr")
+
+def cache_dir():
+    """
+    Returns the directory of the parsed expression cache, or None if it
+    is disabled (with JSONTOOL_CACHE_DIR set to an empty string).
+    """
+    ret = os.environ.get("JSONTOOL_CACHE_DIR")
+    if ret is None:
+        ret = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "jsontool")
+    return ret or None
+
+@lru_cache(maxsize=1)
+def _cache_salt():
+    # The size and modification time of the sources change with every
+    # upgrade (or edit) of either package, and unlike the package versions
+    # don't need importlib.metadata, which takes tens of milliseconds to
+    # import.
+    import hashlib
+    stamps = []
+    for fname in _CACHED_SOURCES:
+        st = os.stat(fname)
+        stamps.append("{}:{}:{}".format(fname, st.st_size, st.st_mtime_ns))
+    with open(GRAMMAR_PATH, "rb") as f:
+        grammar = f.read()
+    return hashlib.sha1(grammar + str(CACHE_VERSION).encode() + "\n".join(stamps).encode()).hexdigest()
+
+def _cache_path(expr):
+    import hashlib
+    key = hashlib.sha1((_cache_salt() + expr).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir(), "exprs", key[:2], key + ".pickle")
+
+def _load_cached(expr):
+    import pickle
+    try:
+        with open(_cache_path(expr), "rb") as f:
+            source, node = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug("Ignoring the cached tree of %s: %s", expr, e)
+        return None
+    return node if source == expr else None
+
+def _save_cached(expr, node):
+    import pickle
+    import tempfile
+    fname = _cache_path(expr)
+    tmp = None
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        # Written under a temporary name so that concurrent runs never
+        # read a partial file.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname))
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((expr, node), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fname)
+    except Exception as e:
+        # The cache is only an optimization (constants folded into
+        # functions, for one, can't be pickled).
+        logger.debug("Could not cache the tree of %s: %s", expr, e)
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+@lru_cache(maxsize=4096)
+def _parse_tree(expr):
+    """
+    Returns the expression tree of @expr, from the on-disk cache if it
+    has been parsed before.
+    """
+    cached = cache_dir() is not None
+    node = _load_cached(expr) if cached else None
+    if node is not None:
+        return node
+    from lark import UnexpectedInput
     try:
-        tree = _PARSER.parse(expr)
-        return _TRANSFORMER.transform(tree)
+        tree = _parser().parse(expr)
     except UnexpectedInput:
         raise ValueError("Could not parse {}".format(expr))
+    node = _TRANSFORMER.transform(tree)
+    if cached:
+        _save_cached(expr, node)
+    return node
+
+def parse_expr(expr):
+    fn = compile_expr(_parse_tree(expr))
+    fn.expr = expr
+    return fn
 
 def test_parse_expr():
     obj = {
@@ -217,3 +762,113 @@ def test_parse_expr():
     assert parse_expr('find("this", $.melon)')(obj) == True
     assert parse_expr('find("test", $.melon)')(obj) == True
     assert parse_expr('find("tast", $.melon)')(obj) == False
+    assert parse_expr('ifind("TEST", $.melon)')(obj) == True
+    assert parse_expr('imatch("THIS", $.melon)')(obj) == True
+    assert parse_expr('find("^is", $.melon)')(obj) == False
+
+def test_required_literals():
+    def test(expr):
+        return required_literals(parse_expr(expr).node)
+
+    assert test('find("hello", $.a)') == {"hello"}
+    assert test('match("ab+cde?f", $.a)') == {"cd"}
+    assert test('find("a/bc\\.d", $.a)') == {"bc.d"}
+    assert test('ifind("hello", $.a)') == set()
+    assert test('find("(?i)hello", $.a)') == set()
+    assert test('find("foo|bar", $.a)') == set()
+    assert test('find("hello", $.a) && find("world", $.b)') == {"hello", "world"}
+    assert test('find("hello", $.a) || find("hello", $.b)') == {"hello"}
+    assert test('find("hello", $.a) || $.b') == set()
+    assert test('not(find("hello", $.a))') == set()
+    # Subjects that aren't taken from the record as they are.
+    assert test('find("yes", $.flag ? "yes" : "no")') == set()
+    assert test('find("yes", "yes")') == set()
+    assert test('find("hello", $.a) && find("ab", $.b ? "ab" : "cd")') == {"hello"}
+    assert isinstance(parse_expr('find("x", $.a)').node.children[0].value, re.Pattern)
+
+def test_expr_cache(tmp_path, monkeypatch):
+    import pickle
+
+    monkeypatch.setenv("JSONTOOL_CACHE_DIR", str(tmp_path))
+    expr = 'find("b+", $.a.b[0]) ? $..c : len{$.d[*]}'
+    node = _parse_tree.__wrapped__(expr)
+    assert os.path.exists(_cache_path(expr))
+    cached = _load_cached(expr)
+    assert cached.key() == node.key() and cached is not node
+    obj = {"a": {"b": ["abb"]}, "c": 1, "e": {"c": 2}}
+    assert compile_expr(cached)(obj) == compile_expr(node)(obj) == [1, 2]
+
+    # Cached trees are used as they are; unreadable ones are reparsed.
+    with open(_cache_path(expr), "wb") as f:
+        pickle.dump((expr, Node("const", 5)), f)
+    assert _parse_tree.__wrapped__(expr).value == 5
+    with open(_cache_path(expr), "wb") as f:
+        f.write(b"garbage")
+    assert _parse_tree.__wrapped__(expr).key() == node.key()
+
+    # Upgrading (or editing) the code that built a cached tree invalidates it.
+    source = tmp_path / "source.py"
+    source.write_text("x = 1\n")
+    monkeypatch.setattr(__name__ + "._CACHED_SOURCES", _CACHED_SOURCES + [str(source)])
+    _cache_salt.cache_clear()
+    path = _cache_path(expr)
+    source.write_text("x = 22\n")
+    _cache_salt.cache_clear()
+    assert _cache_path(expr) != path
+    _cache_salt.cache_clear()
+
+def test_compile_expr():
+    obj = {
+        "apples": 1,
+        "bananas": {"apples": 2},
+        "carrots": [1,2,3,4],
+        "oranges": True,
+        }
+
+    # Constants are folded at parse time.
+    assert parse_expr("1 + 2 * 3").node.kind == "const"
+    assert parse_expr("1 + 2 * 3")(obj) == 9
+    assert parse_expr("True ? $.apples : 2").node.kind == "path"
+    assert parse_expr("1 / 0").node.kind == "op"
+
+    # Repeated lookups are hoisted into a single local.
+    # (Arithmetic associates to the left without precedence.)
+    fn = parse_expr("$.apples + $.apples * $.bananas.apples")
+    assert fn.source.count("_p0(obj)") == 1
+    assert fn(obj) == (1 + 1) * 2
+
+    assert parse_expr("$.bananas |> $.apples")(obj) == 2
+    assert parse_expr("$.bananas |> $.apples |> $.apples")(obj) is None
+    assert parse_expr("$.oranges && $.apples > 0")(obj) is True
+    assert parse_expr("$.tomatoes || $.apples")(obj) == 1
+
+def test_compile_jsonpath():
+    obj = {
+        "a": 1,
+        "b": "apples",
+        "c": [2, 3],
+        "d": {"a": 4, "b": None},
+        "e": [{"a": 5}, {"a": 6, "b": [{"a": 7}]}],
+        }
+
+    paths = ["$.a", "$.b[0]", "$.c[-1]", "$.c[2]", "$.c.a", "$.d.a", "$.d.b", "$.d[0]",
+             "$.a.b", "$.e[1].a", "$.e[*].a", "$.d[*]", "$.a[*]", "$.*", "$.d.*", "$.c.*",
+             "$.e..a", "$..a", "$..b", "$.e..*", "$.d.a,b", "$.c[0,1]", "$.c[0:1]"]
+    for path in paths:
+        path_ = JsonPath(parse_jsonpath(path))
+        assert path_(obj) == path_._find(obj), path
+    assert JsonPath(parse_jsonpath("$.c[0:1]")).getter.__name__ == "_find"
+
+def test_projection():
+    def test(*exprs):
+        return projection([path for expr in exprs for path in parse_expr(expr).paths])
+
+    assert test("$.a") == {"a": None}
+    assert test("$.a.b > 1", "$.a.c") == {"a": {"b": None, "c": None}}
+    assert test("$.a.b", "$.a") == {"a": None}
+    assert test("$.a", "$.a.b") == {"a": None}
+    assert test("$.a[0].b", "$.c..d", "$.e.*") == {"a": None, "c": None, "e": None}
+    assert test("$.a |> $.b") == {"a": None}
+    assert test("$.a", "$.*") is None
+    assert test("$..a") is None
+    assert test("1") == {}
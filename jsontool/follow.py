@@ -0,0 +1,221 @@
+"""
+Incremental reading of growing JSONL files (--follow and --checkpoint)
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1 << 20
+# Seconds between checkpoints while catching up on a large backlog.
+CHECKPOINT_INTERVAL = 10.
+# Lines between checks of the time.
+_CHECK_LINES = 1024
+# Bytes before the offset that a checkpoint keeps a hash of, to tell a
+# file that was rewritten since from one that only grew.
+_FINGERPRINT_SIZE = 256
+
+def _fingerprint(fd, offset):
+    import hashlib
+    start = max(offset - _FINGERPRINT_SIZE, 0)
+    return hashlib.blake2b(os.pread(fd, offset - start, start), digest_size=16).hexdigest()
+
+def load_checkpoint(fname):
+    """
+    Returns the state saved by `save_checkpoint`, or None if there is none.
+    """
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_checkpoint(fname, state):
+    # Written under a temporary name so that a crash never leaves a
+    # partial checkpoint.
+    dirname = os.path.dirname(os.path.abspath(fname))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".checkpoint-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+class FileFollower():
+    """
+    Yields the complete lines of the file @fname from byte @offset; a
+    trailing line without a newline is held back until it is complete.
+    With @follow, it then waits for the file to grow, polling every
+    @poll_interval seconds, until no data came for @idle_timeout seconds
+    (None waits forever). A file that is truncated is read again from the
+    start, and one that is replaced (rotated) is read to its end before
+    the new file is opened.
+
+    `on_checkpoint` (if set) is called with the state to resume from (see
+    `resume`) whenever everything yielded so far has been consumed: before
+    waiting for more data, every `CHECKPOINT_INTERVAL` seconds and at the
+    end.
+    """
+    def __init__(self, fname, offset=0, follow=False, poll_interval=1., idle_timeout=None):
+        self.fname = fname
+        self.offset = offset
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.on_checkpoint = None
+        self.file = None
+        self.stat = None
+
+    @classmethod
+    def resume(cls, fname, state, **kwargs):
+        """
+        Returns a follower of @fname that starts where a checkpoint @state
+        of it left off, or at the start if the file was since rotated or
+        truncated.
+        """
+        offset = 0
+        if state is not None:
+            with open(fname, "rb") as f:
+                st = os.fstat(f.fileno())
+                if [st.st_dev, st.st_ino] != [state.get("device"), state.get("inode")]:
+                    logger.warning("%s was replaced since the checkpoint; reading it from the start", fname)
+                elif st.st_size < state["offset"] or _fingerprint(f.fileno(), state["offset"]) != state.get("fingerprint"):
+                    logger.warning("%s was truncated since the checkpoint; reading it from the start", fname)
+                else:
+                    offset = state["offset"]
+        return cls(fname, offset, **kwargs)
+
+    def state(self):
+        return {"path": os.path.abspath(self.fname), "device": self.stat.st_dev, "inode": self.stat.st_ino,
+                "offset": self.offset, "fingerprint": _fingerprint(self.file.fileno(), self.offset)}
+
+    def _open(self, offset):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.fname, "rb", buffering=0)
+        self.stat = os.fstat(self.file.fileno())
+        self.file.seek(offset)
+        self.offset = offset
+
+    def _checkpoint(self):
+        if self.on_checkpoint is not None:
+            self.on_checkpoint(self.state())
+
+    def _replaced(self):
+        try:
+            st = os.stat(self.fname)
+        except FileNotFoundError:
+            # Rotated, and the new file isn't there yet.
+            return False
+        return (st.st_dev, st.st_ino) != (self.stat.st_dev, self.stat.st_ino)
+
+    def _read(self):
+        """
+        Yields the complete lines of the file from the current offset;
+        returns the incomplete tail.
+        """
+        tail = b""
+        lines, last_check = 0, time.monotonic()
+        while True:
+            block = self.file.read(READ_SIZE)
+            if not block:
+                return tail
+            data = tail + block if tail else block
+            view = memoryview(data)
+            pos, find = 0, data.find
+            while True:
+                nl = find(b"\n", pos)
+                if nl < 0:
+                    break
+                yield view[pos:nl + 1]
+                self.offset += nl + 1 - pos
+                pos = nl + 1
+                lines += 1
+                if lines % _CHECK_LINES == 0 and time.monotonic() - last_check >= CHECKPOINT_INTERVAL:
+                    self._checkpoint()
+                    last_check = time.monotonic()
+            tail = data[pos:]
+
+    def __iter__(self):
+        self._open(self.offset)
+        try:
+            idle = 0.
+            while True:
+                tail = yield from self._read()
+                if self.follow and self._replaced():
+                    # Whatever the old file still had, then the new one.
+                    self.file.seek(self.offset)
+                    tail = yield from self._read()
+                    if tail:
+                        yield tail
+                    logger.info("%s was rotated; reading the new file", self.fname)
+                    self._open(0)
+                    idle = 0.
+                    continue
+                if os.fstat(self.file.fileno()).st_size < self.offset:
+                    logger.warning("%s was truncated; reading it from the start", self.fname)
+                    self._open(0)
+                    continue
+                # The incomplete line is read again once it is complete.
+                self.file.seek(self.offset)
+                self._checkpoint()
+                if not self.follow or (self.idle_timeout is not None and idle >= self.idle_timeout):
+                    return
+                time.sleep(self.poll_interval)
+                idle = 0. if os.fstat(self.file.fileno()).st_size > self.offset + len(tail) else idle + self.poll_interval
+        finally:
+            self.file.close()
+
+def test_file_follower(tmp_path):
+    fname = str(tmp_path / "log.jsonl")
+    checkpoint = str(tmp_path / "checkpoint.json")
+    with open(fname, "wb") as f:
+        f.write(b'{"a": 1}\n{"a": 2}\n{"a": ')
+
+    def read(**kwargs):
+        follower = FileFollower.resume(fname, load_checkpoint(checkpoint), **kwargs)
+        follower.on_checkpoint = lambda state: save_checkpoint(checkpoint, state)
+        return [bytes(line) for line in follower]
+
+    assert read() == [b'{"a": 1}\n', b'{"a": 2}\n']
+    assert load_checkpoint(checkpoint)["offset"] == 18
+    # Only new lines are read, once they are complete.
+    assert read() == []
+    with open(fname, "ab") as f:
+        f.write(b'3}\n{"a": 4}\n')
+    assert read() == [b'{"a": 3}\n', b'{"a": 4}\n']
+
+    # A truncated file is read from the start, even if it grew back.
+    with open(fname, "wb") as f:
+        f.write(b'{"b": 1}\n' * 5)
+    assert read() == [b'{"b": 1}\n'] * 5
+    with open(fname, "wb") as f:
+        f.write(b'{"b": 1}\n')
+    assert read() == [b'{"b": 1}\n']
+
+    # A rotated file is read to its end (even an incomplete last line),
+    # then the new one.
+    with open(fname, "ab") as f:
+        f.write(b'{"b": 2}\n')
+    follower = FileFollower.resume(fname, load_checkpoint(checkpoint), follow=True, poll_interval=0.01,
+                                   idle_timeout=0.05)
+    states = []
+    follower.on_checkpoint = states.append
+    lines = iter(follower)
+    assert bytes(next(lines)) == b'{"b": 2}\n'
+    with open(fname, "ab") as f:
+        f.write(b'{"b": 3}\n{"b": 4}')
+    os.rename(fname, fname + ".1")
+    with open(fname, "wb") as f:
+        f.write(b'{"c": 1}\n')
+    assert [bytes(line) for line in lines] == [b'{"b": 3}\n', b'{"b": 4}', b'{"c": 1}\n']
+    assert states[-1]["offset"] == 9 and states[-1]["inode"] == os.stat(fname).st_ino
+
+    # A rotated file since the checkpoint is read from the start.
+    assert read() == [b'{"c": 1}\n']
@@ -0,0 +1,405 @@
+"""
+Conversion of CSV and TSV files into typed records
+"""
+
+import io
+import os
+import re
+import csv
+import json
+import mmap
+import logging
+from itertools import chain, islice
+
+from .util import JsonWriter, set_default_codec, set_writer_options
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ["auto", "csv", "tsv", "parquet", "arrow"]
+_EXTENSIONS = {
+    ".csv": "csv",
+    ".tsv": "tsv",
+    ".tab": "tsv",
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".ipc": "arrow",
+}
+_COMPRESSED = (".gz", ".bz2", ".xz", ".zst")
+
+# Characters of text read to guess the dialect of a CSV.
+SNIFF_SIZE = 64 * 1024
+# Rows converted at a time.
+BATCH_SIZE = 4096
+
+# Column types from the most to the least specific; a column has the
+# first type that all of its (non-null) sampled values have.
+TYPES = ["null", "bool", "int", "float", "string"]
+_INT_PATTERN = r"[-+]?(?:0|[1-9][0-9]*)"
+# Like JSON numbers, but also "1.", ".5" and "+1"; leading zeros (zip
+# codes, identifiers) keep a cell a string.
+_FLOAT_PATTERN = r"[-+]?(?:(?:0|[1-9][0-9]*)(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?"
+_INT = re.compile(_INT_PATTERN + r"\Z")
+_FLOAT = re.compile(_FLOAT_PATTERN + r"\Z")
+# Whole columns are checked at once, joined with newlines.
+_INTS = re.compile(r"(?:{}\n)*\Z".format(_INT_PATTERN))
+_FLOATS = re.compile(r"(?:{}\n)*\Z".format(_FLOAT_PATTERN))
+_BOOLS = {"true": True, "false": False}
+_BOOL_CELLS = {cell: value for key, value in _BOOLS.items() for cell in (key, key.title(), key.upper())}
+
+def detect_format(fname):
+    """
+    Returns the format of @fname from its extension, or None.
+    """
+    root, ext = os.path.splitext(fname.lower())
+    if ext in _COMPRESSED:
+        root, ext = os.path.splitext(root)
+    return _EXTENSIONS.get(ext)
+
+def csv_dialect(format="auto", delimiter=None, sample=""):
+    """
+    Returns the keyword arguments of `csv.reader` for @format: "csv" and
+    "tsv" are Excel's dialects with commas and tabs, and "auto" guesses
+    the dialect from the text @sample (defaulting to "csv").
+    """
+    if format == "auto":
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",\t;|")
+        except csv.Error:
+            dialect = csv.excel
+    else:
+        dialect = csv.excel_tab if format == "tsv" else csv.excel
+    ret = {
+        "delimiter": dialect.delimiter,
+        "quotechar": dialect.quotechar or '"',
+        "doublequote": dialect.doublequote,
+        "escapechar": dialect.escapechar,
+        "skipinitialspace": dialect.skipinitialspace,
+        "quoting": dialect.quoting,
+    }
+    if delimiter:
+        ret["delimiter"] = delimiter
+    return ret
+
+def field_name(header):
+    # Field names keep only ASCII letters and digits.
+    return re.sub("[^a-zA-Z0-9]", "", header)
+
+def value_type(value):
+    """
+    Returns the most specific type of a (non-null) cell.
+    """
+    if _INT.match(value):
+        return "int"
+    if _FLOAT.match(value):
+        return "float"
+    if value.lower() in _BOOLS:
+        return "bool"
+    return "string"
+
+def _widen(type_, other):
+    if type_ == other or other == "null":
+        return type_
+    if type_ == "null":
+        return other
+    if {type_, other} == {"int", "float"}:
+        return "float"
+    return "string"
+
+def column_types(rows, n_columns, nulls=("",)):
+    """
+    Returns the type of each of the @n_columns columns of @rows.
+    """
+    ret = ["null"] * n_columns
+    for row in rows:
+        for i, value in enumerate(row[:n_columns]):
+            if value not in nulls and ret[i] != "string":
+                ret[i] = _widen(ret[i], value_type(value))
+    return ret
+
+def convert_value(value, nulls=("",)):
+    """
+    Converts a cell to the value of its own type.
+    """
+    if value in nulls:
+        return None
+    type_ = value_type(value)
+    if type_ == "int":
+        return int(value)
+    if type_ == "float":
+        return float(value)
+    if type_ == "bool":
+        return _BOOLS[value.lower()]
+    return value
+
+def _with_nulls(convert, nulls):
+    def _convert(column):
+        if nulls.isdisjoint(column):
+            return convert(column)
+        values = iter(convert([value for value in column if value not in nulls]))
+        return [None if value in nulls else next(values) for value in column]
+    return _convert
+
+def _column_converter(type_, nulls):
+    """
+    Returns a function converting a column of a batch of rows (a tuple of
+    cells) of @type_ at once. Columns with nulls or cells of other types
+    (beyond the sampled rows) are converted cell by cell, the cells of
+    other types like `convert_value`.
+    """
+    def _cell(value):
+        return convert_value(value, nulls)
+
+    if type_ in ("int", "float"):
+        # Ints in a float column become floats, so that the column has one type.
+        pattern, match, number = (_INTS, _INT.match, int) if type_ == "int" else (_FLOATS, _FLOAT.match, float)
+
+        def _convert(column):
+            if pattern.match("\n".join(column) + "\n"):
+                try:
+                    return list(map(number, column))
+                except ValueError:
+                    # A quoted cell with newlines.
+                    pass
+            return [number(value) if match(value) else _cell(value) for value in column]
+        typed_nulls = any(match(null) for null in nulls)
+    elif type_ == "bool":
+        def _convert(column):
+            try:
+                return list(map(_BOOL_CELLS.__getitem__, column))
+            except KeyError:
+                return [_BOOLS[value.lower()] if value.lower() in _BOOLS else _cell(value) for value in column]
+        typed_nulls = any(null.lower() in _BOOLS for null in nulls)
+    elif type_ == "string":
+        _convert, typed_nulls = list, True
+    else:
+        def _convert(column):
+            return list(map(_cell, column))
+        typed_nulls = False
+    # Only nulls that look like values of the type are checked for
+    # upfront; the others fail the fast path.
+    return _with_nulls(_convert, nulls) if typed_nulls and nulls else _convert
+
+class BatchConverter():
+    """
+    Converts batches of rows into records with the fields of @header,
+    converting each column to its type in @types at once. Cells in @nulls
+    are null, blank rows are skipped and short rows lack the fields of
+    their missing cells.
+    """
+    def __init__(self, header, types, nulls=("",)):
+        self.header = header
+        nulls = frozenset(nulls)
+        self.converters = [_column_converter(type_, nulls) for type_ in types]
+
+    def convert_row(self, row):
+        return {key: converter((value,))[0] for key, converter, value in zip(self.header, self.converters, row)}
+
+    def __call__(self, rows):
+        if not all(rows):
+            rows = [row for row in rows if row]
+        if not rows:
+            return []
+        header = self.header
+        if set(map(len, rows)) != {len(header)}:
+            return [self.convert_row(row) for row in rows]
+        columns = [converter(column) for converter, column in zip(self.converters, zip(*rows))]
+        return [dict(zip(header, values)) for values in zip(*columns)]
+
+def _batches(rows, size=BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+class CsvReader():
+    """
+    Reads the records of a CSV or TSV stream: the first row holds the
+    field names, and the type of each column is inferred from the first
+    @sample_size rows (or all cells are strings unless @infer). Cells in
+    @nulls are null. Iterate over the reader for the records.
+    """
+    def __init__(self, fstream, format="auto", delimiter=None, sample_size=1000, nulls=("",), infer=True):
+        text = io.TextIOWrapper(fstream, encoding="utf-8-sig", newline="")
+        head = text.read(SNIFF_SIZE)
+        # The guess only sees whole lines.
+        head += text.readline()
+        self.dialect = csv_dialect(format, delimiter, head)
+        reader = csv.reader(chain(io.StringIO(head, newline=""), text), **self.dialect)
+        self.header = [field_name(name) for name in next(reader, [])]
+        self.sample = list(islice(reader, sample_size))
+        self.nulls = tuple(nulls)
+        self.types = column_types(self.sample, len(self.header), nulls) if infer else ["string"] * len(self.header)
+        self.convert = BatchConverter(self.header, self.types, nulls)
+        self.rows = chain(self.sample, reader)
+        logger.debug("Column types: %s", dict(zip(self.header, self.types)))
+
+    def __iter__(self):
+        convert = self.convert
+        for rows in _batches(self.rows):
+            yield from convert(rows)
+
+def _count(data, byte, start, end, block_size=1 << 20):
+    ret = 0
+    for pos in range(start, end, block_size):
+        ret += data[pos:min(pos + block_size, end)].count(byte)
+    return ret
+
+def record_ranges(fname, n_chunks, quotechar='"'):
+    """
+    Splits @fname into at most @n_chunks (start, end) byte ranges of
+    whole CSV records, after the header. A newline ends a record unless it
+    is quoted, i.e. preceded by an odd number of @quotechar (quotes in
+    quoted cells are doubled, which keeps the count even).
+    """
+    size = os.path.getsize(fname)
+    if size == 0:
+        return []
+    quote = quotechar.encode("utf-8") if quotechar else None
+    with open(fname, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        quotes, pos = 0, 0
+
+        def _record_end(target):
+            # Returns the end of the record that contains @target.
+            nonlocal quotes, pos
+            if quote:
+                quotes += _count(data, quote, pos, target)
+            pos = target
+            while pos < size:
+                end = data.find(b"\n", pos)
+                end = size if end < 0 else end + 1
+                if quote:
+                    quotes += _count(data, quote, pos, end)
+                pos = end
+                if quotes % 2 == 0:
+                    break
+            return pos
+
+        starts = [_record_end(0)]
+        for i in range(1, n_chunks):
+            target = size * i // n_chunks
+            if target < pos:
+                continue
+            start = _record_end(target)
+            if start >= size:
+                break
+            starts.append(start)
+    return [(start, end) for start, end in zip(starts, starts[1:] + [size]) if start < end]
+
+_CONVERTER = None
+
+def _init_converter(header, types, nulls, dialect, codec):
+    global _CONVERTER
+    from .stats import disable_stats
+    set_default_codec(codec)
+    set_writer_options(flush_interval=None, threaded=False)
+    disable_stats()
+    _CONVERTER = (BatchConverter(header, types, nulls), dialect)
+
+def _convert_range(task):
+    fname, start, end = task
+    convert, dialect = _CONVERTER
+    with open(fname, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    reader = csv.reader(io.StringIO(data.decode("utf-8"), newline=""), **dialect)
+    output = io.BytesIO()
+    writer = JsonWriter(output)
+    for rows in _batches(reader):
+        for obj in convert(rows):
+            writer.write(obj)
+    writer.close()
+    return output.getvalue()
+
+def convert_file(fname, reader, jobs, codec="auto"):
+    """
+    Converts the CSV file @fname, whose header, dialect and types @reader
+    (a `CsvReader` of the file) has read, in @jobs worker processes.
+    Returns an iterator over the JSONL output of each chunk in order.
+    Raises ValueError right away (before any output) if the file can't be
+    split into chunks.
+    """
+    from .parallel import CHUNK_SIZE, CHUNKS_PER_JOB
+
+    dialect = reader.dialect
+    if dialect["escapechar"] and not dialect["doublequote"]:
+        # Escaped quotes would throw off counting quotes to find records.
+        raise ValueError("Files with escaped quotes can only be imported in one process")
+    quotechar = dialect["quotechar"] if dialect["quoting"] != csv.QUOTE_NONE else None
+    n_chunks = max(jobs * CHUNKS_PER_JOB, os.path.getsize(fname) // CHUNK_SIZE)
+    tasks = [(fname, start, end) for start, end in record_ranges(fname, n_chunks, quotechar)]
+    return _convert_chunks(tasks, jobs, (reader.header, reader.types, reader.nulls, dialect, codec))
+
+def _convert_chunks(tasks, jobs, initargs):
+    import multiprocessing
+    with multiprocessing.Pool(jobs, initializer=_init_converter, initargs=initargs) as pool:
+        yield from pool.imap(_convert_range, tasks)
+
+def test_column_types():
+    rows = [["1", "1.5", "true", "", "007", "x"], ["-2", "3", "False", "", "8", "1"], ["+3", "1e3", "TRUE"]]
+    assert column_types(rows, 6) == ["int", "float", "bool", "null", "string", "string"]
+    assert [value_type(v) for v in ["1_000", "nan", "inf", ".5", "5.", "-0", "00"]] == \
+        ["string", "string", "string", "float", "float", "int", "string"]
+
+    convert = BatchConverter(["a", "b", "c", "d", "e"], ["int", "float", "bool", "null", "string"])
+    assert convert([["1", "3", "true", "", ""], ["-1", "1e2", "FALSE", "", "x"]]) == [
+        {"a": 1, "b": 3.0, "c": True, "d": None, "e": None}, {"a": -1, "b": 100.0, "c": False, "d": None, "e": "x"}]
+    # Cells that don't fit their column keep their own type.
+    assert convert([["x", "1.5", "1", "2", "y"], ["1", "3", "tRUE", "", "z"]]) == [
+        {"a": "x", "b": 1.5, "c": 1, "d": 2, "e": "y"}, {"a": 1, "b": 3.0, "c": True, "d": None, "e": "z"}]
+    assert convert([["1", "2"], [], ["2", "3", "false", "", "", "extra"]]) == [
+        {"a": 1, "b": 2.0}, {"a": 2, "b": 3.0, "c": False, "d": None, "e": None}]
+    assert convert([["1\n2", "1", "true", "", ""]])[0]["a"] == "1\n2"
+    convert = BatchConverter(["a", "b"], ["int", "string"], ["-1", "NA"])
+    assert convert([["-1", "NA"], ["2", "x"], ["NA", ""]]) == [{"a": None, "b": None}, {"a": 2, "b": "x"}, {"a": None, "b": ""}]
+
+def test_csv_reader():
+    def read(text, *args, **kwargs):
+        return list(CsvReader(io.BytesIO(text.encode("utf-8")), *args, **kwargs))
+
+    text = 'id,name,score,ok\n1,"Smith, J",1.5,true\n2,"multi\nline",,false\n\n3,x\n'
+    expected = [{"id": 1, "name": "Smith, J", "score": 1.5, "ok": True},
+                {"id": 2, "name": "multi\nline", "score": None, "ok": False},
+                {"id": 3, "name": "x"}]
+    assert read(text, "csv") == expected
+    assert read(text) == expected
+    assert read(text.replace(",", "\t").replace('"Smith\t J"', "Smith, J"), "tsv") == expected
+    assert read(text.replace(",", "\t").replace('"Smith\t J"', "Smith, J")) == expected
+    assert read(text, "csv", infer=False)[0] == {"id": "1", "name": "Smith, J", "score": "1.5", "ok": "true"}
+    assert read(text, "csv", nulls=(), infer=False)[1] == {"id": "2", "name": "multi\nline", "score": "", "ok": "false"}
+    assert read("﻿a;b\n1;2\n", "csv", ";") == [{"a": 1, "b": 2}]
+    assert read("") == []
+
+def test_record_ranges(tmp_path):
+    fname = str(tmp_path / "x.csv")
+    rows = ['{},"a\n""b"", {}",{}\n'.format(i, "\n" * (i % 3), i * 1.5) for i in range(200)]
+    with open(fname, "w") as f:
+        f.write("id,text,value\n" + "".join(rows))
+
+    with open(fname, "rb") as f:
+        expected = list(CsvReader(f))
+    assert len(expected) == 200
+    for n_chunks in [1, 3, 16]:
+        ranges = record_ranges(fname, n_chunks)
+        assert len(ranges) == n_chunks
+        assert ranges[0][0] == len("id,text,value\n")
+        assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+        with open(fname, "rb") as f:
+            reader = CsvReader(f)
+        _init_converter(reader.header, reader.types, reader.nulls, reader.dialect, "auto")
+        output = b"".join(_convert_range((fname, start, end)) for start, end in ranges)
+        assert [json.loads(line) for line in output.splitlines()] == expected
+
+    # Files that can't be split are refused before any chunk is converted.
+    with open(fname, "w") as f:
+        f.write('a,b\n1,"x\\"y"\n')
+    with open(fname, "rb") as f:
+        reader = CsvReader(f, "csv")
+    reader.dialect.update(escapechar="\\", doublequote=False)
+    try:
+        convert_file(fname, reader, 2)
+        assert False, "ValueError was not raised"
+    except ValueError:
+        pass
@@ -0,0 +1,343 @@
+"""
+Sidecar indexes that let filter skip parts of a JSONL file
+"""
+
+import os
+import json
+import base64
+import logging
+from bisect import bisect_left, bisect_right
+
+from .expr import parse_expr
+from .sketch import BloomFilter
+from .util import read_lines, read_ranges, default_codec
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".jtidx"
+INDEX_VERSION = 1
+
+def index_path(fname):
+    return fname + INDEX_SUFFIX
+
+def _normalize(value):
+    """
+    Maps values that compare equal in Python (True, 1 and 1.0) to the
+    same key, and anything that can't equal an expression constant to
+    None. NaN, which compares false with everything, is None too, as it
+    would otherwise spoil the bounds of its block.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, (int, float, str)):
+        return value
+    return None
+
+def _sort_key(value):
+    # Numbers sort before strings.
+    return (isinstance(value, str), value)
+
+class _Zone():
+    """
+    The values of a key in one block, summarized as the range of its
+    numbers, the range of its strings and a bloom filter.
+    """
+    def __init__(self):
+        self.values = set()
+
+    def add(self, value):
+        value = _normalize(value)
+        if value is None:
+            return
+        self.values.add(value)
+
+    def to_dict(self):
+        strings = [v for v in self.values if isinstance(v, str)]
+        numbers = [v for v in self.values if not isinstance(v, str)]
+        bloom = BloomFilter(len(self.values))
+        for value in self.values:
+            bloom.add(value)
+        return {"numbers": [min(numbers), max(numbers)] if numbers else None,
+                "strings": [min(strings), max(strings)] if strings else None,
+                "bloom": base64.b64encode(bloom.bits).decode("ascii"), "hashes": bloom.n_hashes}
+
+def _file_stamp(fname):
+    st = os.stat(fname)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def build_index(fname, keys, block_size=1024, sorted_keys=(), codec=None):
+    """
+    Builds an index of @fname for the JSONPath expressions @keys: the byte
+    offset of every block of @block_size lines, per-block zone maps and
+    bloom filters for every key, and a sorted value -> line offsets map
+    for @sorted_keys.
+    """
+    loads = (codec or default_codec()).loads
+    exprs = {str(_key_path(key)): parse_expr(key) for key in keys}
+    sorted_ = {str(_key_path(key)): [] for key in sorted_keys}
+    assert set(sorted_) <= set(exprs), "Sorted keys must also be keys"
+
+    blocks, zones = [], {key: [] for key in exprs}
+    offset = 0
+    with open(fname, "rb") as f:
+        for i, line in enumerate(read_lines(f)):
+            if i % block_size == 0:
+                blocks.append(offset)
+                for key in exprs:
+                    zones[key].append(_Zone())
+            try:
+                obj = loads(line)
+            except ValueError:
+                obj = None
+            for key, expr in exprs.items():
+                try:
+                    value = expr(obj)
+                except Exception:
+                    continue
+                zones[key][-1].add(value)
+                if key in sorted_ and _normalize(value) is not None:
+                    sorted_[key].append((_normalize(value), offset))
+            offset += len(line)
+
+    ret = {
+        "version": INDEX_VERSION,
+        "file": _file_stamp(fname),
+        "block_size": block_size,
+        "blocks": blocks,
+        "keys": {key: {"zones": [zone.to_dict() for zone in zones[key]]} for key in exprs},
+        }
+    for key, values in sorted_.items():
+        values.sort(key=lambda v: (_sort_key(v[0]), v[1]))
+        ret["keys"][key]["sorted"] = values
+    return ret
+
+def save_index(index, fname):
+    with open(index_path(fname), "w") as f:
+        json.dump(index, f)
+
+def _key_path(key):
+    node = parse_expr(key).node
+    if node.kind != "path":
+        raise ValueError("Index keys must be JSONPaths, not {}".format(key))
+    return node.value
+
+class FileIndex():
+    def __init__(self, data, size):
+        self.data = data
+        self.blocks = data["blocks"]
+        self.size = size
+        self.keys = data["keys"]
+        self._blooms = {}
+        self._sorted = {}
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Returns the index of @fname, or None if there is none or it is out
+        of date.
+        """
+        path = index_path(fname)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != INDEX_VERSION or data["file"] != _file_stamp(fname):
+            logger.warning("Ignoring out of date index %s", path)
+            return None
+        return cls(data, data["file"]["size"])
+
+    def _bloom(self, key, block):
+        if (key, block) not in self._blooms:
+            zone = self.keys[key]["zones"][block]
+            self._blooms[key, block] = BloomFilter.from_bytes(base64.b64decode(zone["bloom"]), zone["hashes"])
+        return self._blooms[key, block]
+
+    def _atom(self, key, op, value):
+        """
+        Candidates for records where `key op value` can hold.
+        """
+        value = _normalize(value)
+        if value is None:
+            return None
+        info = self.keys[key]
+        if op == "==" and "sorted" in info:
+            if key not in self._sorted:
+                self._sorted[key] = [_sort_key(v) for v, _ in info["sorted"]]
+            keys = self._sorted[key]
+            lo = bisect_left(keys, _sort_key(value))
+            hi = bisect_right(keys, _sort_key(value))
+            return ("lines", [offset for _, offset in info["sorted"][lo:hi]])
+
+        kind = "strings" if isinstance(value, str) else "numbers"
+        mask = []
+        for block, zone in enumerate(info["zones"]):
+            bounds = zone[kind]
+            if bounds is None:
+                # No value of this key in the block is comparable with @value.
+                mask.append(False)
+                continue
+            lo, hi = bounds
+            if op == "==":
+                mask.append(lo <= value <= hi and value in self._bloom(key, block))
+            elif op == "<":
+                mask.append(lo < value)
+            elif op == "<=":
+                mask.append(lo <= value)
+            elif op == ">":
+                mask.append(hi > value)
+            elif op == ">=":
+                mask.append(hi >= value)
+        return ("blocks", mask)
+
+    def _to_blocks(self, candidates):
+        if candidates[0] == "blocks":
+            return candidates[1]
+        mask = [False] * len(self.blocks)
+        for offset in candidates[1]:
+            mask[bisect_right(self.blocks, offset) - 1] = True
+        return mask
+
+    def _and(self, l, r):
+        if l is None or r is None:
+            return l if r is None else r
+        if l[0] == "lines" and r[0] == "lines":
+            return ("lines", sorted(set(l[1]) & set(r[1])))
+        if l[0] == "lines" or r[0] == "lines":
+            lines, blocks = (l, r) if l[0] == "lines" else (r, l)
+            mask = blocks[1]
+            return ("lines", [offset for offset in lines[1] if mask[bisect_right(self.blocks, offset) - 1]])
+        return ("blocks", [a and b for a, b in zip(l[1], r[1])])
+
+    def _or(self, l, r):
+        if l is None or r is None:
+            return None
+        if l[0] == "lines" and r[0] == "lines":
+            return ("lines", sorted(set(l[1]) | set(r[1])))
+        return ("blocks", [a or b for a, b in zip(self._to_blocks(l), self._to_blocks(r))])
+
+    _FLIP = {"<": ">", "<=": ">=", ">": "<", ">=": "<=", "==": "=="}
+
+    def _candidates(self, node):
+        """
+        Returns the lines or blocks where the expression @node may be
+        true, or None if the index can't tell.
+        """
+        if node.kind != "op":
+            return None
+        l, r = node.children
+        if node.value == "&&":
+            return self._and(self._candidates(l), self._candidates(r))
+        if node.value == "||":
+            return self._or(self._candidates(l), self._candidates(r))
+        if node.value not in self._FLIP:
+            return None
+        op = node.value
+        if l.kind == "const" and r.kind == "path":
+            l, r, op = r, l, self._FLIP[op]
+        if l.kind == "path" and r.kind == "const" and str(l.value) in self.keys:
+            return self._atom(str(l.value), op, r.value)
+        return None
+
+    def candidates(self, exprs, all_=False):
+        """
+        Returns the candidates ("lines", offsets) or ("blocks", mask) for
+        records that may match @exprs (from `parse_expr`), or None if
+        the whole file has to be scanned.
+        """
+        ret = None
+        for i, expr in enumerate(exprs):
+            candidates = self._candidates(expr.node)
+            if all_:
+                ret = self._and(ret, candidates)
+            else:
+                ret = candidates if i == 0 else self._or(ret, candidates)
+                if ret is None:
+                    return None
+        return ret
+
+    def read(self, fstream, candidates):
+        """
+        Yields the lines of @fstream selected by @candidates.
+        """
+        kind, values = candidates
+        if kind == "lines":
+            yield from read_ranges(fstream, ((offset, offset + 1) for offset in values))
+            return
+        yield from read_ranges(fstream, self._block_ranges(values))
+
+    def _block_ranges(self, mask):
+        # Runs of consecutive blocks are one range.
+        block = 0
+        while block < len(mask):
+            if not mask[block]:
+                block += 1
+                continue
+            end = block
+            while end < len(mask) and mask[end]:
+                end += 1
+            yield self.blocks[block], self.blocks[end] if end < len(self.blocks) else self.size
+            block = end
+
+def test_index(tmp_path):
+    fname = str(tmp_path / "test.jsonl")
+    objs = [{"id": i, "name": "n{:04d}".format(i % 500), "flag": i % 3 == 0, "x": [i]} for i in range(2000)]
+    objs[10]["id"] = "s"
+    with open(fname, "w") as f:
+        for obj in objs:
+            f.write(json.dumps(obj) + "\n")
+
+    save_index(build_index(fname, ["$.id", "$.name", "$.flag", "$.x"], block_size=100, sorted_keys=["$.name"]), fname)
+    index = FileIndex.load(fname)
+
+    def test(exprs, all_=False, blocks=None):
+        exprs = [parse_expr(expr) for expr in exprs]
+
+        def match(obj):
+            try:
+                return (all if all_ else any)(expr(obj) for expr in exprs)
+            except Exception:
+                return False
+
+        candidates = index.candidates(exprs, all_)
+        if candidates is None:
+            return None
+        with open(fname, "rb") as f:
+            lines = [json.loads(bytes(line)) for line in index.read(f, candidates)]
+        assert list(filter(match, lines)) == list(filter(match, objs))
+        if blocks is not None:
+            assert sum(index._to_blocks(candidates)) == blocks
+        return len(lines)
+
+    assert test(["$.id == 1234"], blocks=1) == 100
+    assert test(["1234 == $.id"], blocks=1) == 100
+    assert test(["$.id == \"s\""], blocks=1) == 100
+    assert test(["$.id >= 1950"], blocks=1) == 100
+    assert test(["$.id < 150 && $.id > 50"], blocks=2) == 200
+    assert test(["$.id < 150", "$.id > 1899"], blocks=3) == 300
+    assert test(["$.name == \"n0007\""]) == 4
+    assert test(["$.name == \"n0007\" && $.id > 1000"]) == 2
+    assert test(["$.name == \"n0007\" || $.id > 1950"], blocks=5) == 500
+    assert test(["$.flag == True && $.id < 10"], blocks=1) == 100
+    assert test(["$.id < 10", "$.x"], all_=True, blocks=1) == 100
+    assert test(["$.id < 10", "$.x"]) is None
+    assert test(["$.id != 10"]) is None
+
+    with open(fname, "a") as f:
+        f.write("{}\n")
+    assert FileIndex.load(fname) is None
+
+    # NaN (which the json module decodes) doesn't spoil the bounds of its block.
+    from .util import get_codec
+    fname = str(tmp_path / "nan.jsonl")
+    with open(fname, "w") as f:
+        f.write('{"x": NaN}\n{"x": 5}\n{"x": 1}\n{"x": 5}\n{"x": NaN}\n{"x": 1}\n{"x": NaN}\n')
+    index = build_index(fname, ["$.x"], block_size=3, codec=get_codec("json"))
+    assert [zone["numbers"] for zone in index["keys"]["$.x"]["zones"]] == [[1, 5], [1, 5], None]
+    save_index(index, fname)
+    index = FileIndex.load(fname)
+    for expr in ["$.x > 3", "$.x < 3", "$.x == 5"]:
+        assert sum(index._to_blocks(index.candidates([parse_expr(expr)]))) == 2
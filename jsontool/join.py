@@ -0,0 +1,205 @@
+"""
+Joins of two JSONL files by expression keys
+"""
+
+import logging
+from itertools import groupby
+from operator import itemgetter
+
+from .sort import ExternalSorter, DecodeErrors, DEFAULT_MEMORY, ENTRY_OVERHEAD, encode_key
+from .util import default_codec, RawJson
+
+logger = logging.getLogger(__name__)
+
+JOINS = ["inner", "left", "anti"]
+# Key of records with a null key value, which match nothing.
+_NO_KEY = b""
+
+def make_join_key(exprs, codec=None):
+    """
+    Returns a function mapping a line to (encoded key, record) for the
+    compiled @exprs, or (None, None) if the line doesn't decode. Records
+    with a null (or failing) key value get an empty key, which matches
+    nothing, as in SQL.
+    """
+    loads = (codec or default_codec()).loads
+
+    def _value(expr, obj):
+        try:
+            return expr(obj)
+        except Exception:
+            return None
+
+    def _key(line):
+        try:
+            obj = loads(line)
+        except ValueError:
+            return None, None
+        values = [_value(expr, obj) for expr in exprs]
+        if any(value is None for value in values):
+            return _NO_KEY, obj
+        return encode_key(*values), obj
+    return _key
+
+def _keyed(lines, key, errors):
+    for line in lines:
+        key_, obj = key(line)
+        if key_ is None:
+            errors.n += 1
+            continue
+        yield key_, bytes(line), obj
+
+def _build(pairs, memory, keys_only):
+    """
+    Reads (key, line) pairs into a hash table until it takes @memory
+    bytes. Returns the table and whether all pairs fit.
+    """
+    table, size = {}, 0
+    for key_, line in pairs:
+        if key_ == _NO_KEY:
+            continue
+        size += len(key_) + (0 if keys_only else len(line)) + ENTRY_OVERHEAD
+        if keys_only:
+            table[key_] = None
+        else:
+            table.setdefault(key_, []).append(line)
+        if size > memory:
+            return table, False
+    return table, True
+
+def _hash_join(probe, table, how):
+    for key_, line, obj in probe:
+        matches = table.get(key_)
+        if how == "anti":
+            if key_ not in table:
+                yield line, obj, None, None
+        elif matches:
+            for match in matches:
+                yield line, obj, match, None
+        elif how == "left":
+            yield line, obj, None, None
+
+def _groups(pairs):
+    for key_, group in groupby(pairs, itemgetter(0)):
+        yield key_, [line for _, line in group]
+
+def _merge_join(left, right, how):
+    # Both sides are sorted by key; the lines of one right key are held
+    # in memory at a time.
+    rights = _groups(right)
+    right_key, right_lines = next(rights, (None, None))
+    for key_, lines in _groups(left):
+        while right_key is not None and right_key < key_:
+            right_key, right_lines = next(rights, (None, None))
+        matches = right_lines if key_ != _NO_KEY and key_ == right_key else None
+        for line in lines:
+            if how == "anti":
+                if not matches:
+                    yield line, None, None, None
+            elif matches:
+                for match in matches:
+                    yield line, None, match, None
+            elif how == "left":
+                yield line, None, None, None
+
+def join_lines(left, right, left_key, right_key, how="inner", memory=DEFAULT_MEMORY, tmpdir=None, errors=None,
+               build="right"):
+    """
+    Joins the lines of @left and @right whose keys (see `make_join_key`)
+    are equal. Yields (left line, left record, right line, right record)
+    for each match, where the records are None unless already decoded and
+    the right line is None without a match: a left join also yields
+    unmatched left lines and an anti join yields only those.
+
+    The @build side (the right one, or for inner joins either) is read
+    into a hash table and the other side streamed past it, in input
+    order. If the build side takes more than @memory bytes, both sides are
+    sorted by key on disk instead (in @tmpdir) and merged, which yields
+    the lines in key order.
+    """
+    if how not in JOINS:
+        raise ValueError("Unknown join {}; expected one of {}".format(how, ", ".join(JOINS)))
+    errors = errors or DecodeErrors()
+    if build == "left":
+        if how != "inner":
+            raise ValueError("Only inner joins can build the hash table from the left side")
+        for line, obj, match, _ in join_lines(right, left, right_key, left_key, how, memory, tmpdir, errors):
+            yield match, None, line, obj
+        return
+    rights = ((key_, line) for key_, line, _ in _keyed(right, right_key, errors))
+    table, complete = _build(rights, memory, how == "anti")
+    lefts = _keyed(left, left_key, errors)
+    if complete:
+        yield from _hash_join(lefts, table, how)
+        return
+
+    logger.info("The right side doesn't fit in memory; joining with a sort-merge join on disk")
+    with ExternalSorter(memory // 2, tmpdir) as left_sorted, ExternalSorter(memory // 2, tmpdir) as right_sorted:
+        for key_, lines in table.items():
+            for line in (lines or [b""]):
+                right_sorted.add(key_, line)
+        del table
+        for key_, line in rights:
+            right_sorted.add(key_, line)
+        for key_, line, _ in lefts:
+            left_sorted.add(key_, line)
+        yield from _merge_join(left_sorted, right_sorted, how)
+
+def join_records(pairs, how="inner", schema=None, codec=None):
+    """
+    Maps the pairs of `join_lines` to joined records {"left": ...,
+    "right": ...} (right is null without a match), or to what @schema (a
+    compiled schema; see `parse_schema`) extracts from them. Without a
+    schema, anti joins keep the left lines as they are.
+    """
+    loads = (codec or default_codec()).loads
+    for line, obj, match, match_obj in pairs:
+        if schema is None and how == "anti":
+            yield RawJson(line)
+            continue
+        if match is not None and match_obj is None:
+            match_obj = loads(match)
+        record = {"left": loads(line) if obj is None else obj, "right": match_obj}
+        yield record if schema is None else schema(record)
+
+def test_join(tmp_path):
+    import json
+    from .expr import parse_expr
+    from .schema import parse_schema
+
+    left = [{"id": i % 7, "p": i} for i in range(20)] + [{"p": "no id"}]
+    right = [{"id": i, "g": i * 10} for i in range(0, 10, 2)] + [{"id": 4, "g": "again"}, {"id": None}]
+    left_lines = [json.dumps(obj).encode("utf-8") + b"\n" for obj in left] + [b"not json\n"]
+    right_lines = [json.dumps(obj).encode("utf-8") + b"\n" for obj in right]
+    key = make_join_key([parse_expr("$.id")])
+
+    def expected(how):
+        ret = []
+        for obj in left:
+            matches = [obj_ for obj_ in right if obj.get("id") is not None and obj_.get("id") == obj.get("id")]
+            if how == "anti":
+                ret += [] if matches else [obj]
+            else:
+                ret += [{"left": obj, "right": obj_} for obj_ in matches]
+                ret += [{"left": obj, "right": None}] if how == "left" and not matches else []
+        return ret
+
+    def key_order(records):
+        return sorted(records, key=lambda record: json.dumps(record.get("left", record).get("id")))
+
+    for how in JOINS:
+        errors = DecodeErrors()
+        records = [record.decode() if isinstance(record, RawJson) else record for record in
+                   join_records(join_lines(left_lines, right_lines, key, key, how, errors=errors), how)]
+        assert records == expected(how) and errors.n == 1
+        # With little memory, the sort-merge join yields the same records in key order.
+        records = [record.decode() if isinstance(record, RawJson) else record for record in
+                   join_records(join_lines(left_lines, right_lines, key, key, how, memory=400, tmpdir=str(tmp_path)), how)]
+        assert key_order(records) == key_order(expected(how))
+
+    records = list(join_records(join_lines(left_lines, right_lines, key, key, build="left")))
+    assert sorted(records, key=json.dumps) == sorted(expected("inner"), key=json.dumps)
+
+    schema = parse_schema({"p": "$.left.p", "g": "$.right.g"})
+    assert list(join_records(join_lines(left_lines[:3], right_lines, key, key), schema=schema)) == [
+        {"p": 0, "g": 0}, {"p": 2, "g": 20}]
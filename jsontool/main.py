@@ -4,125 +4,715 @@
 JSONtool
 """
 import re
-import pdb
+import io
+import os
 import time
 import sys
 import json
 import csv
 import logging
 from collections import defaultdict
-from pprint import pprint
+from functools import partial
+from itertools import chain, islice
 
-from tqdm import tqdm, trange
-from .expr import parse_expr
-from .util import load_jsonl, list_schema, list_obj, JsonWriter, load_csv
-from .schema import parse_schema, apply_schema
+from .util import load_jsonl, list_schema, list_obj, JsonWriter, CsvWriter, CODECS, set_default_codec
+from .util import default_codec, read_lines, load_projected, transform_lines, RawJson, list_columns, column_name
+from .util import open_input, open_output, set_writer_options
+from .parallel import map_file, map_lines, reduce_file, reduce_lines, is_seekable_file
+# Modules that only some commands need (and that import lark, jsonpath_ng
+# or pyarrow) are imported in those commands, to keep startup fast.
+from .stats import enable_stats, timed, timed_lines, add_exprs, count
 
 logger = logging.getLogger(__name__)
 
-def do_csv(args):
-    writer = csv.writer(args.output, delimiter=args.delimiter)
-    data = load_jsonl(args.input)
+def _progress(iterable, **kwargs):
+    """
+    Shows a progress bar over @iterable when stderr is a terminal; tqdm
+    is only imported then, as importing it takes tens of milliseconds.
+    """
+    if not sys.stderr.isatty():
+        return iterable
+    from tqdm import tqdm
+    return tqdm(iterable, **kwargs)
 
-    datum = next(data)
-    header = list_schema(datum)
+def _loader(paths, lazy):
+    """
+    Returns a function decoding a line; with @lazy, only the parts of the
+    record that @paths can reach are decoded.
+    """
+    codec = default_codec()
+    if lazy:
+        from .expr import projection
+        proj = projection(paths)
+        return timed("decode", lambda line: load_projected(line, proj, codec))
+    return timed("decode", codec.loads)
 
-    writer.writerow(header)
-    writer.writerow(list_obj(datum))
-   
-    for datum in tqdm(data):
-        writer.writerow(list_obj(datum))
+def _literals(exprs, all_):
+    """
+    Returns the byte strings that a line must contain to match @exprs.
+    """
+    from .expr import required_literals
+    literals = [required_literals(expr.node) for expr in exprs]
+    ret = set.union(*literals) if all_ else set.intersection(*literals)
+    return [literal.encode("utf-8") for literal in ret]
 
-def do_filter(args):
-    writer = JsonWriter(args.output)
-    exprs = [parse_expr(e) for e in args.exprs]
+def make_filter(exprs, all_=False, lazy=False, reserialize=False, batch_size=0, plan_sample=1000, prefilter=True):
+    from .expr import parse_expr
+    from .plan import FilterPlan
+    exprs = [parse_expr(e) for e in exprs]
+    add_exprs(exprs)
+    plan = FilterPlan(exprs, all_, plan_sample)
+    plan_ = timed("eval", plan)
+    literals = _literals(exprs, all_) if prefilter else []
+    loads = _loader([path for expr in exprs for path in expr.paths], lazy)
+    loads_all = default_codec().loads
 
-    for obj in tqdm(load_jsonl(args.input)):
+    def _output(line, obj):
+        if not reserialize:
+            return RawJson(line)
+        # Lazily decoded records are incomplete.
+        return loads_all(line) if lazy else obj
+
+    def _ret(line):
+        # Lines without the literal text of the patterns can't match.
+        if literals:
+            line_ = bytes(line)
+            if not all(literal in line_ for literal in literals):
+                return []
         try:
-            if args.all and all(expr(obj) for expr in exprs):
-                writer.write(obj)
-            elif any(expr(obj) for expr in exprs):
-                writer.write(obj)
-        except:
-            pass
+            obj = loads(line)
+        except ValueError:
+            plan.decode_errors += 1
+            return []
+        if plan_(obj):
+            return [_output(line, obj)]
+        return []
+    _ret.report = plan.report
+
+    if not batch_size:
+        return _ret
+
+    from .batch import compile_batch, batch_filter
+    exprs_ = [compile_batch(expr) for expr in exprs]
+    errors = [0] * len(exprs)
+    batch_filter_ = timed("eval", batch_filter, sampled=False)
+
+    def _ret_batch(lines):
+        objs, lines_ = [], []
+        for line in lines:
+            if literals and not all(literal in bytes(line) for literal in literals):
+                continue
+            try:
+                objs.append(loads(line))
+                lines_.append(line)
+            except ValueError:
+                plan.decode_errors += 1
+        mask = batch_filter_(exprs_, objs, all_, errors)
+        for predicate, n in zip(plan.predicates, errors):
+            predicate.errors += n
+        errors[:] = [0] * len(exprs)
+        return [_output(line, obj) for line, obj, match in zip(lines_, objs, mask) if match]
+    _ret_batch.batch_size = batch_size
+    _ret_batch.report = plan.report
+    return _ret_batch
+
+def make_extract(schema, expand_list=False, lazy=False):
+    from .schema import parse_schema, apply_schema, schema_paths, schema_exprs
+    schema = parse_schema(json.loads(schema))
+    add_exprs(schema_exprs(schema))
+    loads = _loader(schema_paths(schema), lazy)
+    apply_schema_ = timed("extract", apply_schema)
+
+    def _ret(line):
+        obj_ = apply_schema_(schema, loads(line))
+        if expand_list and isinstance(obj_, list):
+            return obj_
+        return [obj_]
+    return _ret
+
+def make_decode():
+    loads = timed("decode", default_codec().loads)
+    return lambda line: [loads(line)]
+
+def _following(args):
+    return getattr(args, "follow", False) or getattr(args, "checkpoint", None) is not None
+
+def _follower(args):
+    """
+    Returns a `FileFollower` of the input for --follow and --checkpoint,
+    resuming from the checkpoint, or None without them.
+    """
+    if not _following(args):
+        return None
+    if not is_seekable_file(args.input):
+        raise ValueError("--follow and --checkpoint need an uncompressed regular input file")
+    if getattr(args, "format", "jsonl") != "jsonl":
+        raise ValueError("--follow and --checkpoint only write jsonl")
+    if args.jobs > 1:
+        logger.warning("--follow and --checkpoint read the input in one process")
+        args.jobs = 1
+    from .follow import FileFollower, load_checkpoint
+    state = load_checkpoint(args.checkpoint) if args.checkpoint else None
+    return FileFollower.resume(args.input.name, state, follow=args.follow, poll_interval=args.poll_interval,
+                               idle_timeout=args.idle_timeout)
+
+def _checkpoint(args, writer, state):
+    # Everything read so far has been written once the writer is flushed.
+    writer.flush()
+    if args.checkpoint:
+        from .follow import save_checkpoint
+        save_checkpoint(args.checkpoint, state)
+
+def run(args, transform_factory, transform_args, writer_factory, data=None):
+    """
+    Writes `transform(line)` for every line of the input with a writer
+    from `writer_factory`. The transform is built by
+    `transform_factory(*transform_args)` so that worker processes can
+    rebuild it when `--jobs` is more than 1.
+    """
+    # Built here even when using workers so that bad expressions fail
+    # before any process is started.
+    transform = transform_factory(*transform_args)
+
+    follower = _follower(args)
+    if follower is not None:
+        data = follower
+    elif data is None:
+        data = read_lines(args.input)
+    data = timed_lines(data)
+
+    if args.jobs > 1:
+        if is_seekable_file(args.input):
+            chunks = map_file(args.input.name, transform_factory, transform_args, writer_factory,
+                              args.jobs, ordered=not args.unordered, codec=args.codec)
+        else:
+            # Pipes and compressed files are read here and sent to the workers.
+            chunks = map_lines(_progress(data), transform_factory, transform_args, writer_factory,
+                               args.jobs, codec=args.codec)
+        for chunk in chunks:
+            args.output.write(chunk)
+        return
+
+    writer = writer_factory(args.output)
+    write = timed("write", writer.write)
+    if follower is not None:
+        follower.on_checkpoint = partial(_checkpoint, args, writer)
+    try:
+        for obj in transform_lines(transform, _progress(data)):
+            write(obj)
+    except KeyboardInterrupt:
+        if follower is None:
+            raise
+        # Stopping --follow; lines since the last checkpoint are read again
+        # next time.
+    timed("flush", writer.close, sampled=False)()
+    if hasattr(transform, "report"):
+        transform.report()
+
+def _csv_columns(args, data):
+    """
+    Returns the columns to export and the lines of @data read to find them.
+    """
+    if args.schema_file and os.path.exists(args.schema_file):
+        with open(args.schema_file) as f:
+            return [tuple(path) for path in json.load(f)], []
+
+    loads = default_codec().loads
+    if args.sample:
+        lines = list(islice(data, args.sample))
+        columns = list_columns(map(loads, lines))
+    else:
+        if not is_seekable_file(args.input):
+            raise ValueError("--sample 0 needs a regular input file to read it twice")
+        lines = []
+        with open(args.input.name, "rb") as f:
+            columns = list_columns(map(loads, _progress(read_lines(f), desc="Schema")))
+
+    if args.schema_file:
+        with open(args.schema_file, "w") as f:
+            json.dump(columns, f)
+    return columns, lines
+
+def do_csv(args):
+    data = read_lines(args.input)
+    columns, lines = _csv_columns(args, data)
+    CsvWriter(args.output, delimiter=args.delimiter).writerow([column_name(path) for path in columns])
+
+    run(args, make_decode, (), partial(CsvWriter, delimiter=args.delimiter, columns=columns),
+        data=chain(lines, data))
+
+def _indexed_lines(args):
+    """
+    Returns the lines of the input that the index of the input file says
+    may match the filter, or None if there is no usable index.
+    """
+    if args.no_index or not is_seekable_file(args.input):
+        return None
+    from .expr import parse_expr
+    from .index import FileIndex
+    index = FileIndex.load(args.input.name)
+    if index is None:
+        return None
+    candidates = index.candidates([parse_expr(e) for e in args.exprs], args.all)
+    if candidates is None:
+        logger.info("The index of %s can't narrow down these expressions; scanning the whole file", args.input.name)
+        return None
+    return index.read(args.input, candidates)
+
+def do_filter(args):
+    if _following(args):
+        # Lines are checkpointed as they are written, which batches would delay.
+        args.batch_size = 0
+        args.no_index = True
+    data = _indexed_lines(args)
+    if data is not None and args.jobs > 1:
+        logger.info("Reading the lines selected by the index in one process")
+        args.jobs = 1
+    from .expr import parse_expr
+    literals = [] if args.no_prefilter else _literals([parse_expr(e) for e in args.exprs], args.all)
+    if data is None and literals and not _following(args):
+        # Only lines with the rarest-looking (longest) literal are read at all.
+        data = read_lines(args.input, contains=max(literals, key=len))
+    run(args, make_filter, (args.exprs, args.all, args.lazy, args.reserialize, args.batch_size, args.plan_sample,
+                            not args.no_prefilter), JsonWriter, data=data)
 
 def do_pp(args):
-    writer = JsonWriter(args.output, indent=args.indent)
+    run(args, make_decode, (), partial(JsonWriter, indent=args.indent))
 
-    for obj in load_jsonl(args.input):
-        writer.write(obj)
+def _output_writer(args):
+    """
+    Returns a writer factory for the output format of extract and export.
+    """
+    if args.format == "jsonl":
+        return JsonWriter
+    if args.jobs > 1:
+        logger.warning("--jobs only applies to jsonl output; writing %s in one process", args.format)
+        args.jobs = 1
+    from .columnar import ArrowWriter, arrow_schema
+    schema = None
+    if args.arrow_schema:
+        with open(args.arrow_schema) as f:
+            schema = arrow_schema(json.load(f))
+    return partial(ArrowWriter, format=args.format, schema=schema, row_group_size=args.row_group_size)
 
 def do_extract(args):
-    schema = parse_schema(json.loads(args.schema))
+    run(args, make_extract, (args.schema, args.expand_list, args.lazy), _output_writer(args))
 
-    writer = JsonWriter(args.output)
+def do_export(args):
+    if args.schema:
+        run(args, make_extract, (args.schema, args.expand_list, args.lazy), _output_writer(args))
+    else:
+        run(args, make_decode, (), _output_writer(args))
+
+def do_agg(args):
+    from .agg import Aggregator
+    agg = Aggregator(args.group, args.aggregates)
 
-    for obj in load_jsonl(args.input):
-        obj_ = apply_schema(schema, obj)
-        if args.expand_list and isinstance(obj_, list):
-            for elem in obj_:
-                writer.write(elem)
+    for fstream in args.merge_state:
+        agg.load_state(fstream)
+
+    for fstream in args.input:
+        if args.jobs > 1 and is_seekable_file(fstream):
+            for state in reduce_file(fstream.name, Aggregator, (args.group, args.aggregates),
+                                     args.jobs, codec=args.codec):
+                agg.merge(state)
+        elif args.jobs > 1:
+            for state in reduce_lines(_progress(timed_lines(read_lines(fstream))), Aggregator, (args.group, args.aggregates),
+                                      args.jobs, codec=args.codec):
+                agg.merge(state)
         else:
-            writer.write(obj_)
+            add_line = timed("aggregate", agg.add_line)
+            for line in _progress(timed_lines(read_lines(fstream))):
+                add_line(line)
+
+    agg.report()
+
+    if args.save_state:
+        agg.save_state(args.save_state)
+
+    writer = JsonWriter(args.output)
+    write = timed("write", writer.write)
+    for obj in agg.results():
+        write(obj)
+    writer.close()
+
+def do_index(args):
+    if not is_seekable_file(args.input):
+        raise ValueError("Only uncompressed regular files can be indexed")
+    from .index import build_index, save_index, index_path
+    index = build_index(args.input.name, args.keys, args.block_size, args.sorted)
+    save_index(index, args.input.name)
+    logger.info("Wrote %s", index_path(args.input.name))
 
 def do_import(args):
+    from .importer import CsvReader, convert_file, detect_format
+    format = args.format
+    if format == "auto":
+        format = detect_format(getattr(args.input, "name", "")) or "auto"
+    if format in ("parquet", "arrow"):
+        from .columnar import read_columnar
+        records = read_columnar(args.input, format)
+    else:
+        # With --strings, empty cells stay strings unless --null says otherwise, as before types were inferred.
+        nulls = args.null if args.null is not None else ([] if args.strings else [""])
+        records = CsvReader(args.input, format, args.delimiter, args.sample, nulls, not args.strings)
+        if args.jobs > 1 and is_seekable_file(args.input):
+            # Only a file that can't be split falls back to one process;
+            # errors while converting propagate, as they do there.
+            try:
+                chunks = convert_file(args.input.name, records, args.jobs, args.codec)
+            except ValueError as e:
+                logger.warning("%s", e)
+            else:
+                write = timed("write", args.output.write, sampled=False)
+                for chunk in chunks:
+                    write(chunk)
+                args.output.flush()
+                return
+        elif args.jobs > 1:
+            logger.warning("--jobs needs an uncompressed regular input file; importing in one process")
+    writer = JsonWriter(args.output)
+    write = timed("write", writer.write)
+    for obj in records:
+        write(obj)
+    writer.close()
+
+
+def _size(text):
+    """
+    Parses a size in bytes with an optional K, M or G suffix, e.g. 512M.
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def _sort_key(args):
+    from .expr import parse_expr
+    from .sort import make_key
+    exprs = [parse_expr(e) for e in args.keys]
+    add_exprs(exprs)
+    return timed("key", make_key(exprs, getattr(args, "reverse", False), args.lazy))
+
+def _write_lines(args, lines, errors):
     writer = JsonWriter(args.output)
+    write = timed("write", writer.write_raw)
+    for line in lines:
+        write(line)
+    writer.close()
+    if errors.n:
+        count("decode_errors", errors.n)
+        logger.warning("Skipped %d lines that are not valid JSON", errors.n)
+
+def do_sort(args):
+    from .sort import sort_lines, DecodeErrors
+    errors = DecodeErrors()
+    lines = _progress(timed_lines(read_lines(args.input)))
+    _write_lines(args, sort_lines(lines, _sort_key(args), args.buffer_size, args.temporary_directory, errors), errors)
 
-    if args.format == "csv":
-        for obj in load_csv(args.input, "\t"):
-            writer.write(obj)
+def do_dedup(args):
+    from .sort import dedup_lines, approx_dedup_lines, DecodeErrors
+    errors = DecodeErrors()
+    lines = _progress(timed_lines(read_lines(args.input)))
+    if args.approximate:
+        lines = approx_dedup_lines(lines, _sort_key(args), args.capacity, args.error, errors)
+    else:
+        lines = dedup_lines(lines, _sort_key(args), args.buffer_size, args.temporary_directory, errors)
+    _write_lines(args, lines, errors)
 
+def do_join(args):
+    from .expr import parse_expr
+    from .join import join_lines, join_records, make_join_key
+    from .sort import DecodeErrors
+    left_exprs = [parse_expr(e) for e in args.keys]
+    right_exprs = [parse_expr(e) for e in args.right_keys] if args.right_keys else left_exprs
+    if len(left_exprs) != len(right_exprs):
+        raise ValueError("Both sides need as many keys; got {} and {}".format(len(left_exprs), len(right_exprs)))
+    add_exprs(left_exprs + right_exprs)
+    schema = None
+    if args.schema:
+        from .schema import parse_schema, schema_exprs
+        schema = parse_schema(json.loads(args.schema))
+        add_exprs(schema_exprs(schema))
+        schema = timed("extract", schema)
+
+    right = open_input(args.right)
+    # Inner joins hash the smaller file.
+    build = "right"
+    if args.how == "inner" and is_seekable_file(args.input) and is_seekable_file(right) and \
+            os.fstat(args.input.fileno()).st_size < os.fstat(right.fileno()).st_size:
+        build = "left"
+    errors = DecodeErrors()
+    pairs = join_lines(_progress(timed_lines(read_lines(args.input))), read_lines(right),
+                       timed("key", make_join_key(left_exprs)), timed("key", make_join_key(right_exprs)),
+                       args.how, args.buffer_size, args.temporary_directory, errors, build)
+    writer = JsonWriter(args.output)
+    write = timed("write", writer.write)
+    for obj in join_records(pairs, args.how, schema):
+        write(obj)
+    writer.close()
+    if errors.n:
+        count("decode_errors", errors.n)
+        logger.warning("Skipped %d lines that are not valid JSON", errors.n)
+
+def do_split(args):
+    from .expr import parse_expr
+    from .split import ShardWriter, make_partition
+    expr = parse_expr(args.key)
+    add_exprs([expr])
+    partition = timed("key", make_partition(expr, args.shards, args.lazy))
+    writer = ShardWriter(args.pattern, args.max_open, args.shard_buffer, args.buffer_size, args.max_bytes)
+    write = timed("write", writer.write)
+    errors = 0
+    for line in _progress(timed_lines(read_lines(args.input))):
+        shard = partition(line)
+        if shard is None:
+            errors += 1
+            continue
+        write(shard, line)
+    writer.close()
+    logger.info("Wrote %d files", len(writer.paths))
+    if errors:
+        count("decode_errors", errors)
+        logger.warning("Skipped %d lines that are not valid JSON", errors)
+
+def _profile(args):
+    import cProfile
+    import pstats
+    profile = cProfile.Profile()
+    try:
+        profile.runcall(args.func, args)
+    finally:
+        if args.profile_file:
+            profile.dump_stats(args.profile_file)
+        else:
+            pstats.Stats(profile, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
 
 def main():
     logging.basicConfig(level=logging.INFO)
 
     import argparse
-    parser = argparse.ArgumentParser(description='jsontool: swiss army knife for JSONL files')
+    parser = argparse.ArgumentParser(description='jsontool: swiss army knife for JSONL files; gzip, bz2, xz and zstd inputs are decompressed and outputs named *.gz, *.bz2, *.xz or *.zst are compressed.')
+    parser.add_argument('--codec', choices=CODECS, default="auto", help="JSON backend to use; 'auto' decodes with the fastest one installed and encodes like the json module.")
+    parser.add_argument('--write-buffer-size', type=int, default=1 << 20, help="Write JSON output in blocks of this many bytes.")
+    parser.add_argument('--flush-interval', type=float, help="Also write buffered JSON output when this many seconds have passed since the last write. Without --writer-thread, this is only checked when the next record is written.")
+    parser.add_argument('--writer-thread', action='store_true', help="Write JSON output from a background thread, so that encoding overlaps with slow outputs.")
+    parser.add_argument('--stats', action='store_true', help="Report the time spent reading, decoding, evaluating expressions and writing, record and byte counts, swallowed errors and the slowest expression nodes to stderr. With --jobs, stages run in workers aren't timed.")
+    parser.add_argument('--stats-file', type=str, help="With --stats, write the statistics to this file as JSON instead.")
+    parser.add_argument('--profile', action='store_true', help="Run under cProfile and print the functions with the most cumulative time to stderr.")
+    parser.add_argument('--profile-file', type=str, help="With --profile, save the profile to this file instead (see pstats).")
     parser.set_defaults(func=None)
 
+    def add_parallel_arguments(command_parser):
+        command_parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of worker processes to use (requires a regular input file).")
+        command_parser.add_argument('-U', '--unordered', action='store_true', help="With --jobs, write results as workers finish instead of in input order.")
+
+    def add_follow_arguments(command_parser):
+        command_parser.add_argument('-F', '--follow', action='store_true', help="Keep reading the input file as it grows, like tail -F: a truncated file is read again from the start, and a rotated one to its end before the new file.")
+        command_parser.add_argument('--checkpoint', type=str, help="Resume from the input offset saved in this file, and save it whenever the output is flushed. Lines read since the last checkpoint of an interrupted run are processed again.")
+        command_parser.add_argument('--poll-interval', type=float, default=1., help="With --follow, seconds between checks for new data.")
+        command_parser.add_argument('--idle-timeout', type=float, help="With --follow, stop after this many seconds without new data.")
+
+    def add_format_arguments(command_parser, default="jsonl"):
+        command_parser.add_argument('-f', '--format', choices=["jsonl", "parquet", "arrow"], default=default, help="Output format; parquet and arrow (IPC file) need pyarrow.")
+        command_parser.add_argument('--arrow-schema', type=str, help="JSON file with the Arrow types of the output fields, shaped like the schema, e.g. {\"id\": \"int64\", \"tags\": [\"string\"]}; inferred from the first row group by default.")
+        command_parser.add_argument('--row-group-size', type=int, default=65536, help="Number of records per Parquet row group or Arrow record batch.")
+
     subparsers = parser.add_subparsers()
     command_parser = subparsers.add_parser('csv', help='Convert to csv')
-    command_parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Output CSV file")
+    command_parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer, help="Output CSV file")
     command_parser.add_argument('-d', '--delimiter', default='\t', help="Delimiter to use to both parse input and write output.")
-    command_parser.add_argument('-i', '--input', type=argparse.FileType('r'), default=sys.stdin, help="Input JSONL file")
+    command_parser.add_argument('-n', '--sample', type=int, default=1000, help="Number of records to read to find the columns (0 reads the whole input first). Fields outside of these records are not exported.")
+    command_parser.add_argument('-S', '--schema-file', type=str, help="Read the columns from this file if it exists; otherwise save the columns found to it.")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="Input JSONL file")
+    add_parallel_arguments(command_parser)
     command_parser.set_defaults(func=do_csv)
 
     command_parser = subparsers.add_parser('filter', help='Filter json objects')
-    command_parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Output JSONL file")
+    command_parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer, help="Output JSONL file")
     command_parser.add_argument('-e', '--exprs', type=str, nargs="+", required=True, help="Filter expressions.")
     command_parser.add_argument('-a', '--all', action="store_true", help="Do all expressions have to match?")
-    command_parser.add_argument('-i', '--input', type=argparse.FileType('r'), default=sys.stdin, help="Input JSONL file")
+    command_parser.add_argument('-L', '--lazy', action="store_true", help="Only decode the fields the expressions use; helps when records have large unused fields.")
+    command_parser.add_argument('-b', '--batch-size', type=int, default=0, help="Evaluate expressions with NumPy over blocks of this many records (0 evaluates one record at a time).")
+    command_parser.add_argument('-R', '--reserialize', action="store_true", help="Re-encode matching objects instead of writing their input lines unchanged.")
+    command_parser.add_argument('--plan-sample', type=int, default=1000, help="Order the expressions by their cost and pass rate over this many records (and again every 100000 records); 0 keeps an order estimated from the expressions alone. An expression that raises on a record counts as not matching it.")
+    command_parser.add_argument('--no-prefilter', action="store_true", help="Decode every line, even lines that lack the literal text a match/find pattern requires (which assumes the input escapes no ASCII letters, digits or spaces).")
+    command_parser.add_argument('--no-index', action="store_true", help="Scan the whole input even if it has an up to date index (see the index command).")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="Input JSONL file")
+    add_parallel_arguments(command_parser)
+    add_follow_arguments(command_parser)
     command_parser.set_defaults(func=do_filter)
 
+    command_parser = subparsers.add_parser('index', help='Index a JSONL file so that filter can skip records that cannot match')
+    command_parser.add_argument('-k', '--keys', type=str, nargs="+", required=True, help="JSONPaths to index, e.g. $.id; filter uses the index for comparisons of these paths with constants.")
+    command_parser.add_argument('-B', '--block-size', type=int, default=1024, help="Number of lines per indexed block.")
+    command_parser.add_argument('-S', '--sorted', type=str, nargs="+", default=[], help="Keys to also index line by line, for exact lookups of selective values.")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), required=True, help="Input JSONL file")
+    command_parser.set_defaults(func=do_index)
+
     command_parser = subparsers.add_parser('import', help='Import from another file format')
-    command_parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Output JSONL file")
-    command_parser.add_argument('-f', '--format', choices=["csv"], default="csv", help="Which file format to use.")
-    command_parser.add_argument('-i', '--input', type=argparse.FileType('r'), default=sys.stdin, help="Input JSONL file")
+    command_parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer, help="Output JSONL file")
+    command_parser.add_argument('-f', '--format', choices=["auto", "csv", "tsv", "parquet", "arrow"], default="auto", help="Input format; auto detects it from the file extension, and the CSV dialect from the contents. parquet and arrow (IPC file or stream) need pyarrow.")
+    command_parser.add_argument('-d', '--delimiter', type=str, help="Delimiter of CSV input, overriding that of the format.")
+    command_parser.add_argument('-n', '--sample', type=int, default=1000, help="Number of CSV rows to infer column types from; cells that don't have the type of their column keep their own.")
+    command_parser.add_argument('--null', type=str, nargs="*", help="CSV cells that are null; defaults to empty cells, or none with --strings.")
+    command_parser.add_argument('--strings', action='store_true', help="Keep all CSV cells strings instead of inferring types.")
+    command_parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of worker processes to convert a CSV file with (requires a regular input file).")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="Input CSV, TSV, Parquet or Arrow file")
     command_parser.set_defaults(func=do_import)
 
+    def add_sort_arguments(command_parser):
+        command_parser.add_argument('-S', '--buffer-size', type=_size, default="512M", help="Memory to sort in, e.g. 512M or 2G; larger inputs are sorted in runs on disk that are then merged.")
+        command_parser.add_argument('-T', '--temporary-directory', type=str, help="Directory for the sorted runs; defaults to $TMPDIR or /tmp.")
+        command_parser.add_argument('-L', '--lazy', action="store_true", help="Only decode the fields the keys use; helps when records have large unused fields.")
+
+    command_parser = subparsers.add_parser('sort', help='Sort records by keys, on disk if they do not fit in memory')
+    command_parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer, help="Output JSONL file")
+    command_parser.add_argument('-k', '--keys', type=str, nargs="+", required=True, help="Expressions to sort by, e.g. $.user $.time. Values of different types sort as null < false < true < numbers < strings < lists < dicts; records with equal keys stay in input order.")
+    command_parser.add_argument('-r', '--reverse', action='store_true', help="Sort in descending order.")
+    add_sort_arguments(command_parser)
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="Input JSONL file")
+    command_parser.set_defaults(func=do_sort)
+
+    command_parser = subparsers.add_parser('dedup', help='Keep the first record with each key')
+    command_parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer, help="Output JSONL file")
+    command_parser.add_argument('-k', '--keys', type=str, nargs="+", default=[], help="Expressions that identify a record, e.g. $.id; defaults to the whole record (regardless of the order of its fields).")
+    add_sort_arguments(command_parser)
+    command_parser.add_argument('-A', '--approximate', action='store_true', help="Remember keys in a bloom filter of fixed size instead of exactly; some unique records are dropped as duplicates.")
+    command_parser.add_argument('--capacity', type=int, default=10000000, help="With --approximate, the number of distinct keys to size the filter for.")
+    command_parser.add_argument('--error', type=float, default=0.001, help="With --approximate, the fraction of unique records dropped up to --capacity keys.")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="Input JSONL file")
+    command_parser.set_defaults(func=do_dedup)
+
+    command_parser = subparsers.add_parser('join', help='Join the records of two files by keys')
+    command_parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer, help="Output JSONL file")
+    command_parser.add_argument('-r', '--right', type=argparse.FileType('rb'), required=True, help="JSONL file to join the input with")
+    command_parser.add_argument('-k', '--keys', type=str, nargs="+", required=True, help="Expressions to join by, e.g. $.id; records with a null key match nothing.")
+    command_parser.add_argument('-K', '--right-keys', type=str, nargs="+", help="Expressions to join by on the right side, if they differ from --keys.")
+    command_parser.add_argument('-t', '--how', choices=["inner", "left", "anti"], default="inner", help="inner writes each pair of matching records, left also input records without a match, and anti only those.")
+    command_parser.add_argument('-s', '--schema', type=str, help="Schema to extract (see extract) from each joined record {\"left\": ..., \"right\": ...}, e.g. {\"id\": \"$.left.id\", \"gold\": \"$.right.label\"}. Without one, joined records are written, or the input records of an anti join.")
+    command_parser.add_argument('-S', '--buffer-size', type=_size, default="512M", help="Memory for the hash table of the smaller side (the right one for left and anti joins); past it, both sides are sorted on disk and merged, and the output is in key order.")
+    command_parser.add_argument('-T', '--temporary-directory', type=str, help="Directory for sorted runs; defaults to $TMPDIR or /tmp.")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="Input (left) JSONL file")
+    command_parser.set_defaults(func=do_join)
+
+    command_parser = subparsers.add_parser('split', help='Split records into many files by key in one pass')
+    command_parser.add_argument('-o', '--output-pattern', dest="pattern", type=str, required=True, help="Names of the output files, with {shard} replaced by the shard (and {part} by the part, with --max-bytes), e.g. parts/{shard:04d}.jsonl.gz or by-user/{shard}.jsonl. Directories are created as needed.")
+    command_parser.add_argument('-k', '--key', type=str, required=True, help="Expression to split by, e.g. $.user.")
+    command_parser.add_argument('-n', '--shards', type=int, help="Hash keys into this many numbered shards; without it, each key value gets its own file, named after the value.")
+    command_parser.add_argument('--max-bytes', type=_size, help="Start the next part of a shard once a file would grow past this size, e.g. 1G; the pattern needs a {part} field.")
+    command_parser.add_argument('--max-open', type=int, default=256, help="Files to keep open at once; others are closed and reopened to append.")
+    command_parser.add_argument('--shard-buffer', type=_size, default="256K", help="Bytes to buffer per shard before writing them (as one compressed block, for compressed outputs).")
+    command_parser.add_argument('-S', '--buffer-size', type=_size, default="256M", help="Memory to buffer across all shards; past it, every buffer is written.")
+    command_parser.add_argument('-L', '--lazy', action="store_true", help="Only decode the fields the key uses; helps when records have large unused fields.")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="Input JSONL file")
+    command_parser.set_defaults(func=do_split)
+
     command_parser = subparsers.add_parser('pp', help='Pretty print')
-    command_parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Output JSONL file")
+    command_parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer, help="Output JSONL file")
     command_parser.add_argument('-t', '--indent', type=int, default=2, help="Indentation")
-    command_parser.add_argument('-i', '--input', type=argparse.FileType('r'), default=sys.stdin, help="Input JSONL file")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="Input JSONL file")
+    add_parallel_arguments(command_parser)
     command_parser.set_defaults(func=do_pp)
 
     command_parser = subparsers.add_parser('extract', help='Extract fields from a JSON')
-    command_parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Output JSONL file")
+    command_parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer, help="Output JSONL file")
     command_parser.add_argument('-s', '--schema', type=str, required=True, help="Schema to parse.")
     command_parser.add_argument('-E', '--expand-list', action='store_true', help="Expand lists.")
-    command_parser.add_argument('-i', '--input', type=argparse.FileType('r'), default=sys.stdin, help="Input JSONL file")
+    command_parser.add_argument('-L', '--lazy', action="store_true", help="Only decode the fields the schema uses; helps when records have large unused fields.")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="Input JSONL file")
+    add_parallel_arguments(command_parser)
+    add_format_arguments(command_parser)
+    add_follow_arguments(command_parser)
     command_parser.set_defaults(func=do_extract)
 
+    command_parser = subparsers.add_parser('export', help='Write records, or the fields of a schema, in another format')
+    command_parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer, help="Output file")
+    command_parser.add_argument('-s', '--schema', type=str, help="Schema to extract (see extract); defaults to the whole record.")
+    command_parser.add_argument('-E', '--expand-list', action='store_true', help="Expand lists.")
+    command_parser.add_argument('-L', '--lazy', action="store_true", help="Only decode the fields the schema uses; helps when records have large unused fields.")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="Input JSONL file")
+    add_parallel_arguments(command_parser)
+    add_format_arguments(command_parser, default="parquet")
+    command_parser.set_defaults(func=do_export)
+
+    command_parser = subparsers.add_parser('agg', help='Aggregate values across records, optionally by group')
+    command_parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer, help="Output JSONL file")
+    command_parser.add_argument('-g', '--group', type=str, nargs="+", default=[], help="Expressions to group records by.")
+    command_parser.add_argument('-a', '--aggregates', type=str, nargs="+", required=True, help="Aggregates as [name=]aggregate[:expr], e.g. count, mean:$.score or lat=p99:$.latency. Aggregates are count, sum, mean, var, std, min, max, median, pNN (approximate) and distinct (approximate).")
+    command_parser.add_argument('-s', '--save-state', type=argparse.FileType('wb'), help="Also save the aggregation state to this file so it can be merged later.")
+    command_parser.add_argument('-m', '--merge-state', type=argparse.FileType('rb'), nargs="+", default=[], help="Merge in states saved with --save-state.")
+    command_parser.add_argument('-i', '--input', type=argparse.FileType('rb'), nargs="*", default=[sys.stdin.buffer], help="Input JSONL files")
+    command_parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of worker processes to use (requires regular input files).")
+    command_parser.set_defaults(func=do_agg)
+
     args = parser.parse_args()
     if args.func is None:
         parser.print_help()
         sys.exit(1)
     else:
+        set_default_codec(args.codec)
+        set_writer_options(buffer_size=args.write_buffer_size, flush_interval=args.flush_interval,
+                           threaded=args.writer_thread)
+        # Compressed inputs are detected from their contents and compressed
+        # outputs from their extension.
+        if isinstance(getattr(args, "input", None), list):
+            args.input = [open_input(fstream) for fstream in args.input]
+        elif getattr(args, "input", None) is not None:
+            args.input = open_input(args.input)
+        output = getattr(args, "output", None)
+        if output is not None:
+            args.output = open_output(output)
+        compressed = args.output if output is not None and args.output is not output else None
+        stats = enable_stats() if args.stats else None
+        if stats is not None:
+            if is_seekable_file(getattr(args, "input", None)):
+                stats.counts["input_bytes"] = os.fstat(args.input.fileno()).st_size
+            if output is not None:
+                args.output = stats.output(args.output)
         try:
-            args.func(args)
+            if args.profile:
+                _profile(args)
+            else:
+                args.func(args)
+            if compressed is not None:
+                compressed.close()
+            if stats is not None:
+                stats.report(args.stats_file)
         except BrokenPipeError:
             sys.stderr.write("Unexpected broken pipe\n")
-            pass
+            # Python flushes stdout again on exit, which would raise again.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+
+def test_make_filter():
+    lines = [b'{"a":1,"b":1.0e2}\n', b'{"a":0}\n', b'{"a":"x"}\n']
+
+    def test(*args):
+        transform = make_filter(*args)
+        output = io.BytesIO()
+        writer = JsonWriter(output)
+        for line in lines:
+            for obj in transform(line):
+                writer.write(obj)
+        writer.close()
+        return output.getvalue()
+
+    assert test(["$.a > 0"]) == lines[0]
+    assert test(["$.a > 0"], False, True) == lines[0]
+    assert test(["$.a > 0"], False, False, True) == b'{"a": 1, "b": 100.0}\n'
+    assert test(["$.a > 0"], False, True, True) == b'{"a": 1, "b": 100.0}\n'
+    assert test(["$.a > 0", "$.a == 0"]) == lines[0] + lines[1]
+    assert test(["$.a > 0", "$.a == 0"], True) == b""
+
+    transform = make_filter(["$.a > 0", "$.a == 0"], False, False, False, 2)
+    assert [obj.data for obj in transform_lines(transform, lines)] == lines[:2]
+
+    lines = [b'{"a": "hello world"}\n', b'{"a": "hello"}\n', b'{"b": "world", "a": 1}\n']
+    assert test(['find("world", $.a)']) == lines[0]
+    assert test(['find("world", $.a)', 'find("hel+o", $.a)']) == lines[0] + lines[1]
+    assert test(['find("world", $.a)', 'find("hel+o", $.a)'], True) == lines[0]
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,197 @@
+"""
+Process pool over newline-aligned byte ranges of a JSONL file, or over
+blocks of lines from a stream
+"""
+
+import io
+import os
+import logging
+from collections import deque
+
+from .util import read_lines, transform_lines, set_default_codec, set_writer_options
+from .stats import disable_stats
+
+logger = logging.getLogger(__name__)
+
+# Aim for chunks of about this many bytes, but at least a few per job so
+# that slow chunks don't leave the other workers idle.
+CHUNK_SIZE = 32 * 1024 * 1024
+CHUNKS_PER_JOB = 4
+# Size of the blocks of lines sent to workers from streams.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+def chunk_ranges(fname, n_chunks):
+    """
+    Splits @fname into at most @n_chunks (start, end) byte ranges that
+    each begin at the start of a line.
+    """
+    size = os.path.getsize(fname)
+    starts = [0]
+    with open(fname, "rb") as f:
+        for i in range(1, n_chunks):
+            offset = size * i // n_chunks
+            if offset <= starts[-1]:
+                continue
+            f.seek(offset - 1)
+            f.readline()
+            offset = f.tell()
+            if offset >= size:
+                break
+            if offset > starts[-1]:
+                starts.append(offset)
+    return list(zip(starts, starts[1:] + [size]))
+
+def read_range(fname, start, end):
+    """
+    Yields the lines of @fname that start in [@start, @end).
+    """
+    with open(fname, "rb") as f:
+        yield from read_lines(f, start, end)
+
+def is_seekable_file(stream):
+    try:
+        return stream.seekable() and os.path.isfile(stream.name)
+    except (AttributeError, TypeError, ValueError, OSError):
+        return False
+
+_WORKER = None
+
+def _init_worker(transform_factory, transform_args, writer_factory, codec):
+    global _WORKER
+    set_default_codec(codec)
+    # Workers write to memory, where buffering by time or in a thread doesn't help.
+    set_writer_options(flush_interval=None, threaded=False)
+    # Forked workers would otherwise time into a copy that is never reported.
+    disable_stats()
+    _WORKER = (transform_factory(*transform_args), writer_factory)
+
+def _task_lines(task):
+    """
+    Returns the lines of a task: a byte range of a file or a block of
+    lines sent by the parent.
+    """
+    if isinstance(task, bytes):
+        return read_lines(io.BytesIO(task))
+    return read_range(*task)
+
+def _process_range(task):
+    transform, writer_factory = _WORKER
+
+    output = io.BytesIO()
+    writer = writer_factory(output)
+    for obj in transform_lines(transform, _task_lines(task)):
+        writer.write(obj)
+    writer.close()
+    if hasattr(transform, "report"):
+        transform.report()
+    return output.getvalue()
+
+def _tasks(fname, jobs):
+    size = os.path.getsize(fname)
+    n_chunks = max(jobs * CHUNKS_PER_JOB, size // CHUNK_SIZE)
+    return [(fname, start, end) for start, end in chunk_ranges(fname, n_chunks)]
+
+def map_file(fname, transform_factory, transform_args, writer_factory, jobs, ordered=True, codec="auto"):
+    """
+    Applies a per-record transform to @fname in @jobs worker processes.
+
+    Each worker builds its transform with
+    `transform_factory(*transform_args)`; the transform maps an input
+    line to an iterable of output records, which are written with a writer made
+    by `writer_factory(stream)`. Yields the output bytes of each chunk, in
+    input order unless @ordered is False.
+    """
+    import multiprocessing
+    with multiprocessing.Pool(jobs, initializer=_init_worker,
+                              initargs=(transform_factory, transform_args, writer_factory, codec)) as pool:
+        map_ = pool.imap if ordered else pool.imap_unordered
+        yield from map_(_process_range, _tasks(fname, jobs))
+
+def _blocks(lines, size=BLOCK_SIZE):
+    """
+    Joins @lines into blocks of about @size bytes.
+    """
+    block, n = [], 0
+    for line in lines:
+        block.append(line)
+        n += len(line)
+        if n >= size:
+            yield b"".join(block)
+            block, n = [], 0
+    if block:
+        yield b"".join(block)
+
+def _bounded_map(pool, fn, tasks, window):
+    """
+    Like `pool.imap`, but only reads @window tasks ahead, so that a large
+    stream of tasks isn't all buffered in memory.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(fn, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def map_lines(lines, transform_factory, transform_args, writer_factory, jobs, codec="auto"):
+    """
+    Like `map_file`, but for lines from a stream that can't be split
+    (a pipe or a compressed file): the parent sends blocks of lines to
+    the workers. Yields the output bytes of each block in input order.
+    """
+    import multiprocessing
+    with multiprocessing.Pool(jobs, initializer=_init_worker,
+                              initargs=(transform_factory, transform_args, writer_factory, codec)) as pool:
+        yield from _bounded_map(pool, _process_range, _blocks(lines), 2 * jobs)
+
+def _init_reducer(reducer_factory, reducer_args, codec):
+    global _WORKER
+    set_default_codec(codec)
+    disable_stats()
+    _WORKER = reducer_factory(*reducer_args)
+
+def _reduce_range(task):
+    reducer = _WORKER
+
+    reducer.reset()
+    for line in _task_lines(task):
+        reducer.add_line(line)
+    if hasattr(reducer, "report"):
+        reducer.report()
+    return reducer.state
+
+def reduce_file(fname, reducer_factory, reducer_args, jobs, codec="auto"):
+    """
+    Feeds @fname to reducers (e.g. `agg.Aggregator`) in @jobs worker
+    processes and yields the `state` of each chunk, in input order, for
+    the caller to merge.
+    """
+    import multiprocessing
+    with multiprocessing.Pool(jobs, initializer=_init_reducer,
+                              initargs=(reducer_factory, reducer_args, codec)) as pool:
+        yield from pool.imap(_reduce_range, _tasks(fname, jobs))
+
+def reduce_lines(lines, reducer_factory, reducer_args, jobs, codec="auto"):
+    """
+    Like `reduce_file` for lines from a stream that can't be split.
+    """
+    import multiprocessing
+    with multiprocessing.Pool(jobs, initializer=_init_reducer,
+                              initargs=(reducer_factory, reducer_args, codec)) as pool:
+        yield from _bounded_map(pool, _reduce_range, _blocks(lines), 2 * jobs)
+
+def test_chunk_ranges(tmp_path):
+    fname = str(tmp_path / "test.jsonl")
+    lines = [b'{"a": %d}\n' % i for i in range(100)]
+    with open(fname, "wb") as f:
+        f.writelines(lines)
+
+    for n_chunks in [1, 2, 7, 100, 1000]:
+        ranges = chunk_ranges(fname, n_chunks)
+        assert len(ranges) <= n_chunks
+        assert [bytes(line) for start, end in ranges for line in read_range(fname, start, end)] == lines
+
+    blocks = list(_blocks(iter(lines), 100))
+    assert len(blocks) == 10 and b"".join(blocks) == b"".join(lines)
+    assert [bytes(line) for block in blocks for line in _task_lines(block)] == lines
@@ -0,0 +1,170 @@
+"""
+Ordering of filter predicates by cost and selectivity
+"""
+
+import time
+import logging
+
+from .expr import _singular_keys, _REGEX_FUNCTIONS
+from .stats import count
+
+logger = logging.getLogger(__name__)
+
+# Maps run their function on every element of a list.
+_MAP_FACTOR = 10
+
+def estimate_cost(node):
+    """
+    A rough relative cost of evaluating @node, used to order predicates
+    before their timings are known.
+    """
+    children = sum(estimate_cost(child) for child in node.children)
+    if node.kind == "const":
+        return 0
+    if node.kind == "path":
+        if _singular_keys(node.value.path) is not None:
+            return 1
+        # Compiled multi-match paths (`..`, `*`) vs. jsonpath_ng.
+        return 5 if node.value.getter != node.value._find else 50
+    fn_cost = 20 if node.value in _REGEX_FUNCTIONS else 1
+    if node.kind == "map":
+        return children + _MAP_FACTOR * fn_cost
+    if node.kind in ("reduce", "apply"):
+        return children + fn_cost
+    return children + 1
+
+class Predicate():
+    def __init__(self, expr):
+        self.expr = expr
+        self.cost = estimate_cost(expr.node)
+        self.errors = 0
+        self.error = None
+        self.reset()
+
+    def reset(self):
+        # Statistics of the current sampling window.
+        self.evals = 0
+        self.passes = 0
+        self.time = 0.
+
+    def __call__(self, obj):
+        """
+        Returns whether @obj passes; an expression that raises doesn't
+        pass and is counted as an error.
+        """
+        try:
+            return bool(self.expr(obj))
+        except Exception as e:
+            self.errors += 1
+            if self.error is None:
+                self.error = e
+            return False
+
+    def rank(self, all_):
+        """
+        Predicates are best evaluated in increasing rank: cost per record
+        decided (rejected for `all`, accepted for `any`).
+        """
+        cost = self.time / self.evals if self.evals else self.cost
+        passes = (self.passes + 1) / (self.evals + 2)
+        return cost / ((1 - passes) if all_ else passes)
+
+class FilterPlan():
+    """
+    Evaluates filter expressions on objects, in the order that minimizes
+    expected cost: the order starts from `estimate_cost` and is
+    recomputed from the timings and pass rates of every predicate over
+    @sample_size records, and again every @interval records so that it
+    follows drifting data. With @sample_size 0 the static order is kept.
+    """
+    def __init__(self, exprs, all_=False, sample_size=1000, interval=100000):
+        self.predicates = [Predicate(expr) for expr in exprs]
+        self.all = all_
+        self.sample_size = sample_size if len(self.predicates) > 1 else 0
+        self.interval = interval
+        self.order = sorted(self.predicates, key=lambda p: p.rank(all_))
+        self.count = 0
+        self.decode_errors = 0
+
+    def _sample(self, obj):
+        ret = []
+        for predicate in self.predicates:
+            start = time.perf_counter()
+            value = predicate(obj)
+            predicate.time += time.perf_counter() - start
+            predicate.evals += 1
+            predicate.passes += value
+            ret.append(value)
+        return all(ret) if self.all else any(ret)
+
+    def _replan(self):
+        order = sorted(self.predicates, key=lambda p: p.rank(self.all))
+        if order != self.order:
+            logger.debug("Filter order is now %s", [str(p.expr.expr) for p in order])
+        self.order = order
+        for predicate in self.predicates:
+            predicate.reset()
+
+    def __call__(self, obj):
+        position = self.count % self.interval
+        self.count += 1
+        if position < self.sample_size:
+            ret = self._sample(obj)
+            if position == self.sample_size - 1:
+                self._replan()
+            return ret
+        if self.all:
+            for predicate in self.order:
+                if not predicate(obj):
+                    return False
+            return True
+        for predicate in self.order:
+            if predicate(obj):
+                return True
+        return False
+
+    def report(self):
+        """
+        Logs and resets the error counts.
+        """
+        count("decode_errors", self.decode_errors)
+        count("expression_errors", sum(predicate.errors for predicate in self.predicates))
+        if self.decode_errors:
+            logger.warning("Skipped %d lines that are not valid JSON", self.decode_errors)
+        for predicate in self.predicates:
+            if predicate.errors:
+                logger.warning("%d records raised in %s (e.g. %s: %s)", predicate.errors, predicate.expr.expr,
+                               type(predicate.error).__name__, predicate.error)
+        self.decode_errors = 0
+        for predicate in self.predicates:
+            predicate.errors = 0
+            predicate.error = None
+
+def test_filter_plan():
+    from .expr import parse_expr
+
+    exprs = [parse_expr(e) for e in ["mean(len{$.xs}) > 1", "find(\"x\", $.s)", "$.a > 5", "$.b"]]
+    assert [estimate_cost(expr.node) for expr in exprs] == [13, 21, 2, 1]
+
+    objs = [{"a": i, "b": i % 2, "xs": ["ab", "c"], "s": "xyz" if i % 3 else "y"} for i in range(100)] + [{"a": "x"}]
+    for all_ in [True, False]:
+        plan = FilterPlan(exprs, all_, sample_size=10, interval=50)
+        expected = []
+        for obj in objs:
+            values = []
+            for expr in exprs:
+                try:
+                    values.append(bool(expr(obj)))
+                except Exception:
+                    values.append(False)
+            expected.append((all if all_ else any)(values))
+        assert [plan(obj) for obj in objs] == expected
+
+    # "$.a > 5" rejects nothing here, so "$.b" (which rejects half) goes first.
+    plan = FilterPlan(exprs[2:], True, sample_size=10)
+    for obj in objs[10:20]:
+        plan(obj)
+    assert [p.expr.expr for p in plan.order] == ["$.b", "$.a > 5"]
+    # Errors are counted per expression.
+    assert not plan({"a": "x", "b": 1})
+    assert [p.errors for p in plan.predicates] == [1, 0]
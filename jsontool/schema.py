@@ -4,17 +4,216 @@
 Extract schema
 """
 
-import pdb
-from .expr import parse_expr
+from .expr import parse_expr, _Compiler, _jp, _keys_getter, _compile_steps, _descendants_step, _condense, _is_literal
 
-def parse_schema(obj):
+def _parse_leaves(obj):
     if isinstance(obj, dict):
-        return {key: parse_schema(value) for key, value in obj.items()}
+        return {key: _parse_leaves(value) for key, value in obj.items()}
     elif isinstance(obj, list):
-        return [parse_schema(value) for value in obj]
+        return [_parse_leaves(value) for value in obj]
+    elif isinstance(obj, str):
+        try:
+            return parse_expr(obj)
+        except ValueError:
+            # Other text is a constant, but a broken path is a mistake.
+            if "$." in obj:
+                raise
+            return obj
     else:
-        value = obj
-        return parse_expr(value)
+        return obj
+
+def parse_schema(obj):
+    """
+    Compiles a schema (expressions nested in dicts and lists, and
+    constants) into one function of a record; see `compile_schema`.
+    """
+    return compile_schema(_parse_leaves(obj))
+
+class _Segment():
+    """
+    One step of a JSONPath: `key` identifies it, `field` is the single
+    field or index it looks up (None for steps with several matches)
+    and `step` maps a list of values to the list of their matches.
+    """
+    def __init__(self, key, field, step):
+        self.key = key
+        self.field = field
+        self.step = step
+
+def _segments(path):
+    """
+    Splits a JSONPath into its steps from the root, or returns None if it
+    is outside the subset that `compile_jsonpath` handles.
+    """
+    if isinstance(path, (_jp.Root, _jp.This)):
+        return []
+    if isinstance(path, _jp.Child):
+        left, right = _segments(path.left), _segments(path.right)
+        return None if left is None or right is None else left + right
+    if isinstance(path, _jp.Descendants):
+        left, right = _segments(path.left), _compile_steps(path.right, False)
+        if left is None or right is None:
+            return None
+        return left + [_Segment("..{!r}".format(path.right), None, _descendants_step(right))]
+    step = _compile_steps(path, False)
+    if step is None:
+        return None
+    field = None
+    if isinstance(path, _jp.Fields) and len(path.fields) == 1 and path.fields[0] != "*":
+        field = path.fields[0]
+    elif isinstance(path, _jp.Index) and len(path.indices) == 1:
+        field = path.indices[0]
+    return [_Segment(repr(path), field, step)]
+
+def _chain(steps):
+    def _step(values):
+        for step in steps:
+            values = step(values)
+        return values
+    return _step
+
+class _PathTrie():
+    def __init__(self):
+        self.children = {}
+        self.paths = []
+
+    def add(self, segments, path):
+        node = self
+        for segment in segments:
+            node = node.children.setdefault(segment.key, (segment, _PathTrie()))[1]
+        node.paths.append(path)
+
+def _eager(node):
+    """
+    Yields the nodes that are evaluated whenever @node is, i.e. not
+    behind a short-circuit, a condition or an apply.
+    """
+    yield node
+    if node.kind in ("cond", "apply") or node.value in ("&&", "||"):
+        children = node.children[:1]
+    else:
+        children = node.children
+    for child in children:
+        yield from _eager(child)
+
+def _post_order(node):
+    children = node.children[:1] if node.kind == "apply" else node.children
+    for child in children:
+        yield from _post_order(child)
+    yield node
+
+class _SchemaCompiler(_Compiler):
+    """
+    Generates one function for a whole schema. JSONPaths are merged into
+    a trie so that a prefix shared by several paths is looked up once per
+    record, and subexpressions that occur more than once (and are always
+    evaluated) are computed once.
+    """
+    def __init__(self):
+        super().__init__()
+        self.body = []
+        self._locals = 0
+
+    def local(self, value, prefix="_v"):
+        self._locals += 1
+        name = "{}{}".format(prefix, self._locals)
+        self.body.append("    {} = {}".format(name, value))
+        return name
+
+    def paths(self, nodes):
+        trie = _PathTrie()
+        counts = {}
+        for node in nodes:
+            for node_ in node.scope():
+                if node_.kind != "path":
+                    continue
+                key = str(node_.value)
+                counts[key] = counts.get(key, 0) + 1
+                if counts[key] > 1:
+                    continue
+                segments = _segments(node_.value.path)
+                if segments is not None:
+                    trie.add(segments, key)
+                # Other paths are evaluated by jsonpath_ng, only once
+                # per record if they occur more than once.
+        for key in trie.paths:
+            self._hoisted[key] = "obj"
+        self._paths(trie, "obj", False, [])
+        for node in nodes:
+            for node_ in node.scope():
+                key = str(node_.value)
+                if node_.kind == "path" and key not in self._hoisted and counts[key] > 1:
+                    self._hoisted[key] = self.local("{}(obj)".format(self.path(node_)))
+
+    def _paths(self, trie, base, is_list, pending):
+        for segment, child in trie.children.values():
+            segments = pending + [segment]
+            if len(child.children) == 1 and not child.paths:
+                self._paths(child, base, is_list, segments)
+                continue
+            # A prefix that several paths share, or the end of a path.
+            if not is_list and all(segment.field is not None for segment in segments):
+                getter = self.bind("g", _keys_getter([segment.field for segment in segments]))
+                local, is_list_ = self.local("{}({})".format(getter, base)), False
+            else:
+                steps = self.bind("s", _chain([segment.step for segment in segments]))
+                local, is_list_ = self.local("{}({})".format(steps, base if is_list else "[{}]".format(base)), "_m"), True
+            if child.paths:
+                value = self.local("_condense({})".format(local)) if is_list_ else local
+                for key in child.paths:
+                    self._hoisted[key] = value
+            self._paths(child, local, is_list_, [])
+
+    def common(self, nodes):
+        counts, eager = {}, set()
+        for node in nodes:
+            for node_ in node.scope():
+                if node_.kind not in ("const", "path"):
+                    counts[node_.key()] = counts.get(node_.key(), 0) + 1
+            eager.update(node_.key() for node_ in _eager(node))
+        for node in nodes:
+            for node_ in _post_order(node):
+                key = node_.key() if node_.kind not in ("const", "path") else None
+                if key in eager and counts[key] > 1 and key not in self._memo:
+                    self._memo[key] = self.local(self.expr(node_), "_e")
+
+    def value(self, schema):
+        if isinstance(schema, dict):
+            return "{{{}}}".format(", ".join("{!r}: {}".format(key, self.value(value)) for key, value in schema.items()))
+        elif isinstance(schema, list):
+            return "[{}]".format(", ".join(self.value(value) for value in schema))
+        elif callable(schema):
+            return self.expr(schema.node)
+        elif _is_literal(schema):
+            return repr(schema)
+        else:
+            return self.bind("c", schema)
+
+    def compile_schema(self, schema):
+        exprs = schema_exprs(schema)
+        nodes = [expr.node for expr in exprs]
+        self.namespace["_condense"] = _condense
+        self.paths(nodes)
+        self.common(nodes)
+        self.body.append("    return {}".format(self.value(schema)))
+        source = "\n".join(self.lines + ["def _schema(obj):"] + self.body)
+        exec(compile(source, "<jsontool-schema>", "exec"), self.namespace)
+        fn = self.namespace["_schema"]
+        fn.source = source
+        fn.exprs = exprs
+        paths = {}
+        for expr in exprs:
+            for path in expr.paths:
+                paths.setdefault(str(path), path)
+        fn.paths = list(paths.values())
+        return fn
+
+def compile_schema(schema):
+    """
+    Compiles a schema of parsed expressions into a single function of a
+    record that returns the same as `apply_schema`.
+    """
+    return _SchemaCompiler().compile_schema(schema)
 
 def apply_schema(schema, obj):
     if isinstance(schema, dict):
@@ -26,6 +225,30 @@ def apply_schema(schema, obj):
     else:
         return schema
 
+def schema_paths(schema):
+    """
+    Returns the JSONPaths used by a parsed schema.
+    """
+    if isinstance(schema, dict):
+        return [path for value in schema.values() for path in schema_paths(value)]
+    elif isinstance(schema, list):
+        return [path for value in schema for path in schema_paths(value)]
+    else:
+        return list(getattr(schema, "paths", []))
+
+def schema_exprs(schema):
+    """
+    Returns the compiled expressions of a parsed schema.
+    """
+    if isinstance(schema, dict):
+        return [expr for value in schema.values() for expr in schema_exprs(value)]
+    elif isinstance(schema, list):
+        return [expr for value in schema for expr in schema_exprs(value)]
+    elif hasattr(schema, "exprs"):
+        return list(schema.exprs)
+    else:
+        return [schema] if callable(schema) else []
+
 def test_schema():
     obj = {
         "a": 1,
@@ -51,3 +274,42 @@ def test_schema():
     assert test({"a": {"b": "$.e..a"}}, obj) == {"a": {"b": [5,6]}}
 
     assert test("$.*", obj) == [1, "apples", [2, 3], {"a": 4}, [{"a": 5}, {"a": 6}]]
+
+def test_compile_schema():
+    schema = {
+        "a": "$.r.c[0].m.x",
+        "b": "$.r.c[0].m.y",
+        "c": ["$.r.c[*].m.x", "len($.r.c) > 1 && $.q", "len($.r.c) + 1", "$.r.c[-1].m"],
+        "d": {"e": "$..x", "f": "$.r.*", "g": "$.z[0:2]", "h": "$.z[0:2]"},
+        "i": "$.r |> len($.c)",
+        "j": "find(\"b+\", $.s) ? $.r.c[0].m.y : \"none\"",
+        "k": "const",
+    }
+    objs = [
+        {"r": {"c": [{"m": {"x": 1, "y": 2}}, {"m": {"x": 3}}]}, "q": 1, "z": [1, 2, 3], "s": "abb"},
+        {"r": {"c": [{"m": None}, {"m": {"x": [4]}}]}, "q": 0, "s": "a"},
+        {"r": {"c": "string"}, "z": {"0": 1}},
+        {"r": None, "q": None},
+        {},
+    ]
+    compiled = parse_schema(schema)
+    for obj in objs:
+        try:
+            expected = apply_schema(_parse_leaves(schema), obj)
+        except TypeError:
+            expected = TypeError
+        try:
+            assert compiled(obj) == expected
+        except TypeError:
+            assert expected is TypeError
+    assert apply_schema(compiled, objs[0])["d"] == {"e": [1, 3], "f": [{"m": {"x": 1, "y": 2}}, {"m": {"x": 3}}],
+                                                    "g": [1, 2], "h": [1, 2]}
+
+    # The shared prefix $.r.c is looked up once and len($.r.c) computed once.
+    body = compiled.source.split("def _schema(obj):")[1]
+    # Only $.r, $.q, $.s, $.z[0:2] and $..x are looked up from the record,
+    # and len($.r.c) is computed once.
+    assert body.count("(obj)") + body.count("([obj])") == 5
+    assert body.count(" = _f") == 1
+    assert [str(path) for path in schema_paths(compiled)][:3] == ["$.r.c.[0].m.x", "$.r.c.[0].m.y", "$.r.c.[*].m.x"]
+    assert len(schema_exprs(compiled)) == 12
@@ -0,0 +1,195 @@
+"""
+Mergeable streaming sketches
+"""
+
+import math
+import json
+import random
+import hashlib
+
+def hash64(value):
+    """
+    A 64-bit hash of a JSON value that is the same in every process
+    (unlike `hash`, which is salted per process).
+    """
+    if isinstance(value, str):
+        data = b"s" + value.encode("utf-8")
+    elif isinstance(value, bytes):
+        data = b"b" + value
+    elif type(value) is int or (type(value) is float and math.isfinite(value)):
+        # Same bytes as json.dumps, without its overhead.
+        data = b"j" + repr(value).encode("ascii")
+    else:
+        data = b"j" + json.dumps(value, sort_keys=True).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+class HyperLogLog():
+    """
+    Approximate count of distinct values, with a relative error of about
+    1.04 / sqrt(2 ** p).
+    """
+    def __init__(self, p=14):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add(self, value):
+        h = hash64(value)
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        assert self.p == other.p, "Can't merge sketches of different sizes"
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def __len__(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2. ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities.
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+class _Compactor(list):
+    def compact(self, rng):
+        self.sort()
+        offset = rng.random() < 0.5
+        ret = self[offset::2]
+        del self[:]
+        return ret
+
+class KLL():
+    """
+    Approximate quantiles (Karnin, Lang and Liberty, 2016) in O(k) space.
+    """
+    def __init__(self, k=200, c=2/3, seed=0):
+        self.k = k
+        self.c = c
+        self.rng = random.Random(seed)
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self._grow()
+
+    def _grow(self):
+        self.compactors.append(_Compactor())
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.c ** depth * self.k)) + 1
+
+    def _compress(self):
+        for h in range(len(self.compactors)):
+            if len(self.compactors[h]) >= self._capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self._grow()
+                # An odd item out stays at this level.
+                last = [self.compactors[h].pop()] if len(self.compactors[h]) % 2 else []
+                self.compactors[h + 1].extend(self.compactors[h].compact(self.rng))
+                self.compactors[h].extend(last)
+                self.size = sum(map(len, self.compactors))
+                if self.size < self.max_size:
+                    break
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for h, compactor in enumerate(other.compactors):
+            self.compactors[h].extend(compactor)
+        self.size = sum(map(len, self.compactors))
+        while self.size >= self.max_size:
+            self._compress()
+
+    def quantile(self, q):
+        items = sorted((value, 1 << h) for h, compactor in enumerate(self.compactors) for value in compactor)
+        if not items:
+            return None
+        target = q * sum(weight for _, weight in items)
+        total = 0
+        for value, weight in items:
+            total += weight
+            if total >= target:
+                return value
+        return items[-1][0]
+
+class BloomFilter():
+    """
+    Set membership with no false negatives and a false positive rate of
+    about @error for up to @capacity items.
+    """
+    def __init__(self, capacity, error=0.01):
+        n_bits = max(8, int(-capacity * math.log(error) / math.log(2) ** 2))
+        n_bits = (n_bits + 7) // 8 * 8
+        self.n_hashes = max(1, int(round(n_bits / max(capacity, 1) * math.log(2))))
+        self.n_bits = n_bits
+        self.bits = bytearray((n_bits + 7) // 8)
+
+    @classmethod
+    def from_bytes(cls, bits, n_hashes):
+        ret = cls.__new__(cls)
+        ret.bits = bytearray(bits)
+        ret.n_bits = len(bits) * 8
+        ret.n_hashes = n_hashes
+        return ret
+
+    def _positions(self, value):
+        h = hash64(value)
+        h1, h2 = h & 0xffffffff, h >> 32
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, value):
+        """
+        Adds @value; returns whether it was new (or False for a false
+        positive).
+        """
+        new = False
+        bits = self.bits
+        for pos in self._positions(value):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                new = True
+        return new
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+def test_sketches():
+    values = list(range(100000))
+    random.Random(0).shuffle(values)
+
+    hll, hll_ = HyperLogLog(), HyperLogLog()
+    kll, kll_ = KLL(seed=0), KLL(seed=1)
+    for i, value in enumerate(values):
+        (hll if i % 2 else hll_).add(value % 50000)
+        (kll if i % 2 else kll_).add(value)
+    hll.merge(hll_)
+    kll.merge(kll_)
+
+    assert abs(len(hll) - 50000) < 50000 * 0.03
+    assert sum(map(len, kll.compactors)) < 2000
+    for q in [0.01, 0.5, 0.9, 0.99]:
+        assert abs(kll.quantile(q) - q * len(values)) < 0.02 * len(values)
+
+    small = HyperLogLog()
+    for value in ["a", "b", "c", "a", 1, 1.5]:
+        small.add(value)
+    assert len(small) == 5
+
+    bloom = BloomFilter(1000)
+    for value in range(1000):
+        bloom.add(value)
+    assert all(value in bloom for value in range(1000))
+    assert not bloom.add(1) and bloom.add(b"1")
+    assert sum(value in bloom for value in range(1000, 11000)) < 300
@@ -0,0 +1,370 @@
+"""
+External-memory sorting and deduplication of JSONL by expression keys
+"""
+
+import os
+import math
+import heapq
+import shutil
+import struct
+import logging
+import tempfile
+from itertools import chain, groupby
+from operator import itemgetter
+
+from .util import default_codec, load_projected
+
+logger = logging.getLogger(__name__)
+
+# Memory budget of a sort, in bytes.
+DEFAULT_MEMORY = 512 << 20
+# Approximate memory used by an entry besides its key and line: the
+# tuple, two bytes objects and a list slot.
+ENTRY_OVERHEAD = 120
+# Maximum number of runs merged at once; more are merged in passes.
+MERGE_FAN_IN = 64
+_RUN_HEADER = struct.Struct(">II")
+_RUN_BUFFER = 1 << 20
+
+# Keys of different types sort like jq: null < false < true < numbers <
+# strings < lists < dicts. Encoded keys are prefix-free, so they sort the
+# same when concatenated or (for --reverse) inverted.
+_NULL, _FALSE, _TRUE, _NUMBER, _STRING, _LIST, _DICT = range(1, 8)
+_END = b"\x00"
+_DOUBLE = struct.Struct(">d")
+_INVERT = bytes(range(255, -1, -1))
+
+def _encode_float(value):
+    if value == 0:
+        # -0.0 == 0.0
+        value = 0.
+    data = bytearray(_DOUBLE.pack(value))
+    if data[0] & 0x80:
+        return bytes(0xff - byte for byte in data)
+    data[0] |= 0x80
+    return bytes(data)
+
+def _encode_number(value, out):
+    try:
+        float_ = float(value)
+    except OverflowError:
+        float_ = math.copysign(math.inf, value)
+    out.append(_NUMBER)
+    out += _encode_float(float_)
+    # Ints beyond 2 ** 53 that round to the same float are ordered by
+    # their difference to it (up to 64 bits).
+    diff = value - int(float_) if isinstance(value, int) and math.isfinite(float_) else 0
+    if diff == 0:
+        out.append(2)
+    else:
+        out.append(3 if diff > 0 else 1)
+        diff = min(abs(diff), (1 << 64) - 1)
+        out += (diff if value > float_ else (1 << 64) - 1 - diff).to_bytes(8, "big")
+
+def _encode_string(value, out):
+    # UTF-8 sorts like code points; 0 bytes are escaped so that the
+    # terminator sorts first.
+    out += value.encode("utf-8", "surrogatepass").replace(b"\x00", b"\x00\xff")
+    out += b"\x00\x01"
+
+def _encode(value, out):
+    if value is None:
+        out.append(_NULL)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, (int, float)):
+        _encode_number(value, out)
+    elif isinstance(value, str):
+        out.append(_STRING)
+        _encode_string(value, out)
+    elif isinstance(value, (list, tuple)):
+        out.append(_LIST)
+        for value_ in value:
+            _encode(value_, out)
+        out += _END
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        for key in sorted(value):
+            _encode_string(key, out)
+            _encode(value[key], out)
+        out += _END
+    else:
+        raise TypeError("Can't sort by {!r}".format(value))
+
+def encode_key(*values):
+    """
+    Encodes JSON values as bytes that sort in the same order as the
+    values, one after the other.
+    """
+    out = bytearray()
+    for value in values:
+        _encode(value, out)
+    return bytes(out)
+
+def invert_key(key):
+    """
+    Returns a key that sorts in the opposite order of @key.
+    """
+    return key.translate(_INVERT)
+
+def make_key(exprs=(), reverse=False, lazy=False, codec=None):
+    """
+    Returns a function mapping a line to the encoded key of its record:
+    the values of the compiled @exprs (null where they raise), or the
+    whole record without @exprs. Lines that don't decode have no key
+    (None). With @lazy, only the fields the expressions use are decoded.
+    """
+    codec = codec or default_codec()
+    loads = codec.loads
+    if lazy and exprs:
+        from .expr import projection
+        proj = projection([path for expr in exprs for path in expr.paths])
+        loads = lambda line: load_projected(line, proj, codec)
+
+    def _value(expr, obj):
+        try:
+            return expr(obj)
+        except Exception:
+            return None
+
+    def _key(line):
+        try:
+            obj = loads(line)
+        except ValueError:
+            return None
+        key = encode_key(*[_value(expr, obj) for expr in exprs]) if exprs else encode_key(obj)
+        return invert_key(key) if reverse else key
+    return _key
+
+def _write_run(fname, items):
+    pack = _RUN_HEADER.pack
+    with open(fname, "wb", buffering=_RUN_BUFFER) as f:
+        write = f.write
+        for key, line in items:
+            write(pack(len(key), len(line)))
+            write(key)
+            write(line)
+
+def _read_run(fname):
+    unpack, size = _RUN_HEADER.unpack, _RUN_HEADER.size
+    with open(fname, "rb", buffering=_RUN_BUFFER) as f:
+        read = f.read
+        while True:
+            header = read(size)
+            if not header:
+                return
+            key_size, line_size = unpack(header)
+            yield read(key_size), read(line_size)
+
+class ExternalSorter():
+    """
+    Sorts (key, line) pairs of bytes by key, keeping pairs with equal keys
+    in the order they were added. Pairs are sorted in memory until they
+    take about @memory bytes; then they are written to a sorted run in a
+    temporary directory under @tmpdir, and the runs are merged with a heap
+    (@fan_in at a time). Iterate over the sorter once to get the pairs in
+    order, and call `close` to delete the runs.
+    """
+    def __init__(self, memory=DEFAULT_MEMORY, tmpdir=None, fan_in=MERGE_FAN_IN):
+        self.memory = memory
+        self.tmpdir = tmpdir
+        self.fan_in = max(fan_in, 2)
+        self.items = []
+        self.size = 0
+        self.runs = []
+        self.dir = None
+        self.n_runs = 0
+
+    def add(self, key, line):
+        self.items.append((key, line))
+        self.size += len(key) + len(line) + ENTRY_OVERHEAD
+        if self.size >= self.memory:
+            self._spill()
+
+    def _run_path(self):
+        if self.dir is None:
+            self.dir = tempfile.mkdtemp(prefix="jsontool-sort-", dir=self.tmpdir)
+        self.n_runs += 1
+        return os.path.join(self.dir, "run{}".format(self.n_runs))
+
+    def _spill(self):
+        self.items.sort(key=itemgetter(0))
+        fname = self._run_path()
+        _write_run(fname, self.items)
+        self.runs.append(fname)
+        self.items, self.size = [], 0
+
+    def _merge(self, runs):
+        return heapq.merge(*map(_read_run, runs), key=itemgetter(0))
+
+    def __iter__(self):
+        self.items.sort(key=itemgetter(0))
+        if not self.runs:
+            return iter(self.items)
+        if self.items:
+            self._spill()
+        # Merging consecutive runs keeps equal keys in input order.
+        runs = self.runs
+        while len(runs) > self.fan_in:
+            logger.debug("Merging %d runs", len(runs))
+            merged = []
+            for i in range(0, len(runs), self.fan_in):
+                if len(runs[i:i + self.fan_in]) == 1:
+                    merged.append(runs[i])
+                    continue
+                fname = self._run_path()
+                _write_run(fname, self._merge(runs[i:i + self.fan_in]))
+                for run in runs[i:i + self.fan_in]:
+                    os.remove(run)
+                merged.append(fname)
+            runs = merged
+        self.runs = runs
+        return self._merge(runs)
+
+    def close(self):
+        self.items = []
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class DecodeErrors():
+    # Counts the lines without a key (that don't decode).
+    def __init__(self):
+        self.n = 0
+
+def _keyed(lines, key, errors):
+    for line in lines:
+        key_ = key(line)
+        if key_ is None:
+            errors.n += 1
+            continue
+        # Lines may be views of a memory-mapped file.
+        yield key_, bytes(line)
+
+def sort_lines(lines, key, memory=DEFAULT_MEMORY, tmpdir=None, errors=None):
+    """
+    Yields @lines sorted by `key(line)` (an encoded key; see `make_key`),
+    keeping lines with equal keys in input order. Lines without a key are
+    dropped and counted in @errors.
+    """
+    errors = errors or DecodeErrors()
+    with ExternalSorter(memory, tmpdir) as sorter:
+        for key_, line in _keyed(lines, key, errors):
+            sorter.add(key_, line)
+        for _, line in sorter:
+            yield line
+
+def _sort_dedup(pairs, memory, tmpdir):
+    # Sorts by key and input position, keeps the first line of each key
+    # and sorts those back into input order. Both sorters hold lines at
+    # once, so they share @memory.
+    seq = struct.Struct(">Q").pack
+    with ExternalSorter(memory // 2, tmpdir) as by_key, ExternalSorter(memory // 2, tmpdir) as by_seq:
+        for i, (key_, line) in enumerate(pairs):
+            by_key.add(key_ + seq(i), line)
+        for _, group in groupby(by_key, lambda pair: pair[0][:-8]):
+            key_, line = next(group)
+            by_seq.add(key_[-8:], line)
+        for _, line in by_seq:
+            yield line
+
+def dedup_lines(lines, key, memory=DEFAULT_MEMORY, tmpdir=None, errors=None):
+    """
+    Yields the first line with each `key(line)`, in input order. Keys are
+    kept in a set until it takes half of @memory; the lines after that
+    whose key isn't in the set are deduplicated with an external sort in
+    the other half (the set is still needed to skip its keys).
+    """
+    errors = errors or DecodeErrors()
+    pairs = _keyed(lines, key, errors)
+    seen, size = set(), 0
+    for key_, line in pairs:
+        if key_ in seen:
+            continue
+        size += len(key_) + ENTRY_OVERHEAD
+        if size > memory // 2:
+            logger.info("Keys exceed the memory budget; deduplicating the rest of the input on disk")
+            rest = ((key__, line_) for key__, line_ in chain([(key_, line)], pairs) if key__ not in seen)
+            yield from _sort_dedup(rest, memory // 2, tmpdir)
+            return
+        seen.add(key_)
+        yield line
+
+def approx_dedup_lines(lines, key, capacity=10000000, error=0.001, errors=None):
+    """
+    Yields the first line with each `key(line)`, in input order, with a
+    bloom filter of @capacity keys in constant memory. A fraction of
+    about @error of the unique lines (more beyond @capacity keys) are
+    wrongly dropped as duplicates.
+    """
+    from .sketch import BloomFilter
+    errors = errors or DecodeErrors()
+    bloom = BloomFilter(capacity, error)
+    add = bloom.add
+    for key_, line in _keyed(lines, key, errors):
+        if add(key_):
+            yield line
+
+def test_encode_key():
+    import random
+    values = [None, False, True, -math.inf, -1e300, -2 ** 70, -3, -2.5, 0, 1e-300, 1, 1.5, 2 ** 53,
+              2 ** 53 + 1, 2 ** 64, 2 ** 64 + 1, 1e300, math.inf, "", "\x00", "\x00a", "a", "a\x00", "ab", "b",
+              "é", "😀", [], [None], [1], [1, 2], [2], ["a"], {}, {"a": 1}, {"a": 1, "b": 1}, {"a": 2}, {"b": 0}]
+    keys = [encode_key(value) for value in values]
+    assert keys == sorted(keys) and len(set(keys)) == len(keys)
+    assert encode_key(1) == encode_key(1.0) and encode_key(-0.0) == encode_key(0)
+    inverted = [invert_key(key) for key in keys]
+    assert inverted == sorted(inverted, reverse=True)
+
+    # Keys of several values sort like tuples of the values.
+    pairs = [(random.Random(i).choice(values[3:18]), random.Random(-i).choice(values[18:])) for i in range(200)]
+    pairs_ = sorted(pairs, key=lambda pair: encode_key(*pair))
+    assert [encode_key(*pair) for pair in pairs_] == sorted(encode_key(*pair) for pair in pairs)
+    assert [pair for pair in pairs_ if isinstance(pair[1], str)] == \
+        sorted((pair for pair in pairs if isinstance(pair[1], str)), key=lambda pair: (pair[0], pair[1]))
+
+def test_external_sort(tmp_path):
+    import json
+    import random
+    from .expr import parse_expr
+
+    rng = random.Random(0)
+    objs = [{"k": rng.choice([None, 1, 2.5, "a", "b", [1]]), "n": rng.randrange(50), "i": i} for i in range(3000)]
+    lines = [json.dumps(obj).encode("utf-8") + b"\n" for obj in objs] + [b"not json\n"]
+    key = make_key([parse_expr("$.n")])
+    errors = DecodeErrors()
+    # About 100 lines per run.
+    sorted_ = list(sort_lines(lines, key, memory=20000, tmpdir=str(tmp_path), errors=errors))
+    assert [json.loads(line) for line in sorted_] == sorted(objs, key=lambda obj: obj["n"]) and errors.n == 1
+    # Merged 3 runs at a time, in several passes.
+    with ExternalSorter(20000, str(tmp_path), fan_in=3) as sorter:
+        for line in lines[:-1]:
+            sorter.add(key(line), line)
+        assert len(sorter.runs) > 9
+        assert [line for _, line in sorter] == sorted_
+    assert os.listdir(str(tmp_path)) == []
+
+    key = make_key([parse_expr("$.k"), parse_expr("$.n")], reverse=True, lazy=True)
+    sorted_ = [json.loads(line) for line in sort_lines(lines, key, memory=20000, tmpdir=str(tmp_path))]
+    assert [encode_key(obj["k"], obj["n"]) for obj in sorted_] == \
+        sorted((encode_key(obj["k"], obj["n"]) for obj in objs), reverse=True)
+
+    key = make_key([parse_expr("$.k"), parse_expr("$.n")])
+    expected, seen = [], set()
+    for line, obj in zip(lines, objs):
+        if (json.dumps(obj["k"]), obj["n"]) not in seen:
+            seen.add((json.dumps(obj["k"]), obj["n"]))
+            expected.append(line)
+    assert list(dedup_lines(lines, key)) == expected
+    # Most keys are deduplicated on disk.
+    assert list(dedup_lines(lines, key, memory=5000, tmpdir=str(tmp_path))) == expected
+    assert list(approx_dedup_lines(lines, key, capacity=len(expected))) == expected
+    assert list(dedup_lines([b'{"a": 1, "b": 2}\n', b'{"b": 2, "a": 1}\n'], make_key())) == [b'{"a": 1, "b": 2}\n']
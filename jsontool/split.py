@@ -0,0 +1,258 @@
+"""
+Splitting JSONL into many shards in one pass
+"""
+
+import os
+import json
+import logging
+from collections import OrderedDict
+from urllib.parse import quote
+
+from .util import default_codec, load_projected, block_compressor, compression_of
+
+logger = logging.getLogger(__name__)
+
+# Open files kept at once; the least recently written one is closed first.
+MAX_OPEN = 256
+# Bytes buffered per shard before they are written (as one compressed
+# block, for compressed outputs).
+SHARD_BUFFER = 256 << 10
+# Bytes buffered across all shards; past it, every buffer is written.
+MEMORY = 256 << 20
+# Longest shard name kept whole, leaving room in a file name (at most 255
+# bytes) for the rest of the pattern.
+MAX_NAME = 200
+
+def _is_json(text):
+    try:
+        json.loads(text)
+    except ValueError:
+        return False
+    return True
+
+def shard_name(value):
+    """
+    Returns a file name part for the shard of a key @value, with
+    characters that aren't safe in file names %-escaped: other values than
+    strings as JSON, and strings as they are unless that would read as
+    JSON (e.g. "1.5" or "true"), or as a special name, when they are
+    quoted. Keys of different types thus never share a file. Names longer
+    than `MAX_NAME` are cut short and end with a hash of the whole name.
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if not isinstance(value, str):
+        text = json.dumps(value, sort_keys=True)
+    elif value in ("", ".", "..") or _is_json(value):
+        text = json.dumps(value)
+    else:
+        text = value
+    name = quote(text, safe="")
+    if len(name) > MAX_NAME:
+        from .sketch import hash64
+        # One longer than any whole name, so that they can't be equal.
+        name = "{}~{:016x}".format(name[:MAX_NAME - 16], hash64(name))
+    return name
+
+def make_partition(expr, n_shards=None, lazy=False, codec=None):
+    """
+    Returns a function mapping a line to its shard: the value of the
+    compiled @expr (null where it raises) hashed into one of @n_shards
+    numbered shards, or named after the value (see `shard_name`) without
+    @n_shards. Keys share a shard only if they have the same JSON type
+    and value, where 1 and 1.0 count as equal but true and 1 don't. Lines
+    that don't decode have no shard (None).
+    """
+    from .sketch import hash64
+    codec = codec or default_codec()
+    loads = codec.loads
+    if lazy:
+        from .expr import projection
+        proj = projection(expr.paths)
+        loads = lambda line: load_projected(line, proj, codec)
+
+    def _shard(line):
+        try:
+            obj = loads(line)
+        except ValueError:
+            return None
+        try:
+            value = expr(obj)
+        except Exception:
+            value = None
+        if n_shards is None:
+            return shard_name(value)
+        # Equal numbers go to the same shard.
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return hash64(value) % n_shards
+    return _shard
+
+class _Shard():
+    __slots__ = ("lines", "size", "part", "file_size", "path", "file", "compress")
+
+    def __init__(self):
+        self.lines = []
+        self.size = 0
+        self.part = 0
+        self.file_size = 0
+        self.path = None
+        self.file = None
+        self.compress = None
+
+class ShardWriter():
+    """
+    Writes lines to many files, named by formatting @pattern with the
+    shard and (with @max_bytes) the part of the shard, e.g.
+    "parts/{shard:04d}.jsonl.gz" or "by-user/{shard}-{part}.jsonl".
+
+    Lines are buffered per shard and written @shard_buffer bytes at a
+    time, or all at once when the buffers take @memory bytes. At most
+    @max_open files are open at a time; others are closed (least recently
+    written first) and appended to when they are written again. Outputs
+    named *.gz, *.bz2, *.xz or *.zst are compressed one block at a time,
+    into members that decompress as one stream. With @max_bytes, a file
+    is followed by the next part of its shard once another block would
+    take it past that size. Call `close` when done.
+    """
+    def __init__(self, pattern, max_open=MAX_OPEN, shard_buffer=SHARD_BUFFER, memory=MEMORY, max_bytes=None):
+        if max_bytes and "{part" not in pattern:
+            raise ValueError("Output patterns need a {part} field to roll over files, e.g. {shard}-{part}.jsonl")
+        self.pattern = pattern
+        self.max_open = max(max_open, 1)
+        self.shard_buffer = shard_buffer
+        self.memory = memory
+        self.max_bytes = max_bytes
+        self.shards = {}
+        self.open_files = OrderedDict()
+        self.size = 0
+        self.paths = []
+
+    def write(self, shard, line):
+        state = self.shards.get(shard)
+        if state is None:
+            state = self.shards[shard] = _Shard()
+        # Lines may be views of the input, which join copies once.
+        state.lines.append(line)
+        state.size += len(line)
+        self.size += len(line)
+        if state.size >= self.shard_buffer:
+            self._flush(shard, state)
+        elif self.size >= self.memory:
+            self.flush()
+
+    def _path(self, shard, state):
+        path = self.pattern.format(shard=shard, part=state.part)
+        if state.path is None or path != state.path:
+            # Files are created afresh, then appended to when reopened.
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            open(path, "wb").close()
+            self.paths.append(path)
+            state.path, state.file_size = path, 0
+            state.compress = block_compressor(compression_of(path))
+        return path
+
+    def _open(self, shard, state):
+        if state.file is not None:
+            self.open_files.move_to_end(shard)
+            return state.file
+        if len(self.open_files) >= self.max_open:
+            _, evicted = self.open_files.popitem(last=False)
+            evicted.file.close()
+            evicted.file = None
+        state.file = open(self._path(shard, state), "ab")
+        self.open_files[shard] = state
+        return state.file
+
+    def _roll_over(self, shard, state):
+        if state.file is not None:
+            state.file.close()
+            state.file = None
+            del self.open_files[shard]
+        state.part += 1
+        self._path(shard, state)
+
+    def _flush(self, shard, state):
+        if not state.lines:
+            return
+        data = b"".join(state.lines)
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        self.size -= state.size
+        state.lines, state.size = [], 0
+        if state.path is None:
+            self._path(shard, state)
+        if state.compress is not None:
+            data = state.compress(data)
+        if self.max_bytes and state.file_size and state.file_size + len(data) > self.max_bytes:
+            self._roll_over(shard, state)
+        self._open(shard, state).write(data)
+        state.file_size += len(data)
+
+    def flush(self):
+        for shard, state in self.shards.items():
+            self._flush(shard, state)
+
+    def close(self):
+        self.flush()
+        for state in self.open_files.values():
+            state.file.close()
+            state.file = None
+        self.open_files.clear()
+
+def test_shard_writer(tmp_path):
+    import gzip
+    from .expr import parse_expr
+
+    lines = [json.dumps({"user": "u{}".format(i % 37), "i": i}).encode("utf-8") + b"\n" for i in range(2000)]
+    pattern = str(tmp_path / "parts" / "{shard:02d}.jsonl.gz")
+    partition = make_partition(parse_expr("$.user"), 16)
+    writer = ShardWriter(pattern, max_open=3, shard_buffer=500, memory=4000)
+    for line in lines + [b"not json\n"]:
+        shard = partition(line)
+        if shard is not None:
+            writer.write(shard, line)
+    writer.close()
+    assert len(writer.paths) == 16
+    shards = {}
+    for path in writer.paths:
+        with gzip.open(path) as f:
+            shards[path] = f.read().splitlines(keepends=True)
+    # Each user is in one shard, whose lines are in input order.
+    assert sorted(line for lines_ in shards.values() for line in lines_) == sorted(lines)
+    users = [{json.loads(line)["user"] for line in lines_} for lines_ in shards.values()]
+    assert sum(map(len, users)) == 37
+    for lines_ in shards.values():
+        assert lines_ == [line for line in lines if line in set(lines_)]
+
+    pattern = str(tmp_path / "users" / "{shard}-{part}.jsonl")
+    partition = make_partition(parse_expr("$.user"))
+    writer = ShardWriter(pattern, max_open=5, shard_buffer=300, max_bytes=1000)
+    for line in lines:
+        writer.write(partition(line), line)
+    writer.close()
+    assert all(os.path.getsize(path) <= 1000 for path in writer.paths)
+    with open(str(tmp_path / "users" / "u5-0.jsonl"), "rb") as f:
+        assert f.readline() == lines[5]
+    assert sum(os.path.getsize(path) for path in writer.paths) == sum(map(len, lines))
+
+    assert [shard_name(value) for value in ["a/b", "", ".", 1.5, 2.0, None, {"b": 1, "a": [1]}]] == [
+        "a%2Fb", "%22%22", "%22.%22", "1.5", "2", "null", "%7B%22a%22%3A%20%5B1%5D%2C%20%22b%22%3A%201%7D"]
+    # Keys of different types get different names.
+    keys = ["1.5", 1.5, True, "true", "True", None, "null", "", '""', '"', "[1]", [1], 2, 2.5, "2"]
+    assert len({shard_name(key) for key in keys}) == len(keys)
+    assert shard_name(2.0) == shard_name(2)
+    # Long keys are cut short, and still differ.
+    long_keys = ["é" * 100, "é" * 99 + "e", "https://example.com/" + "a" * 300]
+    names = [shard_name(key) for key in long_keys]
+    assert len(set(names)) == 3 and all(len(name) == MAX_NAME + 1 for name in names)
+    assert shard_name("e" * MAX_NAME) == "e" * MAX_NAME
+    writer = ShardWriter(str(tmp_path / "long" / "{shard}.jsonl.gz"))
+    for key in long_keys:
+        writer.write(shard_name(key), b"{}\n")
+    writer.close()
+    assert len(os.listdir(str(tmp_path / "long"))) == 3
+    partition = make_partition(parse_expr("$.k"), 1 << 20)
+    assert len({partition(json.dumps({"k": key}).encode("utf-8")) for key in keys}) == len(keys)
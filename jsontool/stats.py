@@ -0,0 +1,235 @@
+"""
+Per-stage timings and counters of a run (`--stats`)
+"""
+
+import sys
+import json
+import time
+import resource
+from collections import defaultdict
+from itertools import islice
+
+# Number of input lines kept to time expression nodes on at the end.
+SAMPLE_SIZE = 1000
+# Per-record stages are timed on one call in this many, which is scaled
+# up; the calls are all counted. A prime, so that the sampled calls don't
+# line up with writers that flush every 2^k records.
+TIMING_INTERVAL = 17
+# Number of expression nodes reported.
+TOP_NODES = 10
+
+_STATS = None
+
+def enable_stats():
+    """
+    Starts collecting statistics in this process and returns them.
+    """
+    global _STATS
+    _STATS = Stats()
+    return _STATS
+
+def disable_stats():
+    global _STATS
+    _STATS = None
+
+def get_stats():
+    return _STATS
+
+def timed(stage, fn, sampled=True):
+    """
+    Returns @fn, timed as @stage if statistics are enabled; see
+    `Stats.timed`.
+    """
+    return fn if _STATS is None else _STATS.timed(stage, fn, sampled)
+
+def timed_lines(lines):
+    """
+    Returns @lines, timed and counted as the "read" stage if statistics
+    are enabled.
+    """
+    return lines if _STATS is None else _STATS.lines(lines)
+
+def count(key, n=1):
+    if _STATS is not None:
+        _STATS.counts[key] += n
+
+def add_exprs(exprs):
+    """
+    Registers the compiled expressions of the run, whose nodes are timed
+    on sampled input lines at the end.
+    """
+    if _STATS is not None:
+        _STATS.exprs.extend(exprs)
+
+def profile_nodes(expr, objs):
+    """
+    Returns (node, seconds per object) for every node of the compiled
+    @expr that is evaluated against the record, timing each node (and
+    its children) on @objs.
+    """
+    from .expr import compile_expr
+    ret = []
+    for node in expr.node.scope():
+        if node.is_const:
+            continue
+        fn = compile_expr(node)
+        start = time.perf_counter()
+        for obj in objs:
+            try:
+                fn(obj)
+            except Exception:
+                pass
+        ret.append((node, (time.perf_counter() - start) / max(len(objs), 1)))
+    return ret
+
+class CountingStream():
+    """
+    Passes writes through to @stream, counting the bytes written.
+    """
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+
+    def write(self, data):
+        self.stats.counts["bytes_out"] += len(data)
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class Stats():
+    """
+    Wall time spent in each stage of a run and the number of calls to
+    it, plus counters such as swallowed errors. Stages are timed by
+    wrapping the function of each stage (see `timed`); time outside of
+    every stage is reported as "other".
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = defaultdict(lambda: [0, 0.])
+        self.counts = defaultdict(int)
+        self.exprs = []
+        self.samples = []
+
+    def timed(self, stage, fn, sampled=True):
+        """
+        Wraps @fn to count its calls as @stage and to time them, or only
+        one in `TIMING_INTERVAL` if @sampled, which is cheaper for
+        functions called per record.
+        """
+        stage_ = self.stages[stage]
+        clock = time.perf_counter
+        interval = TIMING_INTERVAL if sampled else 1
+
+        def _timed(*args):
+            stage_[0] += 1
+            if stage_[0] % interval:
+                return fn(*args)
+            start = clock()
+            try:
+                return fn(*args)
+            finally:
+                stage_[1] += (clock() - start) * interval
+        return _timed
+
+    def lines(self, lines):
+        next_ = self.timed("read", iter(lines).__next__)
+        samples = self.samples
+        size = 0
+        try:
+            while True:
+                try:
+                    line = next_()
+                except StopIteration:
+                    # The end of the input isn't a line.
+                    self.stages["read"][0] -= 1
+                    return
+                size += len(line)
+                if len(samples) < SAMPLE_SIZE:
+                    samples.append(bytes(line))
+                yield line
+        finally:
+            self.counts["bytes_in"] += size
+
+    def output(self, stream):
+        return CountingStream(stream, self)
+
+    def slowest_nodes(self):
+        """
+        Returns the slowest expression nodes on the sampled lines.
+        """
+        if not self.samples:
+            return []
+        from .util import default_codec
+        loads = default_codec().loads
+        objs = []
+        for line in self.samples:
+            try:
+                objs.append(loads(line))
+            except ValueError:
+                pass
+        nodes = [(str(node), seconds) for expr in self.exprs for node, seconds in profile_nodes(expr, objs)]
+        nodes.sort(key=lambda node: -node[1])
+        return [{"expr": expr, "seconds_per_record": seconds} for expr, seconds in islice(nodes, TOP_NODES)]
+
+    def to_dict(self):
+        seconds = time.perf_counter() - self.start
+        # Stages that never ran (e.g. those run by workers) are left out.
+        stages = {stage: {"calls": calls, "seconds": time_} for stage, (calls, time_) in self.stages.items() if calls}
+        stages["other"] = {"calls": 0, "seconds": max(seconds - sum(time_ for _, time_ in self.stages.values()), 0.)}
+        records = self.stages["read"][0] if "read" in self.stages else self.counts.get("records_in", 0)
+        size = self.counts.get("input_bytes") or self.counts["bytes_in"]
+        return {
+            "seconds": seconds,
+            "records_in": records,
+            "records_out": self.stages["write"][0] if "write" in self.stages else 0,
+            "records_per_s": records / seconds if seconds else 0.,
+            "mb_per_s": size / seconds / 1e6 if seconds else 0.,
+            # ru_maxrss is in KB on Linux and in bytes on macOS.
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == "darwin" else 1),
+            "stages": stages,
+            "counts": dict(self.counts),
+            "slowest_nodes": self.slowest_nodes(),
+        }
+
+    def report(self, fname=None):
+        """
+        Writes the statistics to stderr, or as JSON to @fname.
+        """
+        stats = self.to_dict()
+        if fname:
+            with open(fname, "w") as f:
+                json.dump(stats, f, indent=2)
+            return
+        write = sys.stderr.write
+        write("{records_in} records in, {records_out} out in {seconds:.2f}s "
+              "({records_per_s:.0f} records/s, {mb_per_s:.1f} MB/s, peak RSS {peak_rss_kb} KB)\n".format(**stats))
+        for stage, values in sorted(stats["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            write("  {:18} {:8.3f}s {:5.1f}% {:10d} calls\n".format(
+                stage, values["seconds"], 100 * values["seconds"] / stats["seconds"], values["calls"]))
+        for key, value in sorted(stats["counts"].items()):
+            write("  {:18} {:>10}\n".format(key, value))
+        if stats["slowest_nodes"]:
+            write("Slowest expression nodes (with their children, over {} sampled records):\n".format(len(self.samples)))
+            for node in stats["slowest_nodes"]:
+                write("  {:10.2f} µs  {}\n".format(node["seconds_per_record"] * 1e6, node["expr"]))
+
+def test_stats():
+    from .expr import parse_expr
+
+    stats = Stats()
+    lines = [b'{"a": %d, "s": "xyz"}' % i for i in range(10)]
+    loads = stats.timed("decode", json.loads)
+    objs = [loads(line) for line in stats.lines(lines)]
+    assert len(objs) == 10 and stats.stages["read"][0] == stats.stages["decode"][0] == 10
+    assert stats.counts["bytes_in"] == sum(map(len, lines))
+
+    stats.exprs.append(parse_expr('$.a > 5 && find("y", $.s)'))
+    stats_ = stats.to_dict()
+    assert stats_["records_in"] == 10 and stats_["records_out"] == 0
+    assert set(stats_["stages"]) == {"read", "decode", "other"}
+    assert {node["expr"] for node in stats_["slowest_nodes"]} == {
+        '(($.a > 5.0) && find("y", $.s))', "($.a > 5.0)", '$.a', 'find("y", $.s)', '$.s'}
+
+    # Without stats, functions are not wrapped at all.
+    assert timed("decode", json.loads) is json.loads
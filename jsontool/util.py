@@ -2,44 +2,834 @@
 Utilities
 """
 
+import io
+import os
 import re
 import csv
 import json
+import mmap
+import bz2
+import gzip
+import lzma
+import stat
+import time
+import queue
 import logging
+import threading
+from collections import deque
+from functools import partial
 
 logger = logging.getLogger(__name__)
 
+class JsonCodec():
+    """
+    A JSON backend: `loads` accepts str, bytes or memoryview and `dumps`
+    returns UTF-8 bytes.
+    """
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return f"<codec: {self.name}>"
+
+def _json_loads(data):
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+def _json_dumps(obj, indent=None, sort_keys=False):
+    return json.dumps(obj, indent=indent, sort_keys=sort_keys).encode("utf-8")
+
+def _orjson_codec():
+    import orjson
+
+    def _loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN, Infinity and integers beyond 64 bits are only accepted by json.
+            return _json_loads(data)
+
+    def _dumps(obj, indent=None, sort_keys=False):
+        if indent not in (None, 2):
+            return _json_dumps(obj, indent, sort_keys)
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, option=option)
+        except TypeError:
+            return _json_dumps(obj, indent, sort_keys)
+
+    return _loads, _dumps
+
+def _ujson_codec():
+    import ujson
+
+    def _loads(data):
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return ujson.loads(data)
+
+    def _dumps(obj, indent=None, sort_keys=False):
+        return ujson.dumps(obj, indent=indent or 0, sort_keys=sort_keys,
+                           escape_forward_slashes=False).encode("utf-8")
+
+    return _loads, _dumps
+
+def _simdjson_codec():
+    import simdjson
+
+    def _loads(data):
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return simdjson.loads(data)
+
+    # simdjson only decodes.
+    return _loads, _json_dumps
+
+_BACKENDS = {
+    "json": lambda: (_json_loads, _json_dumps),
+    "orjson": _orjson_codec,
+    "simdjson": _simdjson_codec,
+    "ujson": _ujson_codec,
+}
+# In order of preference for "auto".
+_FAST_BACKENDS = ["orjson", "simdjson", "ujson"]
+CODECS = ["auto"] + list(_BACKENDS)
+
+def get_codec(name="auto"):
+    """
+    Returns the JsonCodec for backend @name.
+
+    "auto" decodes with the fastest installed backend but encodes with
+    `json`, since only `json` produces the same bytes as before (the
+    other encoders omit the spaces after separators and format some
+    floats differently). Naming a backend uses it for both.
+    """
+    if name != "auto":
+        return JsonCodec(name, *_BACKENDS[name]())
+    for name_ in _FAST_BACKENDS:
+        try:
+            loads, _ = _BACKENDS[name_]()
+        except ImportError:
+            continue
+        return JsonCodec("auto ({})".format(name_), loads, _json_dumps)
+    return get_codec("json")
+
+_CODEC = get_codec()
+
+def set_default_codec(name):
+    global _CODEC
+    _CODEC = get_codec(name)
+
+def default_codec():
+    return _CODEC
+
+class _TextToBytes():
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        self.stream.write(bytes(data).decode("utf-8"))
+
+    def flush(self):
+        self.stream.flush()
+
+def binary_stream(stream):
+    """
+    Returns a stream that bytes can be written to for @stream.
+    """
+    if isinstance(stream, io.TextIOBase):
+        if hasattr(stream, "buffer"):
+            stream.flush()
+            return stream.buffer
+        return _TextToBytes(stream)
+    return stream
+
 def JsonFile(*args, **kwargs):
     def _ret(fname):
-        return json.load(open(fname, *args, **kwargs))
+        with open(fname, "rb") as f:
+            return _CODEC.loads(f.read())
     return _ret
 
-class JsonWriter():
-    def __init__(self, stream, indent=None):
+# Defaults for JsonWriter, set from the command line.
+_WRITER_OPTIONS = {"buffer_size": 1 << 20, "flush_interval": None, "threaded": False}
+
+def set_writer_options(**options):
+    _WRITER_OPTIONS.update(options)
+
+class _WriterThread():
+    """
+    Writes buffers to @stream in a background thread, flushing the stream
+    after those put with `flush`. With @idle_interval, `on_idle` (if set)
+    is called every @idle_interval seconds that nothing is put. An error
+    raised by a write (e.g. BrokenPipeError) is raised again by the next
+    `put` or `join`.
+    """
+    def __init__(self, stream, depth=4, idle_interval=None):
         self.stream = stream
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.idle_interval = idle_interval
+        self.on_idle = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_interval)
+            except queue.Empty:
+                if self.on_idle is not None:
+                    self.on_idle()
+                continue
+            try:
+                if item is None:
+                    return
+                data, flush = item
+                if self.error is None:
+                    self.stream.write(data)
+                    if flush:
+                        self.stream.flush()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def put(self, data, flush=False):
+        self._check()
+        self.queue.put((data, flush))
+
+    def put_nowait(self, data, flush=False):
+        # Raises queue.Full instead of waiting.
+        self.queue.put_nowait((data, flush))
+
+    def join(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+class JsonWriter():
+    """
+    Writes objects as JSON lines. Lines are collected and written
+    @buffer_size bytes at a time, when @flush_interval seconds have passed
+    since the last write, or on `flush`. With @threaded, a background
+    thread does the writes so that encoding overlaps with I/O, and also
+    writes lines that waited @flush_interval seconds while no more came;
+    otherwise the interval is only checked when the next line is written.
+    Call `close` when done.
+    """
+    def __init__(self, stream, indent=None, codec=None, sort_keys=False, **options):
+        options = dict(_WRITER_OPTIONS, **options)
+        self.stream = binary_stream(stream)
         self.indent = indent
+        self.sort_keys = sort_keys
+        self.codec = get_codec(codec) if isinstance(codec, str) else (codec or _CODEC)
+        self.buffer_size = options["buffer_size"]
+        self.flush_interval = options["flush_interval"]
+        self.thread = None
+        # Guards the buffer against the writer thread's timer.
+        self.lock = None
+        if options["threaded"]:
+            self.thread = _WriterThread(self.stream, idle_interval=self.flush_interval)
+            if self.flush_interval is not None:
+                self.lock = threading.Lock()
+                self.thread.on_idle = self._on_idle
+        self.buffer = []
+        self.size = 0
+        self.last_write = time.monotonic()
 
     def write(self, obj):
-        self.stream.write(json.dumps(obj, indent=self.indent))
-        self.stream.write("\n")
+        if isinstance(obj, RawJson):
+            self.write_raw(obj.data)
+        else:
+            self._append(self.codec.dumps(obj, indent=self.indent, sort_keys=self.sort_keys) + b"\n")
+
+    def write_raw(self, line):
+        """
+        Writes an already encoded line as is.
+        """
+        self._append(line)
+        if not line or line[-1] != 0x0a:
+            self._append(b"\n")
+
+    def _append(self, data):
+        if self.lock is None:
+            self._add(data)
+        else:
+            with self.lock:
+                self._add(data)
+
+    def _add(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self._write_buffer()
+        elif self.flush_interval is not None and time.monotonic() - self.last_write >= self.flush_interval:
+            # Written for someone waiting on the lines, so through the stream's buffer too.
+            self._write_buffer(flush=True)
+
+    def _write_buffer(self, flush=False):
+        # Lines may be views of the input, which join copies once.
+        data = b"".join(self.buffer)
+        self.buffer, self.size = [], 0
+        self.last_write = time.monotonic()
+        if self.thread is not None:
+            self.thread.put(data, flush)
+        else:
+            self.stream.write(data)
+            if flush:
+                self.stream.flush()
+
+    def _on_idle(self):
+        # Called by the writer thread, which can't wait for the lock or the
+        # queue: the main thread may hold the lock while waiting for the
+        # queue. Skipped now means tried again after the next interval.
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.buffer and time.monotonic() - self.last_write >= self.flush_interval:
+                self.thread.put_nowait(b"".join(self.buffer), True)
+                self.buffer, self.size = [], 0
+                self.last_write = time.monotonic()
+        except queue.Full:
+            pass
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        if self.lock is not None:
+            with self.lock:
+                if self.buffer:
+                    self._write_buffer()
+        elif self.buffer:
+            self._write_buffer()
+        if self.thread is not None:
+            self.thread.join()
+        self.stream.flush()
+
+    def close(self):
+        """
+        Writes anything buffered; the stream stays open.
+        """
+        self.flush()
+        if self.thread is not None:
+            self.thread.close()
+            self.thread = None
+
+# Block size for reading inputs that can't be memory-mapped.
+READ_SIZE = 1 << 20
+
+def _is_regular_file(fstream):
+    try:
+        return stat.S_ISREG(os.fstat(fstream.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return False
+
+def _grep(buf, view, needle, pos, end):
+    """
+    Yields the lines of @buf that start in [@pos, @end) and contain
+    @needle, jumping from one occurrence of @needle to the next.
+    """
+    find, rfind = buf.find, buf.rfind
+    size = len(buf)
+    while pos < end:
+        hit = find(needle, pos)
+        if hit < 0:
+            return
+        start = rfind(b"\n", pos, hit) + 1 or pos
+        if start >= end:
+            return
+        nl = find(b"\n", hit)
+        stop = size if nl < 0 else nl + 1
+        yield view[start:stop]
+        pos = stop
+
+def _mmap_lines(fstream, start, end, contains=None):
+    size = os.fstat(fstream.fileno()).st_size
+    if size == 0:
+        return
+    mm = mmap.mmap(fstream.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mm, "madvise"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mm)
+    end = size if end is None else min(end, size)
+    pos = fstream.tell() if start is None else start
+    try:
+        if contains:
+            yield from _grep(mm, view, contains, pos, end)
+            return
+        find = mm.find
+        while pos < end:
+            nl = find(b"\n", pos)
+            nl = size if nl < 0 else nl + 1
+            yield view[pos:nl]
+            pos = nl
+    finally:
+        _close_map(mm, view)
+
+def _close_map(mm, view):
+    try:
+        view.release()
+        mm.close()
+    except BufferError:
+        # A caller still holds a line; the map is closed when it is collected.
+        pass
+
+def read_ranges(fstream, ranges):
+    """
+    Yields the lines of a regular file that start in each (start, end)
+    byte range of @ranges, which must start at lines, as memoryview
+    slices of a single map of the file.
+    """
+    size = os.fstat(fstream.fileno()).st_size
+    if size == 0:
+        return
+    mm = mmap.mmap(fstream.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    try:
+        find = mm.find
+        for pos, end in ranges:
+            end = min(end, size)
+            while pos < end:
+                nl = find(b"\n", pos)
+                nl = size if nl < 0 else nl + 1
+                yield view[pos:nl]
+                pos = nl
+    finally:
+        _close_map(mm, view)
+
+def _buffered_grep(fstream, contains):
+    # read1 returns what a pipe has instead of waiting for a full block.
+    read = getattr(fstream, "read1", fstream.read)
+    tail = b""
+    while True:
+        block = read(READ_SIZE)
+        if not block:
+            break
+        data = tail + block
+        last = data.rfind(b"\n") + 1
+        yield from _grep(data, memoryview(data), contains, 0, last)
+        tail = data[last:]
+    if tail:
+        yield from _grep(tail, memoryview(tail), contains, 0, len(tail))
+
+def _buffered_lines(fstream):
+    # read1 returns what a pipe has instead of waiting for a full block.
+    read = getattr(fstream, "read1", fstream.read)
+    tail = b""
+    while True:
+        block = read(READ_SIZE)
+        if not block:
+            break
+        view = memoryview(block)
+        pos = 0
+        if tail:
+            nl = block.find(b"\n")
+            if nl < 0:
+                tail += block
+                continue
+            yield tail + block[:nl + 1]
+            tail, pos = b"", nl + 1
+        find = block.find
+        while True:
+            nl = find(b"\n", pos)
+            if nl < 0:
+                break
+            yield view[pos:nl + 1]
+            pos = nl + 1
+        tail = block[pos:]
+    if tail:
+        yield tail
+
+def read_lines(fstream, start=None, end=None, contains=None):
+    """
+    Yields the lines of a binary stream as bytes-like objects, including
+    the trailing newline; with @contains, only the lines that contain
+    those bytes, which is much faster than checking each line.
+
+    Regular files are memory-mapped and lines are returned as
+    memoryview slices of the map without copying; other streams (pipes,
+    stdin) are read in large blocks. @start and @end restrict a regular
+    file to lines that start in that byte range.
+    """
+    if _is_regular_file(fstream):
+        return _mmap_lines(fstream, start, end, contains)
+    assert start is None and end is None, "Byte ranges need a regular file"
+    if contains:
+        return _buffered_grep(fstream, contains)
+    return _buffered_lines(fstream)
+
+# Compressed streams are recognized by their first bytes when reading and
+# by their file extension when writing.
+_MAGIC = [
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+]
+_EXTENSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz", ".zst": "zstd"}
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd files need zstandard; install it with `pip install jsontool[zstd]`")
+    return zstandard
+
+def detect_compression(fstream):
+    """
+    Returns the compression of a binary stream from its first bytes
+    without consuming them, or None.
+    """
+    if not hasattr(fstream, "peek"):
+        return None
+    head = fstream.peek(6)[:6]
+    for magic, compression in _MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+class _ReadAhead(io.RawIOBase):
+    """
+    Reads blocks from @stream in a background thread, so that
+    decompression (which releases the GIL) overlaps with parsing.
+    """
+    def __init__(self, stream, name=None, depth=4):
+        super().__init__()
+        self.stream = stream
+        self.name = name
+        self.blocks = queue.Queue(depth)
+        self.block = b""
+        self.eof = False
+        threading.Thread(target=self._fill, daemon=True).start()
+
+    def _fill(self):
+        try:
+            while True:
+                block = self.stream.read(READ_SIZE)
+                self.blocks.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self.blocks.put(e)
+
+    def readable(self):
+        return True
+
+    def _next_block(self):
+        block = self.blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        self.eof = not block
+        return block
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        if not self.block and not self.eof:
+            self.block = self._next_block()
+        ret, self.block = self.block[:size], self.block[size:]
+        return ret
+
+    def readall(self):
+        blocks = [self.block]
+        self.block = b""
+        while not self.eof:
+            blocks.append(self._next_block())
+        return b"".join(blocks)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def open_input(fstream):
+    """
+    Returns a binary stream of the decompressed contents of @fstream if
+    it is compressed, and @fstream itself otherwise.
+    """
+    compression = detect_compression(fstream)
+    if compression is None:
+        return fstream
+    if compression == "gzip":
+        # Reads files of several gzip members, like those of pigz and bgzip.
+        stream = gzip.GzipFile(fileobj=fstream, mode="rb")
+    elif compression == "bz2":
+        stream = bz2.BZ2File(fstream, "rb")
+    elif compression == "xz":
+        stream = lzma.LZMAFile(fstream, "rb")
+    else:
+        stream = _zstandard().ZstdDecompressor().stream_reader(fstream, read_across_frames=True)
+    return _ReadAhead(stream, getattr(fstream, "name", None))
+
+class _ParallelCompressor():
+    """
+    Compresses blocks of @block_size bytes with @compress in a pool of
+    threads and writes them in order. Each block is a complete gzip
+    member (or bz2 or xz stream) and a sequence of them decompresses as
+    one stream, as with pigz.
+    """
+    def __init__(self, stream, compress, block_size=4 << 20, threads=None):
+        self.stream = stream
+        self.compress = compress
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count() or 1
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        self.pending.append(self.executor.submit(self.compress, b"".join(self.buffer)))
+        self.buffer, self.size = [], 0
+        while len(self.pending) > 2 * self.threads:
+            self.stream.write(self.pending.popleft().result())
+
+    def flush(self):
+        if self.buffer:
+            self._submit()
+        while self.pending:
+            self.stream.write(self.pending.popleft().result())
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+
+def open_output(fstream, compression=None):
+    """
+    Returns a binary stream that compresses to @fstream according to
+    @compression or to the extension of its name, and @fstream itself if
+    neither asks for compression. Close the returned stream when done;
+    that doesn't close @fstream.
+    """
+    if compression is None:
+        name = getattr(fstream, "name", None)
+        compression = compression_of(name) if isinstance(name, str) else None
+    if compression is None:
+        return fstream
+    if compression == "zstd":
+        # zstd compresses with several threads on its own.
+        return _zstandard().ZstdCompressor(threads=-1).stream_writer(fstream, closefd=False)
+    return _ParallelCompressor(fstream, block_compressor(compression))
+
+def block_compressor(compression):
+    """
+    Returns a function that compresses a block of bytes into a complete
+    gzip member (or bz2 or xz stream, or zstd frame), or None for no
+    @compression. Compressed blocks written one after the other
+    decompress as one stream.
+    """
+    if compression is None:
+        return None
+    if compression == "gzip":
+        return partial(gzip.compress, compresslevel=6, mtime=0)
+    elif compression == "bz2":
+        return bz2.compress
+    elif compression == "xz":
+        return lzma.compress
+    return _zstandard().ZstdCompressor().compress
 
+def compression_of(fname):
+    """
+    Returns the compression that the extension of @fname asks for, or None.
+    """
+    return _EXTENSIONS.get(os.path.splitext(fname)[1])
+
+def _is_binary(fstream):
+    return isinstance(fstream, (io.BufferedIOBase, io.RawIOBase))
 
-def load_jsonl(fstream):
+def load_jsonl(fstream, codec=None):
     if isinstance(fstream, str):
-        with open(fstream) as fstream_:
-            return list(load_jsonl(fstream_))
+        with open(fstream, "rb") as fstream_:
+            return list(load_jsonl(fstream_, codec))
+
+    if _is_binary(fstream):
+        fstream = read_lines(fstream)
+    loads = (codec or _CODEC).loads
+    return (loads(line) for line in fstream)
+
+class RawJson():
+    """
+    A JSON value that has been left undecoded, as a bytes-like span.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __repr__(self):
+        return f"<raw: {bytes(self.data)!r}>"
+
+    def decode(self, codec=None):
+        return (codec or _CODEC).loads(self.data)
+
+_WS = re.compile(rb"[ \t\r\n]*")
+_SCALAR = re.compile(rb"[^,:}\]\s]+")
+_QUOTE, _BACKSLASH, _COMMA, _COLON = b'"\\,:'
+_OPEN = frozenset(b"{[")
+_STRUCTURAL = b'"{}[]'
+
+def _skip_string(data, pos):
+    while True:
+        end = data.find(b'"', pos + 1)
+        if end < 0:
+            raise ValueError("Unterminated string at {}".format(pos))
+        escape = end - 1
+        while data[escape] == _BACKSLASH:
+            escape -= 1
+        if (end - 1 - escape) % 2 == 0:
+            return end + 1
+        pos = end
 
-    return (json.loads(line) for line in fstream)
+def _skip_value(data, pos):
+    """
+    Returns the end of the JSON value that starts at @pos. Containers are
+    skipped by matching brackets without checking their contents.
+    """
+    c = data[pos]
+    if c == _QUOTE:
+        return _skip_string(data, pos)
+    if c not in _OPEN:
+        return _SCALAR.match(data, pos).end()
+
+    # Jump between structural characters with bytes.find, remembering
+    # where the next one of each kind is.
+    n = len(data)
+    find = data.find
+    nexts = [find(c, pos) for c in _STRUCTURAL]
+    nexts = [n if p < 0 else p for p in nexts]
+    depth = 0
+    while True:
+        p = min(nexts)
+        if p == n:
+            raise ValueError("Unterminated container at {}".format(pos))
+        c = data[p]
+        if c == _QUOTE:
+            end = _skip_string(data, p)
+        else:
+            depth += 1 if c in _OPEN else -1
+            if depth == 0:
+                return p + 1
+            end = p + 1
+        for i, p_ in enumerate(nexts):
+            if p_ < end:
+                p_ = find(_STRUCTURAL[i], end)
+                nexts[i] = n if p_ < 0 else p_
+
+def _load_projected(data, pos, projection, loads):
+    ret = {}
+    pos = _WS.match(data, pos + 1).end()
+    if data[pos] == ord("}"):
+        return ret, pos + 1
+    while True:
+        assert data[pos] == _QUOTE, "Expected a key at {}".format(pos)
+        end = _skip_string(data, pos)
+        key = data[pos + 1:end - 1]
+        key = json.loads(data[pos:end]) if b"\\" in key else key.decode("utf-8")
+        pos = _WS.match(data, end).end()
+        assert data[pos] == _COLON, "Expected ':' at {}".format(pos)
+        pos = _WS.match(data, pos + 1).end()
+
+        if key in projection:
+            sub = projection[key]
+            if sub is not None and data[pos] == ord("{"):
+                ret[key], pos = _load_projected(data, pos, sub, loads)
+            else:
+                end = _skip_value(data, pos)
+                ret[key] = loads(data[pos:end])
+                pos = end
+        else:
+            end = _skip_value(data, pos)
+            ret[key] = RawJson(data[pos:end])
+            pos = end
+
+        pos = _WS.match(data, pos).end()
+        if data[pos] == _COMMA:
+            pos = _WS.match(data, pos + 1).end()
+        else:
+            assert data[pos] == ord("}"), "Expected ',' or '}}' at {}".format(pos)
+            return ret, pos + 1
+
+def load_projected(line, projection, codec=None):
+    """
+    Decodes the parts of a JSON object selected by @projection (see
+    `expr.projection`), leaving all other fields as `RawJson` spans.
+    Skipped values are only checked for matching brackets and quotes.
+    """
+    loads = (codec or _CODEC).loads
+    if projection is None:
+        return loads(line)
+    if not isinstance(line, bytes):
+        line = bytes(line)
+    pos = _WS.match(line).end()
+    if line[pos] != ord("{"):
+        return loads(line)
+    try:
+        ret, _ = _load_projected(line, pos, projection, loads)
+    except (AssertionError, AttributeError, IndexError, ValueError) as e:
+        raise ValueError("Invalid JSON object: {}".format(e))
+    return ret
 
-def save_jsonl(fstream, objs):
+def save_jsonl(fstream, objs, codec=None):
     if isinstance(fstream, str):
-        with open(fstream, "w") as fstream_:
-            save_jsonl(fstream_, objs)
+        with open(fstream, "wb") as fstream_:
+            save_jsonl(fstream_, objs, codec)
         return
 
+    writer = JsonWriter(fstream, codec=codec, sort_keys=True)
     for obj in objs:
-        fstream.write(json.dumps(obj, sort_keys=True))
-        fstream.write("\n")
+        writer.write(obj)
+    writer.close()
+
+def batched(itable, n):
+    """
+    Yields lists of @n items (the last possibly shorter) from @itable.
+    """
+    batch = []
+    for item in itable:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def transform_lines(transform, lines):
+    """
+    Yields the outputs of @transform over @lines. Transforms with a
+    `batch_size` attribute take a list of lines at a time.
+    """
+    batch_size = getattr(transform, "batch_size", None)
+    if batch_size:
+        for batch in batched(lines, batch_size):
+            yield from transform(batch)
+    else:
+        for line in lines:
+            yield from transform(line)
 
 def first(itable):
     return next(iter(itable))
@@ -113,12 +903,14 @@ def visit_obj(fn, obj, path=None):
             fn(value, path)
         path.pop()
 
+def column_name(path):
+    return ".".join(re.sub(r"[^a-zA-Z]", "", k) for k in path)
+
 def list_schema(obj):
     ret = []
 
-    _to_key = lambda k: re.sub(r"[^a-zA-Z]", "", k)
     def _get_schema(value, path):
-        ret.append(".".join(map(_to_key, path)))
+        ret.append(column_name(path))
 
     visit_obj(_get_schema, obj)
     return ret
@@ -135,6 +927,126 @@ def list_obj(obj):
     visit_obj(_to_str, obj)
     return ret
 
+def _leaf_paths(obj, prefix, ret):
+    for key, value in obj.items():
+        if isinstance(value, dict):
+            _leaf_paths(value, prefix + (key,), ret)
+        else:
+            ret.add(prefix + (key,))
+
+def list_columns(objs):
+    """
+    Returns the union of the flattened key paths of @objs, in the order
+    `list_obj` visits them.
+    """
+    ret = set()
+    for obj in objs:
+        if isinstance(obj, dict):
+            _leaf_paths(obj, (), ret)
+    return sorted(ret)
+
+_MISSING = object()
+_EMPTY = {}
+
+def _cell(value):
+    if value.__class__ is str:
+        return value
+    if value is _MISSING or isinstance(value, dict):
+        return ""
+    if isinstance(value, list):
+        return ",".join(map(str, value))
+    return str(value)
+
+def compile_row(columns):
+    """
+    Returns a function mapping an object to its values for @columns (key
+    paths from `list_columns`), formatted like `list_obj`; missing values
+    are empty.
+    """
+    tree = {}
+    for path in columns:
+        node = tree
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node.setdefault(path[-1], {})
+
+    # Each dict on the way to a column is looked up once per object.
+    body, parents = [], {(): "obj"}
+    def _walk(node, prefix):
+        for key, children in node.items():
+            if children:
+                var = "d{}".format(len(parents))
+                parents[prefix + (key,)] = var
+                body.append("{} = {}.get({!r}, _EMPTY)".format(var, parents[prefix], key))
+                body.append("if {0}.__class__ is not dict: {0} = _EMPTY".format(var))
+                _walk(children, prefix + (key,))
+    _walk(tree, ())
+    cells = ["_cell({}.get({!r}, _MISSING))".format(parents[path[:-1]], path[-1]) for path in columns]
+    source = "def _row(obj):\n" + "".join("    {}\n".format(line) for line in body) + \
+             "    return [{}]\n".format(", ".join(cells))
+
+    env = {"_cell": _cell, "_MISSING": _MISSING, "_EMPTY": _EMPTY}
+    exec(source, env)
+    ret = env["_row"]
+    ret.source = source
+    return ret
+
+class _BytesToText():
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        self.stream.write(data.encode("utf-8"))
+
+    def flush(self):
+        self.stream.flush()
+
+class CsvWriter():
+    """
+    Writes each object as a row of its flattened values (see `list_obj`),
+    or of its values for @columns if given. Rows for @columns are encoded
+    @batch_size at a time, so call `close` when done.
+    """
+    def __init__(self, stream, delimiter="\t", columns=None, batch_size=1024):
+        if not isinstance(stream, io.TextIOBase):
+            stream = _BytesToText(stream)
+        self.stream = stream
+        self.writer = csv.writer(stream, delimiter=delimiter)
+        self.row = compile_row(columns) if columns is not None else None
+        self.batch_size = batch_size
+        self.rows = []
+        self.buffer = io.StringIO()
+        self.buffer_writer = csv.writer(self.buffer, delimiter=delimiter)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def write(self, obj):
+        if self.row is None:
+            self.writer.writerow(list_obj(obj))
+            return
+        self.rows.append(self.row(obj))
+        if len(self.rows) >= self.batch_size:
+            self._write_rows()
+
+    def _write_rows(self):
+        self.buffer_writer.writerows(self.rows)
+        self.stream.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.rows = []
+
+    def flush(self):
+        if self.rows:
+            self._write_rows()
+        self.stream.flush()
+
+    def close(self):
+        """
+        Writes anything buffered; the stream stays open.
+        """
+        self.flush()
+
 def load_csv(fstream, delimiter="\t"):
     reader = csv.reader(fstream, delimiter=delimiter)
 
@@ -143,3 +1055,180 @@ def load_csv(fstream, delimiter="\t"):
     for row in reader:
         obj = {key: value for key, value in zip(header, row)}
         yield obj
+
+def test_codecs():
+    obj = {"b": [1, 2.5, None, True], "a": {"c": "caf\u00e9 \\/ \"x\""}}
+    line = json.dumps(obj).encode("utf-8")
+
+    for name in CODECS:
+        try:
+            codec = get_codec(name)
+        except ImportError:
+            continue
+        assert codec.loads(line) == obj
+        assert codec.loads(line.decode("utf-8")) == obj
+        assert codec.loads(memoryview(line)) == obj
+        assert codec.loads(codec.dumps(obj, indent=2, sort_keys=True)) == obj
+        assert codec.loads(b'{"a": NaN}')["a"] != 0
+
+    # The default encoder preserves the format of json.dumps.
+    assert get_codec().dumps(obj) == line
+
+    output = io.StringIO()
+    save_jsonl(output, [obj, obj])
+    assert list(load_jsonl(output.getvalue().splitlines())) == [obj, obj]
+
+def test_read_lines(tmp_path):
+    lines = [b'{"a": %d}\n' % i for i in range(1000)] + [b'{"b": 1}']
+    fname = str(tmp_path / "test.jsonl")
+    with open(fname, "wb") as f:
+        f.writelines(lines)
+
+    with open(fname, "rb") as f:
+        assert [bytes(line) for line in read_lines(f)] == lines
+    with open(fname, "rb") as f:
+        assert [bytes(line) for line in read_lines(f, 9, 27)] == lines[1:3]
+    with open(fname, "rb") as f:
+        offsets = [len(b"".join(lines[:i])) for i in [0, 2, 3, 999, 1000]]
+        ranges = [(offsets[0], offsets[0] + 1), (offsets[1], offsets[2] + 1), (offsets[3], 10 ** 6), (10 ** 6, 10 ** 7)]
+        assert [bytes(line) for line in read_ranges(f, ranges)] == lines[:1] + lines[2:4] + lines[999:]
+    with open(fname, "rb") as f:
+        assert len(load_jsonl(fname)) == len(lines)
+    for needle in [b"7", b"99", b'"b"', b"1}", b"x"]:
+        expected = [line for line in lines if needle in line]
+        with open(fname, "rb") as f:
+            assert [bytes(line) for line in read_lines(f, contains=needle)] == expected
+        with open(fname, "rb") as f:
+            assert [bytes(line) for line in read_lines(f, 9, 1000, contains=needle)] == \
+                [bytes(line) for line in read_lines(f, 9, 1000) if needle in bytes(line)]
+
+    # Non-seekable streams are read in blocks, with lines spanning blocks.
+    global READ_SIZE
+    read_size, READ_SIZE = READ_SIZE, 7
+    try:
+        r, w = os.pipe()
+        os.write(w, b"".join(lines[:50]))
+        os.close(w)
+        with open(r, "rb") as f:
+            assert [bytes(line) for line in read_lines(f)] == lines[:50]
+        r, w = os.pipe()
+        os.write(w, b"".join(lines[-50:]))
+        os.close(w)
+        with open(r, "rb") as f:
+            assert [bytes(line) for line in read_lines(f, contains=b"9")] == [line for line in lines[-50:] if b"9" in line]
+    finally:
+        READ_SIZE = read_size
+
+def test_load_projected():
+    obj = {
+        "a": 1,
+        "b": {"c": "x", "d": [1, {"e": "}]"}], "f": {"g": None}},
+        "t": "a \\\"long\\\" text {with [brackets]}",
+        "v": [0.5, -1e3, [True, False, None], {"w": {}}, []],
+        "k\\\"": {},
+        }
+    line = json.dumps(obj).encode("utf-8")
+    for line_ in [line, json.dumps(obj, indent=2).encode("utf-8"), memoryview(line)]:
+        assert load_projected(line_, None) == obj
+        ret = load_projected(line_, {"a": None, "b": {"d": None, "f": {}}, "k\\\"": None})
+        assert ret["a"] == 1 and ret["b"]["d"] == obj["b"]["d"] and ret["k\\\""] == {}
+        assert isinstance(ret["b"]["c"], RawJson) and isinstance(ret["b"]["f"]["g"], RawJson)
+        assert {key: value.decode() for key, value in ret.items() if isinstance(value, RawJson)} == \
+                {"t": obj["t"], "v": obj["v"]}
+
+    assert load_projected(b"{}", {"a": None}) == {}
+    assert load_projected(b"[1, 2]\n", {"a": None}) == [1, 2]
+
+def test_compression(tmp_path):
+    lines = [b'{"a": %d}\n' % i for i in range(10000)]
+    for compression in ["gzip", "bz2", "xz", "zstd"]:
+        try:
+            _zstandard() if compression == "zstd" else None
+        except ImportError:
+            continue
+        fname = str(tmp_path / "test.jsonl")
+        with open(fname, "wb") as f:
+            output = open_output(f, compression)
+            if isinstance(output, _ParallelCompressor):
+                output.block_size = 1000
+            for line in lines:
+                output.write(line)
+            output.close()
+        with open(fname, "rb") as f:
+            assert detect_compression(f) == compression
+            assert [bytes(line) for line in read_lines(open_input(f))] == lines
+
+    with open(fname, "wb") as f:
+        f.writelines(lines)
+    with open(fname, "rb") as f:
+        assert open_input(f) is f
+    with open(str(tmp_path / "test.jsonl.gz"), "wb") as f:
+        assert isinstance(open_output(f), _ParallelCompressor)
+
+def test_json_writer():
+    class Stream(io.BytesIO):
+        writes = 0
+        def write(self, data):
+            self.writes += 1
+            return super().write(data)
+
+    objs = [{"a": i, "b": [1, 2]} for i in range(1000)]
+    expected = b"".join(json.dumps(obj).encode() + b"\n" for obj in objs)
+    for threaded in [False, True]:
+        stream = Stream()
+        writer = JsonWriter(stream, buffer_size=4096, threaded=threaded)
+        for obj in objs[:500]:
+            writer.write(obj)
+        for obj in objs[500:]:
+            writer.write_raw(memoryview(json.dumps(obj).encode()))
+        writer.close()
+        assert stream.getvalue() == expected
+        assert stream.writes < 20
+
+    # With a writer thread, a line is written once it waited the flush
+    # interval, even if no more lines come.
+    stream = Stream()
+    writer = JsonWriter(stream, flush_interval=0.01, threaded=True)
+    writer.write(objs[0])
+    deadline = time.monotonic() + 5
+    while not stream.getvalue() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stream.getvalue() == expected[:expected.index(b"\n") + 1]
+    for obj in objs[1:]:
+        writer.write(obj)
+    writer.close()
+    assert stream.getvalue() == expected
+
+    class BrokenStream(io.BytesIO):
+        def write(self, data):
+            raise BrokenPipeError()
+
+    writer = JsonWriter(BrokenStream(), buffer_size=1, threaded=True)
+    try:
+        for obj in objs:
+            writer.write(obj)
+        writer.close()
+        assert False, "BrokenPipeError was not raised"
+    except BrokenPipeError:
+        pass
+
+def test_compile_row():
+    objs = [{"b": {"x": 1, "y": [1, 2]}, "a": "s"}, {"a": None, "c": True, "b": {"x": {"z": 2}}}, {"b": 3}]
+    columns = list_columns(objs)
+    assert columns == [("a",), ("b",), ("b", "x"), ("b", "x", "z"), ("b", "y"), ("c",)]
+    assert [column_name(path) for path in columns] == ["a", "b", "b.x", "b.x.z", "b.y", "c"]
+
+    row = compile_row(columns)
+    assert row(objs[0]) == ["s", "", "1", "", "1,2", ""]
+    assert row(objs[1]) == ["None", "", "", "2", "", "True"]
+    assert row(objs[2]) == ["", "3", "", "", "", ""]
+    # Same as list_obj on records that have every column.
+    obj = {"b": {"y": [1, 2], "x": 1.5}, "a": "s"}
+    assert compile_row(list_columns([obj]))(obj) == list_obj(obj)
+
+    output = io.BytesIO()
+    writer = CsvWriter(output, ",", columns, batch_size=2)
+    for obj in objs:
+        writer.write(obj)
+    writer.close()
+    assert output.getvalue().decode().splitlines() == ["s,,1,,\"1,2\",", "None,,,2,,True", ",3,,,,"]
@@ -84,6 +84,9 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'fast': ['orjson'],
+        'arrow': ['pyarrow'],
+        'zstd': ['zstandard'],
     },
 
     # If there are data files included in your packages that need to be